@@ -40,6 +40,10 @@ NICENESS=12
 # 'flock' opens the file for reading to indicate when the workflow is running.
 export LOCKFILE=/storage/TTT/.TTT_snakemake.lock
 
+# Run ledger (SQLite3) where all tparty programs record stage timings and
+# resource use. Summarize it with 'run_ledger.py'. Unset to disable.
+export TPARTY_LEDGER=/storage/TTT/tparty_ledger.sqlite3
+
 # Load environment variables required to activate conda environment
 # Activate conda environment
 # Change workdir to analysis dir
@@ -50,6 +54,33 @@ source activate proteotyping
 cd /storage/TTT/                    
 export PATH=$TTT_BINDIR:$PATH  
 
+# Pre-fault the reference databases into the page cache and keep them
+# resident while this script runs, so the first jobs of a batch don't pay
+# the cold-read cost. Set to "no" to disable.
+WARM_CACHE=yes
+if [ "$WARM_CACHE" = "yes" ] && flock -n $LOCKFILE true; then
+	warm_cache.py \
+		--config TTT_pipeline_snakemake_config.yaml \
+		--hold \
+		--while-pid $$ \
+		> warm_cache.log 2>&1 &
+fi
+
+# Shared work queue (work_queue.py) on a filesystem all hosts can lock.
+# When set, this host also runs queued jobs (e.g. submitted with
+# 'work_queue.py submit $WORK_QUEUE run_xtandem.py ... SAMPLE.mzXML.gz'),
+# so any host with free capacity takes backlog from the others.
+WORK_QUEUE=
+WORK_QUEUE_JOBS=2
+if [ -n "$WORK_QUEUE" ]; then
+	flock -n $LOCKFILE.work_queue \
+		work_queue.py worker $WORK_QUEUE \
+			--jobs $WORK_QUEUE_JOBS \
+			--exit-when-empty \
+			--logdir work_queue_logs \
+		>> work_queue.log 2>&1 &
+fi
+
 # Run snakemake only if it isn't already currently running.
 # flock creates a lockfile that, when open, indicates if the workflow in
 # currently in progress. flock detects if the file is already opened and 
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+"""
+End-to-end pipeline benchmark with stand-in executables.
+
+Builds a synthetic workdir in the Snakemake layout (1.mzXML, 2.xml,
+3.fasta, 4.blast8, 5.results) with stand-ins for X!Tandem, X!!Tandem,
+mpirun, BLAT and taxonomic_composition that write realistic BIOML and
+blast8 after a configurable latency, then runs the commands of the
+Snakemake rules on every sample and reports samples per hour and time
+per stage.
+"""
+
+from sys import argv, exit, executable
+from os import path, makedirs, environ, chmod, replace
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfile
+from statistics import median
+import subprocess
+import argparse
+import logging
+import shlex
+import base64
+import random
+import struct
+import gzip
+import time
+
+from run_ledger import LEDGER_ENVIRONMENT_VARIABLE
+import profile_hooks
+
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# Stages in pipeline order, as run for each sample.
+STAGES = ["xtandem_bacterial", "xtandem_human", "parallel_xtandem",
+          "xml2fasta", "unique_bacterial_proteins", "unique_human_proteins",
+          "blast8", "resistance", "taxonomic_composition", "summary"]
+
+# Reference genome shards, searched concurrently as in the blat_bacterial rule.
+GENOME_SHARDS = 3
+
+Stage_Time = namedtuple("Stage_Time", ["sample", "stage", "seconds", "status"])
+
+
+# The stand-ins are written with a header setting LATENCY (seconds per
+# 1000 spectra or peptides, plus FIXED seconds per call) and, for
+# X!!Tandem, PARALLEL.
+TANDEM_STANDIN = r'''
+import gzip
+import random
+import re
+import sys
+import time
+from xml.sax.saxutils import quoteattr
+
+start = time.time()
+with open(sys.argv[1]) as f:
+    notes = dict(re.findall(r'label="([^"]+)">([^<]*)<', f.read()))
+with open(notes["list path, taxonomy information"]) as f:
+    taxa = f.read()
+taxon = re.search(r'<taxon label="{}">(.*?)</taxon>'.format(re.escape(notes["protein, taxon"])), taxa, re.S)
+proteins = []
+for url in re.findall(r'URL="([^"]+)"', taxon.group(1)):
+    with open(url) as f:
+        for record in f.read().split(">")[1:]:
+            header, _, sequence = record.partition("\n")
+            proteins.append((header.strip(), url, sequence.replace("\n", "")))
+
+spectrum_path = notes["spectrum, path"]
+with (gzip.open if spectrum_path.endswith(".gz") else open)(spectrum_path, "rt") as f:
+    text = f.read()
+if "BEGIN IONS" in text:
+    spectra = [(number, (re.findall(r"TITLE=.*?scan=(\d+)", block) or [str(number)])[0])
+               for number, block in enumerate(text.split("BEGIN IONS")[1:], start=1)]
+else:
+    spectra = [(int(scan), scan) for scan in re.findall(r'<scan num="(\d+)"[^>]*msLevel="2"', text)]
+
+output = notes["output, path"]
+if PARALLEL:
+    output = output[:-len(".xml")] + time.strftime(".%Y_%m_%d_%H_%M_%S.xml")
+rng = random.Random(spectrum_path + notes["protein, taxon"])
+with open(output, "w") as out:
+    out.write('<?xml version="1.0"?>\n<?xml-stylesheet type="text/xsl" href="tandem-style.xsl"?>\n')
+    out.write('<bioml xmlns:GAML="http://www.bioml.com/gaml/" label={}>\n'.format(quoteattr("models from '" + spectrum_path + "'")))
+    for number, scan in spectra:
+        if rng.random() > IDENTIFIED:
+            continue
+        label, url, sequence = rng.choice(proteins)
+        length = rng.randint(8, 20)
+        begin = rng.randint(0, len(sequence) - length)
+        peptide = sequence[begin:begin + length]
+        charge = rng.randint(2, 3)
+        mh = 110.0 * length + 19.0
+        expect = 10 ** -rng.uniform(0, 8)
+        hyperscore = 20 + 5 * -__import__("math").log10(expect)
+        out.write('<group id="{n}" mh="{mh:.4f}" z="{z}" rt="" expect="{e:.1e}" label={l} type="model" sumI="6.1" maxI="1.2e05" fI="1200" act="0" >\n'
+                  '<protein expect="{le:.1f}" id="{n}.1" uid="{n}" label={l} sumI="6.1" >\n'
+                  '<note label="description">{label}</note>\n<file type="peptide" URL="{url}"/>\n'
+                  '<peptide start="1" end="{end}">\n{sequence}\n'
+                  '<domain id="{n}.1.1" start="{s}" end="{e2}" expect="{e:.1e}" mh="{mh:.4f}" delta="0.0012" hyperscore="{h:.1f}" nextscore="{h2:.1f}" '
+                  'y_score="10.2" y_ions="{y}" b_score="4.1" b_ions="{b}" pre="{pre}" post="{post}" seq="{p}" missed_cleavages="0">\n'
+                  '</domain>\n</peptide>\n</protein>\n'
+                  '<group label="supporting data" type="support">\n'
+                  '<GAML:trace label="{n}.hyper" type="hyperscore expectation function">\n'
+                  '<GAML:attribute type="a0">3.2</GAML:attribute>\n<GAML:attribute type="a1">-0.21</GAML:attribute>\n'
+                  '<GAML:Xdata label="{n}.hyper" units="score"><GAML:values byteorder="INTEL" format="ASCII" numvalues="20">{xs}</GAML:values></GAML:Xdata>\n'
+                  '<GAML:Ydata label="{n}.hyper" units="counts"><GAML:values byteorder="INTEL" format="ASCII" numvalues="20">{ys}</GAML:values></GAML:Ydata>\n'
+                  '</GAML:trace>\n</group>\n'
+                  '<group label="fragment ion mass spectrum" type="support">\n<note label="Description">scan={scan}</note>\n'
+                  '<GAML:trace id="{n}" label="{n}.spectrum" type="tandem mass spectrum">\n'
+                  '<GAML:Xdata label="{n}.spectrum" units="MASSTOCHARGERATIO"><GAML:values byteorder="INTEL" format="ASCII" numvalues="50">{mz}</GAML:values></GAML:Xdata>\n'
+                  '<GAML:Ydata label="{n}.spectrum" units="UNKNOWN"><GAML:values byteorder="INTEL" format="ASCII" numvalues="50">{it}</GAML:values></GAML:Ydata>\n'
+                  '</GAML:trace>\n</group>\n</group>\n'.format(
+                      n=number, mh=mh, z=charge, e=expect, le=__import__("math").log10(expect), l=quoteattr(label),
+                      label=label.split(" ", 1)[-1], url=url, end=len(sequence), sequence=sequence,
+                      s=begin + 1, e2=begin + length, h=hyperscore, h2=hyperscore / 2, y=rng.randint(3, 12), b=rng.randint(1, 8),
+                      pre=sequence[max(0, begin - 4):begin] or "[", post=sequence[begin + length:begin + length + 4] or "]",
+                      p=peptide, scan=scan,
+                      xs=" ".join(str(x) for x in range(20)), ys=" ".join(str(rng.randint(0, 500)) for _ in range(20)),
+                      mz=" ".join("{:.1f}".format(rng.uniform(100, 2000)) for _ in range(50)),
+                      it=" ".join(str(rng.randint(1, 100)) for _ in range(50))))
+    time.sleep(max(0, FIXED + LATENCY * len(spectra) / 1000 - (time.time() - start)))
+    out.write('<group label="input parameters" type="parameters">\n')
+    for label, value in sorted(notes.items()):
+        out.write('\t<note type="input" label={}>{}</note>\n'.format(quoteattr(label), value))
+    out.write('</group>\n<group label="performance parameters" type="parameters">\n'
+              '\t<note label="list path, sequence source #1">{}</note>\n'
+              '\t<note label="modelling, total spectra used">{}</note>\n'
+              '\t<note label="timing, total (sec)">{:.2f}</note>\n</group>\n</bioml>\n'.format(
+                  proteins[0][1] if proteins else "", len(spectra), time.time() - start))
+'''
+
+MPIRUN_STANDIN = r'''
+import os
+import sys
+
+args = sys.argv[1:]
+while args and args[0] in ("-n", "-np", "--bind-to"):
+    args = args[2:]
+os.execvp(args[0], args)
+'''
+
+# blat DATABASE QUERY [options] OUTPUT
+BLAT_STANDIN = r'''
+import random
+import sys
+import time
+
+start = time.time()
+with open(sys.argv[2]) as f:
+    peptides = [line[1:].split()[0] for line in f if line.startswith(">")]
+rng = random.Random(sys.argv[1] + sys.argv[2])
+with open(sys.argv[-1], "w") as out:
+    for peptide in peptides:
+        for hit in range(rng.randint(0, 3)):
+            out.write("{}\tgenome_{}_{}\t100.00\t{}\t0\t0\t1\t{}\t{}\t{}\t1e-05\t{}.0\n".format(
+                peptide, rng.randint(1, 50), hit, 10, 10, 1000, 1030, 20))
+    time.sleep(max(0, FIXED + LATENCY * len(peptides) / 1000 - (time.time() - start)))
+'''
+
+# taxonomic_composition BLAST8 --write-discriminative-peptides FILE --output FILE [...]
+TAXONOMIC_COMPOSITION_STANDIN = r'''
+import argparse
+import collections
+import time
+
+start = time.time()
+parser = argparse.ArgumentParser()
+parser.add_argument("BLAST8")
+parser.add_argument("--write-discriminative-peptides", dest="discpeps")
+parser.add_argument("--output")
+options, _ = parser.parse_known_args()
+hits = collections.defaultdict(set)
+with open(options.BLAST8) as f:
+    for line in f:
+        peptide, subject = line.split("\t")[:2]
+        hits[peptide].add(subject.split("_")[1])
+species = collections.Counter(next(iter(s)) for s in hits.values() if len(s) == 1)
+with open(options.output, "w") as out:
+    out.write("Taxonomic composition\nspecies\tdiscriminative peptides\n")
+    for taxid, count in species.most_common():
+        out.write("species_{}\t{}\n".format(taxid, count))
+with open(options.discpeps, "w") as out:
+    out.write("Discriminative peptides\npeptide\ttaxid\trank\n")
+    for peptide, taxids in sorted(hits.items()):
+        out.write("{}\t{}\t{}\n".format(peptide, ",".join(sorted(taxids)), "species" if len(taxids) == 1 else "genus"))
+time.sleep(max(0, FIXED + LATENCY * len(hits) / 1000 - (time.time() - start)))
+'''
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Benchmark the tparty pipeline end to end on synthetic samples with stand-in X!Tandem, MPI, BLAT and taxonomic_composition executables. Reports samples per hour and time per stage. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("WORKDIR",
+        help="Directory for the synthetic pipeline workdir (created, reused if it exists).")
+    parser.add_argument("-s", "--samples", dest="samples", metavar="N",
+        type=int,
+        default=4,
+        help="Number of synthetic samples [%(default)s].")
+    parser.add_argument("--spectra", dest="spectra", metavar="N",
+        type=int,
+        default=2000,
+        help="MS2 spectra per sample [%(default)s].")
+    parser.add_argument("--proteins", dest="proteins", metavar="N",
+        type=int,
+        default=2000,
+        help="Proteins in each synthetic reference database [%(default)s].")
+    parser.add_argument("--identified", dest="identified", metavar="F",
+        type=float,
+        default=0.3,
+        help="Fraction of spectra the X!Tandem stand-in reports a PSM for [%(default)s].")
+    parser.add_argument("--tandem-latency", dest="tandem_latency", metavar="S",
+        type=float,
+        default=1.0,
+        help="X!Tandem stand-in seconds per 1000 spectra [%(default)s].")
+    parser.add_argument("--blat-latency", dest="blat_latency", metavar="S",
+        type=float,
+        default=0.5,
+        help="BLAT stand-in seconds per 1000 peptides, per genome shard [%(default)s].")
+    parser.add_argument("--fixed-latency", dest="fixed_latency", metavar="S",
+        type=float,
+        default=0.2,
+        help="Seconds per stand-in call, e.g. database loading [%(default)s].")
+    parser.add_argument("-j", "--jobs", dest="jobs", metavar="N",
+        type=int,
+        default=1,
+        help="Samples processed concurrently, like snakemake --jobs [%(default)s].")
+    parser.add_argument("-n", "--threads", dest="threads", metavar="N",
+        default="2",
+        help="--threads for run_xtandem.py and run_parallel_tandem.py [%(default)s].")
+    parser.add_argument("--xtandem-args", dest="xtandem_args", metavar="ARGS",
+        default="--slim --pin",
+        help="Extra arguments to run_xtandem.py, quoted, e.g. add --prefilter to measure it [%(default)s].")
+    parser.add_argument("--skip", dest="skip", metavar="STAGE",
+        nargs="*",
+        choices=STAGES,
+        default=[],
+        help="Stages not to run: " + ", ".join(STAGES) + ".")
+    parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        default="",
+        help="Write per sample and stage times as TSV [WORKDIR/benchmark.tsv].")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel, format="%(asctime)s %(levelname)s: %(message)s")
+    return options
+
+
+def random_fasta(filename, count, prefix, rng):
+    """
+    Write count random proteins of 150-600 residues to filename.
+    """
+
+    with open(filename, "w") as out:
+        for number in range(1, count + 1):
+            sequence = "M" + "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(150, 600)))
+            out.write(">{prefix}_{n} {prefix} protein {n}\n".format(prefix=prefix, n=number))
+            for pos in range(0, len(sequence), 60):
+                out.write(sequence[pos:pos + 60] + "\n")
+
+
+def random_genome(filename, length, rng):
+    """
+    Write a random nucleotide sequence of length bases to filename.
+    """
+
+    with open(filename, "w") as out:
+        out.write(">genome {}\n".format(path.basename(filename)))
+        sequence = "".join(rng.choice("ACGT") for _ in range(length))
+        for pos in range(0, len(sequence), 60):
+            out.write(sequence[pos:pos + 60] + "\n")
+
+
+def encode_peaks(count, rng):
+    """
+    Base64 of count random network order 32 bit (m/z, intensity) pairs.
+    """
+
+    mzs = sorted(rng.uniform(100, 2000) for _ in range(count))
+    values = []
+    for mz in mzs:
+        values.extend((mz, rng.expovariate(1e-3)))
+    return base64.b64encode(struct.pack(">{}f".format(len(values)), *values)).decode()
+
+
+def synthetic_mzxml(filename, spectra, rng):
+    """
+    Write gzipped mzXML with an MS1 scan followed by five MS2 scans, repeated.
+    """
+
+    with gzip.open(filename, "wt") as out:
+        out.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                  '<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.1">\n'
+                  '<msRun scanCount="{}">\n'.format(spectra + spectra // 5 + 1))
+        num = 0
+        for ms2 in range(spectra):
+            if ms2 % 5 == 0:
+                num += 1
+                out.write('<scan num="{}" msLevel="1" peaksCount="200" retentionTime="PT{:.2f}S">\n'
+                          '<peaks precision="32" byteOrder="network" pairOrder="m/z-int">{}</peaks>\n</scan>\n'.format(
+                              num, num * 0.5, encode_peaks(200, rng)))
+            num += 1
+            peaks = rng.randint(20, 150)
+            out.write('<scan num="{}" msLevel="2" peaksCount="{}" retentionTime="PT{:.2f}S">\n'
+                      '<precursorMz precursorIntensity="{:.1f}" precursorCharge="{}">{:.4f}</precursorMz>\n'
+                      '<peaks precision="32" byteOrder="network" pairOrder="m/z-int">{}</peaks>\n</scan>\n'.format(
+                          num, peaks, num * 0.5, rng.expovariate(1e-5), rng.randint(2, 3),
+                          rng.uniform(450, 1200), encode_peaks(peaks, rng)))
+        out.write('</msRun>\n</mzXML>\n')
+
+
+def write_standin(filename, body, **constants):
+    """
+    Write executable Python stand-in script with constants set in its header.
+    """
+
+    with open(filename, "w") as out:
+        out.write("#!{}\n".format(executable))
+        for name, value in sorted(constants.items()):
+            out.write("{} = {!r}\n".format(name, value))
+        out.write(body)
+    chmod(filename, 0o755)
+
+
+def create_workdir(options):
+    """
+    Create the synthetic workdir: samples, reference databases and stand-ins.
+
+    Existing samples and databases are reused; stand-ins are rewritten
+    so latencies can be changed between runs.
+    Returns the list of sample names.
+    """
+
+    workdir = options.WORKDIR
+    for dirname in ["1.mzXML", "2.xml", "3.fasta", "4.blast8", "5.results", "bin", "db", "shadow"]:
+        makedirs(path.join(workdir, dirname), exist_ok=True)
+
+    rng = random.Random(0)
+    databases = {}
+    for taxon in ["bacteria", "human"]:
+        databases[taxon] = path.abspath(path.join(workdir, "db", taxon + ".fasta"))
+        if not path.isfile(databases[taxon]):
+            random_fasta(databases[taxon], options.proteins, taxon, rng)
+    resistance_db = path.join(workdir, "db", "resistance.fasta")
+    if not path.isfile(resistance_db):
+        # Every tenth bacterial protein, so some peptides match exactly.
+        with open(databases["bacteria"]) as bacteria, open(resistance_db, "w") as out:
+            records = bacteria.read().split(">")[1:]
+            out.write("".join(">" + record for record in records[::10]))
+    for shard in range(1, GENOME_SHARDS + 1):
+        genome = path.join(workdir, "db", "reference_genomes_{:02d}.fasta".format(shard))
+        if not path.isfile(genome):
+            random_genome(genome, 100000, rng)
+    with open(path.join(workdir, "db", "taxonomy.xml"), "w") as out:
+        out.write('<?xml version="1.0"?>\n<bioml label="x! taxon-to-file matching list">\n')
+        for taxon, database in sorted(databases.items()):
+            out.write('\t<taxon label="{}">\n\t\t<file format="peptide" URL="{}"/>\n\t</taxon>\n'.format(taxon, database))
+        out.write('</bioml>\n')
+    default_parameters = path.join(path.dirname(path.abspath(__file__)), "..", "xtandem_files", "default_parameters.xml")
+    copyfile(default_parameters, path.join(workdir, "db", "default_parameters.xml"))
+
+    samples = []
+    for number in range(1, options.samples + 1):
+        sample = "S{:03d}".format(number)
+        mzxml = path.join(workdir, "1.mzXML", sample + ".mzXML.gz")
+        if not path.isfile(mzxml):
+            synthetic_mzxml(mzxml, options.spectra, random.Random(sample))
+        samples.append(sample)
+
+    bindir = path.join(workdir, "bin")
+    latency = dict(FIXED=options.fixed_latency, IDENTIFIED=options.identified)
+    write_standin(path.join(bindir, "tandem"), TANDEM_STANDIN, LATENCY=options.tandem_latency, PARALLEL=False, **latency)
+    write_standin(path.join(bindir, "tandem.exe"), TANDEM_STANDIN, LATENCY=options.tandem_latency, PARALLEL=True, **latency)
+    write_standin(path.join(bindir, "mpirun"), MPIRUN_STANDIN)
+    write_standin(path.join(bindir, "blat"), BLAT_STANDIN, LATENCY=options.blat_latency, FIXED=options.fixed_latency)
+    write_standin(path.join(bindir, "taxonomic_composition"), TAXONOMIC_COMPOSITION_STANDIN, LATENCY=0.0, FIXED=options.fixed_latency)
+    logging.info("Created workdir %s with %s samples of %s spectra", workdir, len(samples), options.spectra)
+    return samples
+
+
+def stage_commands(sample, options):
+    """
+    Commands (argument lists) of each stage for sample, mirroring the Snakemake rules.
+
+    blast8 is the blat_bacterial rule (BLAT on each genome shard in the
+    background, then concatenated) and resistance the blat_resistance
+    rule (exact_match.py). parallel_xtandem is not a workflow rule; it
+    compares run_parallel_tandem.py with run_xtandem.py. Paths are
+    absolute; each stage runs in its own shadow directory.
+    """
+
+    here = path.dirname(path.abspath(__file__))
+    workdir = path.abspath(options.WORKDIR)
+    script = lambda name: [executable, path.join(here, name)]
+    mzxml = path.join(workdir, "1.mzXML", sample + ".mzXML.gz")
+    xmldir = path.join(workdir, "2.xml", sample)
+    fasta = path.join(workdir, "3.fasta", sample + ".bacterial.fasta")
+    blast8 = path.join(workdir, "4.blast8", sample + ".bacterial.blast8")
+    resistance = path.join(workdir, "4.blast8", sample + ".resistance.blast8")
+    results = path.join(workdir, "5.results", sample, sample)
+    taxonomy = path.join(workdir, "db", "taxonomy.xml")
+    defaults = path.join(workdir, "db", "default_parameters.xml")
+    cutoffs = ["--min-hyperscore", "30", "--max-evalue", "1"]
+
+    def xtandem(taxon, name):
+        return script("run_xtandem.py") + [
+                "--output", xmldir + "." + name + ".xml",
+                "--xtandem", path.join(workdir, "bin", "tandem"),
+                "--threads", options.threads,
+                "--taxon", taxon,
+                "--taxonomy", taxonomy,
+                "--default-parameters", defaults] + shlex.split(options.xtandem_args) + [mzxml]
+
+    blat_options = "-out=blast8 -t=dnax -q=prot -tileSize=5 -stepSize=5 -minScore=10 -minIdentity=90"
+    blat_calls = []
+    shard_outputs = []
+    for shard in range(1, GENOME_SHARDS + 1):
+        genome = path.join(workdir, "db", "reference_genomes_{:02d}.fasta".format(shard))
+        shard_output = "{}_{:02d}".format(blast8, shard)
+        blat_calls.append("blat {} {} {} {} & pids=\"$pids $!\"".format(
+                shlex.quote(genome), shlex.quote(fasta), blat_options, shlex.quote(shard_output)))
+        shard_outputs.append(shlex.quote(shard_output))
+    blat = "\n".join(blat_calls + [
+            "for pid in $pids; do wait $pid || exit 1; done",
+            "cat {} > {} && rm -f {}".format(" ".join(shard_outputs), shlex.quote(blast8), " ".join(shard_outputs))])
+
+    return [
+        ("xtandem_bacterial", xtandem("bacteria", "bacterial")),
+        ("xtandem_human", xtandem("human", "human")),
+        ("parallel_xtandem", script("run_parallel_tandem.py") + [
+                "--output", xmldir + ".parallel.xml",
+                "--db", path.join(workdir, "db", "bacteria.fasta"),
+                "--xtandem", path.join(workdir, "bin", "tandem.exe"),
+                "--threads", options.threads, mzxml]),
+        ("xml2fasta", script("convert_tandem_xml_2_fasta.py") + cutoffs + [
+                "--outfile", fasta, xmldir + ".bacterial.xml"]),
+        ("unique_bacterial_proteins", script("create_unique_protein_list.py") + cutoffs + [
+                "-o", results + ".unique_bacterial_proteins.txt", xmldir + ".bacterial.xml"]),
+        ("unique_human_proteins", script("create_unique_protein_list.py") + cutoffs + [
+                "-o", results + ".unique_human_proteins.txt", xmldir + ".human.xml"]),
+        ("blast8", ["sh", "-c", blat]),
+        ("resistance", script("exact_match.py") + [
+                path.join(workdir, "db", "resistance.fasta"), fasta, "--outfile", resistance]),
+        ("taxonomic_composition", [path.join(workdir, "bin", "taxonomic_composition"), blast8,
+                "--peptide-fasta", fasta,
+                "--write-discriminative-peptides", results + ".discriminative_peptides.txt",
+                "--output", results + ".taxonomic_composition.txt"]),
+    ]
+
+
+def summary_results(sample):
+    """
+    Run gspread_report.get_summary_results for sample in workdir.
+
+    Runs in a subprocess, as get_summary_results reads paths relative
+    to the working directory.
+    """
+
+    here = path.dirname(path.abspath(__file__))
+    code = "import sys; sys.path.insert(0, {!r}); import gspread_report; print(gspread_report.get_summary_results({!r}))".format(here, sample)
+    return [executable, "-c", code]
+
+
+def run_sample(sample, options, env):
+    """
+    Run all stages for sample, in order. Returns a list of Stage_Time.
+
+    A failed stage is logged with its output; later stages still run,
+    as the Snakemake rules they mirror would for existing inputs.
+    """
+
+    workdir = path.abspath(options.WORKDIR)
+    makedirs(path.join(workdir, "5.results", sample), exist_ok=True)
+    commands = stage_commands(sample, options) + [("summary", summary_results(sample))]
+    times = []
+    for stage, command in commands:
+        if stage in options.skip:
+            continue
+        shadow = path.join(workdir, "shadow", sample + "." + stage)
+        makedirs(shadow, exist_ok=True)
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=workdir if stage == "summary" else shadow, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        seconds = time.perf_counter() - start
+        status = "ok" if process.returncode == 0 else "failed"
+        if process.returncode:
+            logging.error("%s %s failed (exit %s):\n%s", sample, stage, process.returncode, process.stdout[-2000:])
+        elif stage == "summary":
+            logging.info("%s", process.stdout.strip())
+        logging.debug("%s %s took %.2f s", sample, stage, seconds)
+        times.append(Stage_Time(sample, stage, seconds, status))
+    return times
+
+
+def format_report(times, wall_seconds, samples):
+    """
+    Samples per hour and per stage time breakdown, as text.
+    """
+
+    per_stage = defaultdict(list)
+    failed = defaultdict(int)
+    for record in times:
+        per_stage[record.stage].append(record.seconds)
+        failed[record.stage] += record.status != "ok"
+    total = sum(record.seconds for record in times) or 1
+    lines = ["{} samples in {:.1f} s: {:.1f} samples/hour".format(
+        samples, wall_seconds, samples * 3600 / wall_seconds if wall_seconds else 0)]
+    lines.append("{:<28}{:>6}{:>10}{:>10}{:>10}{:>8}{:>8}".format("stage", "runs", "total_s", "median_s", "max_s", "share", "failed"))
+    for stage in STAGES:
+        if stage not in per_stage:
+            continue
+        seconds = per_stage[stage]
+        lines.append("{:<28}{:>6}{:>10.2f}{:>10.2f}{:>10.2f}{:>7.1f}%{:>8}".format(
+            stage, len(seconds), sum(seconds), median(seconds), max(seconds), 100 * sum(seconds) / total, failed[stage]))
+    return "\n".join(lines)
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    with profile_hooks.timer("create_workdir"):
+        samples = create_workdir(options)
+
+    env = dict(environ)
+    env["PATH"] = path.abspath(path.join(options.WORKDIR, "bin")) + ":" + env.get("PATH", "")
+    env[LEDGER_ENVIRONMENT_VARIABLE] = path.abspath(path.join(options.WORKDIR, "ledger.sqlite3"))
+    env["TPARTY_CPU_LEASES"] = path.abspath(path.join(options.WORKDIR, "cpu_leases"))
+
+    start = time.perf_counter()
+    times = []
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        for sample_times in executor.map(lambda sample: run_sample(sample, options, env), samples):
+            times.extend(sample_times)
+            profile_hooks.count("samples")
+    wall_seconds = time.perf_counter() - start
+
+    outfile = options.outfile or path.join(options.WORKDIR, "benchmark.tsv")
+    with open(outfile + ".partial", "w") as out:
+        out.write("sample\tstage\tseconds\tstatus\n")
+        for record in times:
+            out.write("{}\t{}\t{:.3f}\t{}\n".format(*record))
+    replace(outfile + ".partial", outfile)
+
+    print(format_report(times, wall_seconds, len(samples)))
+    logging.info("Per stage times written to %s, run ledger in %s", outfile, env[LEDGER_ENVIRONMENT_VARIABLE])
+    return 1 if any(record.status != "ok" for record in times) else 0
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    exit(profile_hooks.run_main(main, options))
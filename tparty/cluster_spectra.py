@@ -0,0 +1,474 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace, remove, makedirs
+from collections import namedtuple
+from copy import deepcopy
+import argparse
+import logging
+import sqlite3
+import time
+import numpy as np
+from lxml import etree
+
+from mzxml_spectra import iter_scans, condition_peaks, read_peak_conditioning, write_mgf_spectrum
+from prefilter_mzxml import read_xtandem_parameters, read_spectrum_filter, rejection_reason, PROTON_MASS
+from run_ledger import record_stage, sample_name
+from slim_bioml import format_attributes
+import profile_hooks
+
+
+# A searchable MS2 scan of one of the clustered files.
+Clustered_Scan = namedtuple("Clustered_Scan",
+        ["source",
+         "scan",
+         "intensity_sum"])
+
+# X!Tandem's id offset for the 3+ copy of a spectrum without a charge.
+ALTERNATE_CHARGE_ID = 100000000
+
+# Clusters larger than this within one precursor window are formed in
+# consecutive blocks, bounding the similarity matrix to BLOCK_SIZE**2.
+BLOCK_SIZE = 2000
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Cluster redundant MS2 scans (within and across mzXML files) into consensus spectra for X!Tandem, and expand the search results back to the original scans. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest="command")
+
+    cluster_parser = subparsers.add_parser("cluster",
+        help="Cluster scans of one or more mzXML files into a consensus MGF.")
+    cluster_parser.add_argument("FILES", metavar="MZXML", nargs="+",
+        help="mzXML files (can be gzipped), e.g. technical replicates.")
+    cluster_parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        required=True,
+        help="Output consensus MGF filename.")
+    cluster_parser.add_argument("-m", "--map", dest="map", metavar="DBFILE",
+        default="",
+        help="Cluster membership map (SQLite3) [OUTFILE.clusters.sqlite3].")
+    cluster_parser.add_argument("-p", "--default-parameters", metavar="FILE", dest="default_parameters",
+        required=True,
+        help="X!Tandem default_parameters.xml with parent mass tolerance, spectrum thresholds and peak reduction settings.")
+    cluster_parser.add_argument("-s", "--min-similarity", dest="min_similarity", metavar="S",
+        type=float,
+        default=0.8,
+        help="Minimum cosine similarity of binned, square root scaled fragment peaks [%(default)s].")
+    cluster_parser.add_argument("-b", "--bin-width", dest="bin_width", metavar="DA",
+        type=float,
+        default=1.0005,
+        help="Fragment m/z bin width in Dalton [%(default)s].")
+
+    expand_parser = subparsers.add_parser("expand",
+        help="Expand X!Tandem BIOML results of a consensus MGF to the original scans.")
+    expand_parser.add_argument("FILE",
+        help="X!Tandem BIOML output of the consensus MGF (can be slimmed).")
+    expand_parser.add_argument("-m", "--map", dest="map", metavar="DBFILE",
+        required=True,
+        help="Cluster membership map written by 'cluster'.")
+    expand_parser.add_argument("-d", "--outdir", dest="outdir", metavar="DIR",
+        default=".",
+        help="Directory for one BIOML file per original mzXML, named output_SAMPLE.xml [%(default)s].")
+    expand_parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        default="",
+        help="Output filename when the map has a single source file (may be FILE).")
+
+    for subparser in (cluster_parser, expand_parser):
+        profile_hooks.add_profile_arguments(subparser)
+        subparser.add_argument("--loglevel",
+            choices=["INFO", "DEBUG"],
+            default="INFO",
+            help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+    if not options.command:
+        parser.print_help()
+        exit(1)
+
+    logging.basicConfig(level=options.loglevel)
+
+    if options.command == "cluster" and not options.map:
+        options.map = cluster_map(options.outfile)
+    return options
+
+
+def read_parent_tolerance(parameter_file):
+    """
+    Read X!Tandem's parent mass tolerance as a tuple (error, units).
+
+    The larger of the plus and minus errors is used; units are 'ppm' or
+    'Daltons'.
+    """
+
+    parameters = read_xtandem_parameters(parameter_file)
+    error = max(float(parameters.get("spectrum, parent monoisotopic mass error plus", 10.0)),
+                float(parameters.get("spectrum, parent monoisotopic mass error minus", 10.0)))
+    return error, parameters.get("spectrum, parent monoisotopic mass error units", "ppm")
+
+
+def mz_tolerance(mz, charge, parent_tolerance):
+    """
+    Precursor m/z tolerance at mz (array) for parent_tolerance (error, units).
+    """
+
+    error, units = parent_tolerance
+    if units.lower().startswith("ppm"):
+        return mz * error * 1e-6
+    return error / np.maximum(charge, 1)
+
+
+def read_searchable_scans(filenames, spectrum_filter, peak_conditioning):
+    """
+    Read the searchable MS2 scans of filenames, with peaks reduced as X!Tandem would.
+
+    Returns a tuple (list of Scan, list of Clustered_Scan).
+    """
+
+    scans = []
+    members = []
+    for filename in filenames:
+        source = sample_name(filename)
+        for scan in profile_hooks.timed_iter(iter_scans(filename, ms_levels=(2,)), "parse"):
+            if scan.precursor_mz is None:
+                continue
+            mz, intensity = condition_peaks(scan.mz, scan.intensity, peak_conditioning)
+            if rejection_reason(scan.ms_level, len(mz), scan.precursor_mz, scan.precursor_charge, spectrum_filter):
+                continue
+            scans.append(scan._replace(mz=mz, intensity=intensity))
+            members.append(Clustered_Scan(source, scan.num, float(intensity.sum())))
+    return scans, members
+
+
+def binned_vectors(scans, bin_width):
+    """
+    Unit length vectors of square root intensities in m/z bins, one row per scan.
+
+    Only bins occupied by any of the scans are used as columns.
+    """
+
+    rows = np.repeat(np.arange(len(scans)), [len(scan.mz) for scan in scans])
+    bins = np.concatenate([np.floor(scan.mz / bin_width).astype(np.int64) for scan in scans])
+    intensities = np.concatenate([np.sqrt(scan.intensity) for scan in scans]).astype(np.float32)
+    columns_used, columns = np.unique(bins, return_inverse=True)
+    vectors = np.zeros((len(scans), len(columns_used)), dtype=np.float32)
+    np.add.at(vectors, (rows, columns), intensities)
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, np.newaxis]
+
+
+def cluster_block(scans, members, parent_tolerance, min_similarity, bin_width):
+    """
+    Greedily cluster scans of one precursor window.
+
+    The most intense unassigned scan seeds a cluster, which takes all
+    unassigned scans within the precursor tolerance of the seed and with
+    at least min_similarity to it. Returns a list of clusters (lists of
+    indexes into scans, seed first).
+    """
+
+    if len(scans) == 1:
+        return [[0]]
+    similarities = binned_vectors(scans, bin_width)
+    similarities = similarities.dot(similarities.T)
+    precursors = np.array([scan.precursor_mz for scan in scans])
+    charges = np.array([scan.precursor_charge or 0 for scan in scans])
+    tolerances = mz_tolerance(precursors, charges, parent_tolerance)
+    unassigned = np.ones(len(scans), dtype=bool)
+    clusters = []
+    for seed in np.argsort([-member.intensity_sum for member in members], kind="mergesort"):
+        if not unassigned[seed]:
+            continue
+        joining = (unassigned
+                   & (similarities[seed] >= min_similarity)
+                   & (np.abs(precursors - precursors[seed]) <= tolerances[seed]))
+        joining[seed] = False
+        cluster = [int(seed)] + np.nonzero(joining)[0].tolist()
+        unassigned[cluster] = False
+        clusters.append(cluster)
+    return clusters
+
+
+def cluster_scans(scans, members, parent_tolerance, min_similarity=0.8, bin_width=1.0005):
+    """
+    Cluster scans on precursor charge, precursor m/z and fragment similarity.
+
+    Scans are sorted on m/z per charge state and split into windows
+    wherever consecutive precursors are further apart than the
+    tolerance; each window is clustered on its own. Returns a list of
+    clusters (lists of indexes into scans, seed first).
+    """
+
+    clusters = []
+    charges = sorted(set(scan.precursor_charge or 0 for scan in scans))
+    for charge in charges:
+        indexes = [i for i, scan in enumerate(scans) if (scan.precursor_charge or 0) == charge]
+        indexes.sort(key=lambda i: scans[i].precursor_mz)
+        precursors = np.array([scans[i].precursor_mz for i in indexes])
+        gaps = np.diff(precursors) > mz_tolerance(precursors[:-1], charge, parent_tolerance)
+        window_starts = [0] + (np.nonzero(gaps)[0] + 1).tolist() + [len(indexes)]
+        for window_start, window_end in zip(window_starts[:-1], window_starts[1:]):
+            for block_start in range(window_start, window_end, BLOCK_SIZE):
+                block = indexes[block_start:min(block_start + BLOCK_SIZE, window_end)]
+                for cluster in cluster_block([scans[i] for i in block], [members[i] for i in block],
+                        parent_tolerance, min_similarity, bin_width):
+                    clusters.append([block[i] for i in cluster])
+    return clusters
+
+
+def consensus_spectrum(scans, bin_width, peak_conditioning, min_fraction=0.5):
+    """
+    Consensus peaks of a cluster of scans.
+
+    Peaks are pooled in m/z bins; bins with peaks in at least
+    min_fraction of the scans are kept, at the intensity weighted mean
+    m/z and the mean intensity. Returns (precursor m/z, mz, intensity).
+    """
+
+    precursor_mz = float(np.mean([scan.precursor_mz for scan in scans]))
+    if len(scans) == 1:
+        return precursor_mz, scans[0].mz, scans[0].intensity
+    mz = np.concatenate([scan.mz for scan in scans])
+    intensity = np.concatenate([scan.intensity for scan in scans])
+    owners = np.repeat(np.arange(len(scans)), [len(scan.mz) for scan in scans])
+    bins = np.floor(mz / bin_width).astype(np.int64)
+    used_bins, columns = np.unique(bins, return_inverse=True)
+    intensity_sums = np.bincount(columns, weights=intensity, minlength=len(used_bins))
+    weighted_mz = np.bincount(columns, weights=mz * intensity, minlength=len(used_bins))
+    scans_per_bin = np.bincount(np.unique(columns * len(scans) + owners) // len(scans), minlength=len(used_bins))
+    keep = (scans_per_bin >= min_fraction * len(scans)) & (intensity_sums > 0)
+    consensus_mz = weighted_mz[keep] / intensity_sums[keep]
+    consensus_intensity = intensity_sums[keep] / len(scans)
+    consensus_mz, consensus_intensity = condition_peaks(consensus_mz, consensus_intensity, peak_conditioning)
+    return precursor_mz, consensus_mz, consensus_intensity
+
+
+def cluster_map(mgf_filename):
+    """
+    Default cluster map filename for a consensus MGF.
+    """
+
+    return mgf_filename + ".clusters.sqlite3"
+
+
+def create_map_db(dbfile):
+    db = sqlite3.connect(dbfile)
+    db.executescript("""
+        DROP TABLE IF EXISTS members;
+        CREATE TABLE members(
+            cluster integer NOT NULL,
+            source text NOT NULL,
+            scan integer NOT NULL,
+            precursor_mz real NOT NULL,
+            charge integer);
+    """)
+    return db
+
+
+def write_clusters(filenames, outfilename, map_dbfile, default_parameters, min_similarity=0.8, bin_width=1.0005):
+    """
+    Cluster the scans of filenames and write one consensus spectrum per cluster.
+
+    Clusters are numbered from 1 in output order, the spectrum ids
+    X!Tandem gives MGF spectra; the TITLE 'scan=N' carries the same
+    number. Every member scan is written to map_dbfile with its source
+    file's sample name. Returns a tuple (scans, clusters).
+    """
+
+    start_time = time.time()
+    spectrum_filter = read_spectrum_filter(default_parameters)
+    peak_conditioning = read_peak_conditioning(default_parameters)
+    parent_tolerance = read_parent_tolerance(default_parameters)
+    scans, members = read_searchable_scans(filenames, spectrum_filter, peak_conditioning)
+    logging.info("Read %s searchable MS2 scans from %s in %.1f s",
+            len(scans), ", ".join(filenames), time.time() - start_time)
+
+    with profile_hooks.timer("cluster"):
+        clusters = cluster_scans(scans, members, parent_tolerance, min_similarity, bin_width)
+    clusters.sort(key=lambda cluster: (scans[cluster[0]].precursor_mz, members[cluster[0]].source, members[cluster[0]].scan))
+
+    tmp_outfilename = outfilename + ".partial"
+    tmp_map_dbfile = map_dbfile + ".partial"
+    if path.exists(tmp_map_dbfile):
+        remove(tmp_map_dbfile)
+    map_db = create_map_db(tmp_map_dbfile)
+    with open(tmp_outfilename, "w") as mgf, profile_hooks.timer("write"):
+        for number, cluster in enumerate(clusters, 1):
+            seed = scans[cluster[0]]
+            precursor_mz, mz, intensity = consensus_spectrum([scans[i] for i in cluster], bin_width, peak_conditioning)
+            write_mgf_spectrum(mgf, seed._replace(num=number, precursor_mz=precursor_mz), mz, intensity)
+            map_db.executemany("INSERT INTO members VALUES (?,?,?,?,?)",
+                    [(number, members[i].source, members[i].scan, scans[i].precursor_mz, scans[i].precursor_charge)
+                     for i in cluster])
+    with map_db:
+        map_db.execute("CREATE INDEX members_cluster ON members(cluster)")
+    map_db.close()
+    replace(tmp_map_dbfile, map_dbfile)
+    replace(tmp_outfilename, outfilename)
+    profile_hooks.count("scans_read", len(scans))
+    profile_hooks.count("clusters_written", len(clusters))
+
+    logging.info("Clustered %s scans into %s consensus spectra (%.0f%% fewer) in %.1f s, wrote %s",
+            len(scans), len(clusters), 100.0 * (1 - len(clusters) / len(scans)) if scans else 0.0,
+            time.time() - start_time, outfilename)
+    return len(scans), len(clusters)
+
+
+def read_members(map_dbfile):
+    """
+    Cluster members as a dict {cluster: [(source, scan, precursor m/z, charge), ...]}.
+    """
+
+    if not path.isfile(map_dbfile):
+        raise FileNotFoundError("Cluster map {} not found".format(map_dbfile))
+    db = sqlite3.connect(map_dbfile)
+    members = {}
+    for cluster, source, scan, precursor_mz, charge in db.execute("SELECT * FROM members ORDER BY cluster, scan"):
+        members.setdefault(cluster, []).append((source, scan, precursor_mz, charge))
+    db.close()
+    return members
+
+
+def expand_group(group, scan, precursor_mz, charge, group_id=None):
+    """
+    Copy of a BIOML model group as a result for the original scan.
+
+    The copy has id group_id (default: the scan number) and the scan
+    number in its scan attribute.
+    """
+
+    group_id = group_id or scan
+    expanded = deepcopy(group)
+    expanded.attrib["id"] = str(group_id)
+    expanded.attrib["scan"] = str(scan)
+    charge = charge or int(group.attrib.get("z", 0))
+    if precursor_mz and charge:
+        expanded.attrib["mh"] = "{:.6f}".format(precursor_mz * charge - (charge - 1) * PROTON_MASS)
+    for domain in expanded.iter("domain"):
+        domain.attrib["id"] = "{}.{}".format(group_id, domain.attrib["id"].split(".", 1)[-1])
+    return expanded
+
+
+def expand_bioml(xmlfile, map_dbfile, outfilenames):
+    """
+    Write the BIOML results of a consensus MGF search once per original scan.
+
+    Each model group is copied for every member scan of its cluster into
+    the output file of the member's source, with group and domain ids
+    set to the scan number and mh to the scan's own precursor, so the
+    existing converters see ordinary per-sample results. Parameter
+    groups are copied to every output. outfilenames is a dict {source:
+    output filename}; outputs are written atomically and may replace
+    xmlfile. Returns the number of groups written.
+
+    X!Tandem searches spectra without a charge as 2+ and 3+, and adds
+    ALTERNATE_CHARGE_ID to the id of the 3+ copy; such copies keep the
+    offset on the expanded ids.
+    """
+
+    members = read_members(map_dbfile)
+    outputs = {}
+    for source, outfilename in outfilenames.items():
+        outputs[source] = open(outfilename + ".partial", "w")
+        outputs[source].write('<?xml version="1.0"?>\n')
+    written = 0
+    for event, element in etree.iterparse(xmlfile, events=("start", "end")):
+        if event == "start":
+            if element.tag == "bioml":
+                for output in outputs.values():
+                    output.write("<bioml{}>\n".format(format_attributes(element)))
+            continue
+        if element.tag != "group" or element.getparent() is None or element.getparent().tag != "bioml":
+            continue
+        if element.attrib.get("type") == "model":
+            offset, cluster = divmod(int(element.attrib["id"]), ALTERNATE_CHARGE_ID)
+            for source, scan, precursor_mz, charge in members.get(cluster, []):
+                if source in outputs:
+                    expanded = expand_group(element, scan, precursor_mz, charge,
+                            group_id=scan + offset * ALTERNATE_CHARGE_ID)
+                    outputs[source].write(etree.tostring(expanded, encoding="unicode", with_tail=False))
+                    outputs[source].write("\n")
+                    written += 1
+        else:
+            for output in outputs.values():
+                output.write(etree.tostring(element, encoding="unicode", with_tail=False))
+                output.write("\n")
+        element.clear()
+    for source, output in outputs.items():
+        output.write("</bioml>\n")
+        output.close()
+        replace(outfilenames[source] + ".partial", outfilenames[source])
+    profile_hooks.count("groups_written", written)
+    return written
+
+
+def map_sources(map_dbfile):
+    """
+    Source sample names in cluster map.
+    """
+
+    db = sqlite3.connect(map_dbfile)
+    sources = [source for source, in db.execute("SELECT DISTINCT source FROM members ORDER BY source")]
+    db.close()
+    return sources
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    if options.command == "cluster":
+        with record_stage(sample_name(options.outfile), "cluster_spectra", inputs=options.FILES, outputs=[options.outfile, options.map]) as record:
+            scans, clusters = write_clusters(options.FILES, options.outfile, options.map,
+                    options.default_parameters, options.min_similarity, options.bin_width)
+            record.records = scans
+        return
+
+    sources = map_sources(options.map)
+    if options.outfile:
+        if len(sources) > 1:
+            logging.error("Cluster map %s has %s source files, use --outdir", options.map, len(sources))
+            exit(1)
+        outfilenames = {source: options.outfile for source in sources}
+    else:
+        makedirs(options.outdir, exist_ok=True)
+        outfilenames = {source: path.join(options.outdir, "output_" + source + ".xml") for source in sources}
+    start_time = time.time()
+    with record_stage(sample_name(options.FILE), "expand_clusters", inputs=[options.FILE], outputs=list(outfilenames.values())) as record:
+        record.records = expand_bioml(options.FILE, options.map, outfilenames)
+    logging.info("Expanded %s to %s groups in %s files in %.1f s",
+            options.FILE, record.records, len(outfilenames), time.time() - start_time)
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
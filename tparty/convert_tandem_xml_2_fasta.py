@@ -22,8 +22,13 @@
 from sys import argv, exit
 import argparse
 import logging
-from os import path, makedirs
-from lxml import etree
+from os import path, makedirs, replace, remove
+from multiprocessing import Pool
+from functools import partial
+import resource
+import time
+
+import profile_hooks
 
 
 def parse_commandline():
@@ -51,6 +56,21 @@ def parse_commandline():
         type=float,
         default=1e15,
         help="Maximum e-value [%(default)s].")
+    parser.add_argument("-j", "--jobs", dest="jobs", metavar="N",
+        type=int,
+        default=1,
+        help="Number of files to convert concurrently [%(default)s].")
+    parser.add_argument("--max-memory", dest="max_memory", metavar="MB",
+        type=int,
+        default=0,
+        help="Maximum address space per worker process in MiB, 0 means unlimited [%(default)s].")
+    parser.add_argument("--skip-existing", dest="skip_existing", action="store_true",
+        default=False,
+        help="Skip files whose output is newer than the input, e.g. to restart an interrupted batch. The cutoffs of the existing output are not checked [%(default)s].")
+    parser.add_argument("-x", "--expand", dest="expand", metavar="MAP",
+        default="",
+        help="Header map from dedup_fasta.py; also counts the proteins with identical sequence to the source proteins found in a deduplicated database in the log.")
+    profile_hooks.add_profile_arguments(parser)
     parser.add_argument("--loglevel", 
         choices=["INFO", "DEBUG"],
         default="INFO",
@@ -74,9 +94,15 @@ def generate_seqences_from_bioml_xml(xmlfile):
     Only returns the first peptide for each spectrum. 
     """
 
+    from lxml import etree
+
+    groups = 0
+    domains = 0
     for _, element in etree.iterparse(xmlfile):
         if element.tag == "group":
+            groups += 1
             for child in element.iterdescendants("domain"):
+                domains += 1
                 yield (element.attrib["label"], 
                        child.attrib["id"], 
                        child.attrib["expect"], 
@@ -87,41 +113,157 @@ def generate_seqences_from_bioml_xml(xmlfile):
                 break
             element.clear()
             continue
+    profile_hooks.count("groups_seen", groups)
+    profile_hooks.count("domains_yielded", domains)
 
 
-def convert_tandem_bioml_to_fasta(xmlfile, outdir, outfile, min_hyperscore, max_evalue):
+def output_filename(xmlfile, outdir, outfile):
     """
-    Converts X!tandem output BIOML XML to FASTA, writes to file in outdir.
+    Determine output FASTA filename for xmlfile.
     """
 
     if outfile:
-        outfilename = outfile
-    else:
-        outfilename = path.join(outdir, path.splitext(path.basename(xmlfile))[0]+".fasta")
-        if not path.exists(outdir):
-            makedirs(outdir)
+        return outfile
+    return path.join(outdir, path.splitext(path.basename(xmlfile))[0]+".fasta")
+
+
+def is_up_to_date(xmlfile, outfilename):
+    """
+    True if outfilename exists and is newer than xmlfile.
+    """
+
+    return path.exists(outfilename) and path.getmtime(outfilename) >= path.getmtime(xmlfile)
+
+
+def convert_tandem_bioml_to_fasta(xmlfile, outdir, outfile, min_hyperscore, max_evalue, header_map=None):
+    """
+    Converts X!tandem output BIOML XML to FASTA, writes to file in outdir.
+
+    The FASTA is written to a temporary name and renamed when complete,
+    so an interrupted conversion never leaves a truncated output behind;
+    the temporary file is removed if the conversion fails.
+    With header_map, the logged number of source proteins also counts all
+    proteins with identical sequence; the written peptides are the same.
+    Returns the number of written peptides.
+    """
+
+    outfilename = output_filename(xmlfile, outdir, outfile)
+    if not outfile and not path.exists(outdir):
+        makedirs(outdir, exist_ok=True)
 
     logging.debug("Writing FASTA to '%s'", outfilename)
     sourceheaders = set()
     write_counter = 0
-    with open(outfilename, 'w') as fastafile:
-        for sourceheader, identity, expect, hyperscore, charge, mass, sequence in generate_seqences_from_bioml_xml(xmlfile):
-            if float(expect) <= max_evalue and float(hyperscore) >= min_hyperscore:
-                sourceheaders.add(sourceheader)
-                logging.debug("Writing seq %s with length %s, expect %s, hyperscore %s, charge %s, mass %s.", identity, sequence, expect, hyperscore, charge, mass)
-                header = ">{}_{} expect={} hyperscore={} z={} mh={}".format(identity, len(sequence), expect, hyperscore, charge, mass)
-                fastafile.write("{}\n{}\n".format(header, sequence))
-                write_counter += 1
-    logging.info("Wrote %s peptide fragments from %s unique protein sequences to %s", write_counter, len(sourceheaders), outfilename)
+    tmp_outfilename = outfilename + ".partial"
+    start_time = time.perf_counter()
+    parse_time = profile_hooks.TIMERS["parse"]
+    read_counter = 0
+    sequences = profile_hooks.timed_iter(generate_seqences_from_bioml_xml(xmlfile), "parse")
+    try:
+        with open(tmp_outfilename, 'w') as fastafile:
+            for sourceheader, identity, expect, hyperscore, charge, mass, sequence in sequences:
+                read_counter += 1
+                if float(expect) <= max_evalue and float(hyperscore) >= min_hyperscore:
+                    sourceheaders.add(sourceheader)
+                    logging.debug("Writing seq %s with length %s, expect %s, hyperscore %s, charge %s, mass %s.", identity, sequence, expect, hyperscore, charge, mass)
+                    header = ">{}_{} expect={} hyperscore={} z={} mh={}".format(identity, len(sequence), expect, hyperscore, charge, mass)
+                    fastafile.write("{}\n{}\n".format(header, sequence))
+                    write_counter += 1
+        replace(tmp_outfilename, outfilename)
+    finally:
+        if path.exists(tmp_outfilename):
+            remove(tmp_outfilename)
+    proteins = len(header_map.expand(sourceheaders)) if header_map else len(sourceheaders)
+    parse_time = profile_hooks.TIMERS["parse"] - parse_time
+    profile_hooks.TIMERS["filter_and_write"] += time.perf_counter() - start_time - parse_time
+    profile_hooks.count("filter_rejects", read_counter - write_counter)
+    profile_hooks.count("peptides_written", write_counter)
+    logging.info("Wrote %s peptide fragments from %s unique protein sequences (%s proteins) to %s",
+            write_counter, len(sourceheaders), proteins, outfilename)
+    return write_counter
+
+
+def limit_worker_memory(max_memory):
+    """
+    Pool initializer that caps the address space of a worker process (MiB).
+    """
+
+    if max_memory:
+        limit = max_memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def convert_file(xmlfile, outdir, outfile, min_hyperscore, max_evalue, header_map_file=""):
+    """
+    Worker wrapper around convert_tandem_bioml_to_fasta.
+
+    Returns (xmlfile, input size in bytes, number of written peptides),
+    with None peptides if the conversion failed and size 0 if xmlfile
+    does not exist.
+    """
+
+    from lxml import etree
+    from run_ledger import record_stage, sample_name
+
+    header_map = None
+    if header_map_file:
+        from dedup_fasta import Header_Map
+        header_map = Header_Map(header_map_file)
+
+    with record_stage(sample_name(xmlfile), "xml2fasta", 
+            inputs=[xmlfile], outputs=[output_filename(xmlfile, outdir, outfile)]) as record:
+        try:
+            peptides = convert_tandem_bioml_to_fasta(xmlfile, outdir, outfile, min_hyperscore, max_evalue, header_map)
+            record.records = peptides
+        except (MemoryError, OSError, etree.XMLSyntaxError) as e:
+            logging.error("Could not convert %s: %s", xmlfile, e)
+            record.status = "failed"
+            peptides = None
+    size = path.getsize(xmlfile) if path.exists(xmlfile) else 0
+    return xmlfile, size, peptides
 
 
 def main(options):
     """
     Main.
     """
+
+    xmlfiles = []
     for xmlfile in options.FILE:
-        convert_tandem_bioml_to_fasta(xmlfile, options.outdir, options.outfile,
-                options.min_hyperscore, options.max_evalue)
+        if options.skip_existing and is_up_to_date(xmlfile, output_filename(xmlfile, options.outdir, options.outfile)):
+            logging.info("Output for %s is up to date, skipping", xmlfile)
+        else:
+            xmlfiles.append(xmlfile)
+
+    converter = partial(convert_file, 
+            outdir=options.outdir, 
+            outfile=options.outfile,
+            min_hyperscore=options.min_hyperscore, 
+            max_evalue=options.max_evalue,
+            header_map_file=options.expand)
+
+    start_time = time.time()
+    if xmlfiles and (options.max_memory or (options.jobs > 1 and len(xmlfiles) > 1)):
+        # Recycle workers after each file so that lxml/allocator memory 
+        # from one large BIOML file is returned before the next. The
+        # memory limit is only set in the workers, so with --max-memory
+        # even a single job converts in a worker process.
+        with Pool(min(options.jobs, len(xmlfiles)), limit_worker_memory, (options.max_memory,), maxtasksperchild=1) as pool:
+            results = list(pool.imap_unordered(converter, xmlfiles))
+    else:
+        results = [converter(xmlfile) for xmlfile in xmlfiles]
+    elapsed = time.time() - start_time
+
+    failed = [xmlfile for xmlfile, _, peptides in results if peptides is None]
+    total_bytes = sum(size for _, size, _ in results)
+    total_peptides = sum(peptides for _, _, peptides in results if peptides)
+    if results:
+        logging.info("Converted %s files (%.1f MiB, %s peptides) in %.1f s: %.2f files/s, %.1f MiB/s", 
+                len(results) - len(failed), total_bytes / 2**20, total_peptides, elapsed,
+                len(results) / max(elapsed, 1e-9), total_bytes / 2**20 / max(elapsed, 1e-9))
+    if failed:
+        logging.error("Failed to convert %s files: %s", len(failed), ", ".join(failed))
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -129,4 +271,4 @@ if __name__ == "__main__":
     if options.outfile and len(options.FILE) > 1:
         logging.error("Cannot specify output filename with more than one file on command line")
         exit()
-    main(options)
+    profile_hooks.run_main(main, options)
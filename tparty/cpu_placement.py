@@ -0,0 +1,276 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, environ, getpid, getuid, kill, sched_getaffinity
+from tempfile import gettempdir
+from contextlib import contextmanager
+from glob import glob
+import argparse
+import logging
+import fcntl
+
+import profile_hooks
+
+
+# Lease file shared by all concurrent tparty searches on a node. The
+# default is per user, as another user's file in /tmp is not writable;
+# set $TPARTY_CPU_LEASES to a shared path (e.g. in the workdir) to
+# coordinate searches of several users.
+LEASE_ENVIRONMENT_VARIABLE = "TPARTY_CPU_LEASES"
+DEFAULT_LEASE_FILE = path.join(gettempdir(), "tparty_cpu_leases.{}".format(getuid()))
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Show NUMA nodes and the CPU leases held by running tparty searches. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--lease-file", metavar="FILE", dest="lease_file",
+        default=environ.get(LEASE_ENVIRONMENT_VARIABLE, DEFAULT_LEASE_FILE),
+        help="CPU lease file [${} or %(default)s].".format(LEASE_ENVIRONMENT_VARIABLE))
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+    return options
+
+
+def parse_cpulist(cpulist):
+    """
+    Parse a Linux CPU list such as '0-9,20-29' into a set of CPU numbers.
+    """
+
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """
+    Format a set of CPU numbers as a Linux CPU list, e.g. '0-9,20-29'.
+    """
+
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else "{}-{}".format(first, last)
+                    for first, last in ranges)
+
+
+def numa_nodes():
+    """
+    CPUs of each NUMA node, restricted to the CPUs this process may use.
+
+    Returns a list of sets. Without NUMA information in sysfs, all usable
+    CPUs are treated as one node.
+    """
+
+    usable = sched_getaffinity(0)
+    nodes = []
+    for cpulist_file in sorted(glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(cpulist_file) as f:
+            cpus = parse_cpulist(f.read()) & usable
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [set(usable)]
+
+
+def process_alive(pid):
+    """
+    Check whether a process with pid exists.
+    """
+
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_leases(lease_file):
+    """
+    Read leases held by live processes as a dict {pid: set of CPUs}.
+
+    Leases of processes that have died are dropped.
+    """
+
+    leases = {}
+    lease_file.seek(0)
+    for line in lease_file:
+        try:
+            pid, cpulist = line.split()
+            pid = int(pid)
+        except ValueError:
+            continue
+        if process_alive(pid):
+            leases[pid] = parse_cpulist(cpulist)
+    return leases
+
+
+def write_leases(lease_file, leases):
+    lease_file.seek(0)
+    lease_file.truncate()
+    for pid, cpus in sorted(leases.items()):
+        lease_file.write("{} {}\n".format(pid, format_cpulist(cpus)))
+    lease_file.flush()
+
+
+def choose_cpus(count, nodes, leased):
+    """
+    Pick count free CPUs, preferably all on one NUMA node.
+
+    The node with the fewest free CPUs that still fits the request is
+    used, to keep larger free blocks for later searches. Otherwise CPUs
+    are taken from the nodes with the most free CPUs first. Returns an
+    empty set if not enough CPUs are free.
+    """
+
+    free_per_node = [sorted(node - leased) for node in nodes]
+    fitting = [free for free in free_per_node if len(free) >= count]
+    if fitting:
+        return set(min(fitting, key=len)[:count])
+    if sum(len(free) for free in free_per_node) < count:
+        return set()
+    cpus = set()
+    for free in sorted(free_per_node, key=len, reverse=True):
+        cpus.update(free[:count - len(cpus)])
+        if len(cpus) == count:
+            break
+    return cpus
+
+
+def acquire_cpus(count, lease_filename):
+    """
+    Lease count CPUs for this process in lease_filename.
+
+    Returns the set of leased CPUs, or an empty set if not enough are free.
+    """
+
+    with open(lease_filename, "a+") as lease_file:
+        fcntl.flock(lease_file, fcntl.LOCK_EX)
+        try:
+            leases = read_leases(lease_file)
+            leased = set().union(*leases.values()) if leases else set()
+            cpus = choose_cpus(count, numa_nodes(), leased)
+            if cpus:
+                leases[getpid()] = leases.get(getpid(), set()) | cpus
+            write_leases(lease_file, leases)
+        finally:
+            fcntl.flock(lease_file, fcntl.LOCK_UN)
+    return cpus
+
+
+def release_cpus(cpus, lease_filename):
+    """
+    Return leased cpus of this process.
+    """
+
+    with open(lease_filename, "a+") as lease_file:
+        fcntl.flock(lease_file, fcntl.LOCK_EX)
+        try:
+            leases = read_leases(lease_file)
+            remaining = leases.pop(getpid(), set()) - cpus
+            if remaining:
+                leases[getpid()] = remaining
+            write_leases(lease_file, leases)
+        finally:
+            fcntl.flock(lease_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def pinned_cpus(count, lease_filename=""):
+    """
+    Context manager that leases count CPUs for a search.
+
+    Yields the set of CPUs to pin the search to, or None if not enough
+    CPUs are free, in which case the search should run unpinned. A count
+    of 0 disables pinning.
+    """
+
+    if not count:
+        yield None
+        return
+    lease_filename = lease_filename or environ.get(LEASE_ENVIRONMENT_VARIABLE, DEFAULT_LEASE_FILE)
+    cpus = acquire_cpus(int(count), lease_filename)
+    if not cpus:
+        logging.warning("Not enough free CPUs for %s threads in %s, running unpinned", count, lease_filename)
+        yield None
+        return
+    logging.info("Pinned to CPUs %s", format_cpulist(cpus))
+    try:
+        yield cpus
+    finally:
+        release_cpus(cpus, lease_filename)
+
+
+def pinned_command(command, cpus):
+    """
+    Command (list) prefixed with taskset, restricting it to cpus.
+
+    The affinity is set before the program starts, so all its threads
+    and child processes inherit it. (A Popen preexec_fn is not safe
+    while other threads, e.g. the staging thread, are running.)
+    With all threads on one node's CPUs, Linux's first-touch policy also
+    places the search's memory on that node.
+    """
+
+    if not cpus:
+        return list(command)
+    return ["taskset", "--cpu-list", format_cpulist(cpus)] + list(command)
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    for node_number, cpus in enumerate(numa_nodes()):
+        print("node{}".format(node_number), format_cpulist(cpus), sep="\t")
+    if path.isfile(options.lease_file):
+        with open(options.lease_file) as lease_file:
+            for pid, cpus in sorted(read_leases(lease_file).items()):
+                print(pid, format_cpulist(cpus), sep="\t")
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
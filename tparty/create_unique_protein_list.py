@@ -21,10 +21,13 @@
 
 from sys import argv, exit, stdout
 from os import path, makedirs
+from os.path import getmtime
+from collections import Counter
 import argparse
 import logging
 import sqlite3
-from lxml import etree
+
+import profile_hooks
 
 
 def parse_commandline():
@@ -35,10 +38,16 @@ def parse_commandline():
     desc = """Extract unique protein information from X!Tandem XML output files. Fredrik Boulund 2016"""
 
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument("FILE", type=str,
+    parser.add_argument("FILE", type=str, nargs="+",
             help="Filename of output XML file(s) to summarize")
     parser.add_argument("-o", dest="outfile", metavar="OUTFILE", type=str,
             help="Output filename, default is <input_filename>_unique_proteins.txt.")
+    parser.add_argument("-m", "--matrix", dest="matrix", metavar="DBFILE", type=str,
+            default="",
+            help="Add PSM counts for all FILEs to protein x sample matrix in DBFILE (SQLite3). Samples already in DBFILE are skipped unless their XML file has changed.")
+    parser.add_argument("--write-matrix", dest="write_matrix", metavar="TSV", type=str,
+            default="",
+            help="Write protein x sample PSM count matrix from DBFILE to TSV (requires --matrix).")
     parser.add_argument("-H", "--min-hyperscore", dest="min_hyperscore", metavar="H",
         type=float,
         default=0.0,
@@ -47,6 +56,10 @@ def parse_commandline():
         type=float,
         default=1e15,
         help="Maximum e-value [%(default)s].")
+    parser.add_argument("-x", "--expand", dest="expand", metavar="MAP", type=str,
+        default="",
+        help="Header map from dedup_fasta.py; re-expands proteins found in a deduplicated database to all proteins with identical sequence. In the --matrix, their PSMs are counted once, on a row labelled with all their headers.")
+    profile_hooks.add_profile_arguments(parser)
     parser.add_argument("--loglevel", 
             choices=["INFO", "DEBUG"],
             default="INFO",
@@ -59,6 +72,16 @@ def parse_commandline():
     options = parser.parse_args()
 
     logging.basicConfig(level=options.loglevel)
+
+    if options.outfile and options.matrix:
+        logging.error("Cannot specify output filename with --matrix, use --write-matrix")
+        exit(1)
+    if options.outfile and len(options.FILE) > 1:
+        logging.error("Cannot specify output filename with more than one file on command line")
+        exit(1)
+    if options.write_matrix and not options.matrix:
+        logging.error("--write-matrix requires --matrix")
+        exit(1)
     return options
 
 
@@ -70,9 +93,15 @@ def extract_seqences_from_bioml_xml(xmlfile):
     This is a generator, meant to be used as an iterator.
     """
 
+    from lxml import etree
+
+    groups = 0
+    domains = 0
     for _, element in etree.iterparse(xmlfile):
         if element.tag == "group":
+            groups += 1
             for child in element.iterdescendants("domain"):
+                domains += 1
                 yield (element.attrib["label"], 
                        child.attrib["id"], 
                        float(child.attrib["expect"]),
@@ -87,43 +116,226 @@ def extract_seqences_from_bioml_xml(xmlfile):
             # more than 5 GiB of RAM! With this call, memory usage
             # should stay below 200 MiB in most cases.
             element.clear()  
+    profile_hooks.count("groups_seen", groups)
+    profile_hooks.count("domains_yielded", domains)
 
 
-def get_unique_proteins(xmlfile, max_evalue, min_hyperscore):
+def get_unique_proteins(xmlfile, max_evalue, min_hyperscore, header_map=None):
     """
     Returns unique proteins encountered in X!Tandem BIOML XML file.
 
     Unique proteins are determined by their FASTA headers.
     Several different peptides can come from the same protein header.
+    With header_map, proteins are re-expanded to all headers sharing
+    their sequence in the full database.
+    """
+
+    headers = set()
+    rejects = 0
+    sequences = profile_hooks.timed_iter(extract_seqences_from_bioml_xml(xmlfile), "parse")
+    for label, pep_id, expect, hyperscore, z, mh, seq in sequences:
+        if expect < max_evalue and hyperscore > min_hyperscore:
+            headers.add(label)
+        else:
+            rejects += 1
+    profile_hooks.count("filter_rejects", rejects)
+    if header_map:
+        headers = header_map.expand(headers)
+    return headers
+
+
+def count_protein_psms(xmlfile, max_evalue, min_hyperscore, header_map=None):
+    """
+    Counts PSMs per protein in X!Tandem BIOML XML file.
+
+    Uses the same filtering as get_unique_proteins, so the keys of the 
+    returned Counter are exactly the unique proteins of the file. With
+    header_map, each PSM is still counted once, under a label combining
+    all headers with identical sequence (see Header_Map.combined_label).
+    """
+
+    psm_counts = Counter(label 
+                   for label, pep_id, expect, hyperscore, z, mh, seq 
+                   in profile_hooks.timed_iter(extract_seqences_from_bioml_xml(xmlfile), "parse") 
+                   if expect < max_evalue and hyperscore > min_hyperscore)
+    if header_map:
+        combined_counts = Counter()
+        for label, count in psm_counts.items():
+            combined_counts[header_map.combined_label(label)] += count
+        psm_counts = combined_counts
+    return psm_counts
+
+
+def bioml_sample_name(xmlfile):
+    """
+    Sample name from BIOML filename, e.g. 2.xml/SAMPLE.bacterial.xml -> SAMPLE.bacterial.
+    """
+    basename = path.basename(xmlfile)
+    if basename.endswith((".gz", ".GZ")):
+        basename = basename[:-3]
+    return path.splitext(basename)[0]
+
+
+class Protein_Matrix_DB():
+    """
+    Sparse protein x sample matrix of PSM counts stored in SQLite3.
+
+    Protein labels and sample names are interned to integer ids, and only
+    non-zero counts are stored (one row per protein/sample pair). New 
+    samples can be added incrementally as they finish.
     """
 
-    headers = (label 
-               for label, pep_id, expect, hyperscore, z, mh, seq 
-               in extract_seqences_from_bioml_xml(xmlfile) 
-               if expect < max_evalue and hyperscore > min_hyperscore)
-    return set(headers)
+    def __init__(self, dbfile):
+        self.db = sqlite3.connect(dbfile)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS proteins(
+                id integer PRIMARY KEY,
+                label text UNIQUE NOT NULL);
+            CREATE TABLE IF NOT EXISTS samples(
+                id integer PRIMARY KEY,
+                name text UNIQUE NOT NULL,
+                source text,
+                mtime real);
+            CREATE TABLE IF NOT EXISTS psms(
+                protein_id integer NOT NULL REFERENCES proteins(id),
+                sample_id integer NOT NULL REFERENCES samples(id),
+                count integer NOT NULL,
+                PRIMARY KEY (sample_id, protein_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS psms_protein ON psms(protein_id);
+        """)
+        self.protein_ids = dict(self.db.execute("SELECT label, id FROM proteins"))
+
+    def is_current(self, name, xmlfile):
+        """True if sample is already in the matrix and its source file is unchanged."""
+        row = self.db.execute("SELECT mtime FROM samples WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == getmtime(xmlfile)
+
+    def intern_proteins(self, labels):
+        """Returns integer ids for protein labels, assigning new ids as needed."""
+        for label in labels:
+            if label not in self.protein_ids:
+                self.protein_ids[label] = self.db.execute("INSERT INTO proteins(label) VALUES (?)", (label,)).lastrowid
+        return [self.protein_ids[label] for label in labels]
+
+    def add_sample(self, name, xmlfile, psm_counts):
+        """Adds (or replaces) the column for one sample in a single transaction."""
+        try:
+            with self.db:
+                self.db.execute("DELETE FROM psms WHERE sample_id IN (SELECT id FROM samples WHERE name = ?)", (name,))
+                self.db.execute("INSERT OR REPLACE INTO samples(id, name, source, mtime) VALUES ((SELECT id FROM samples WHERE name = ?), ?, ?, ?)",
+                        (name, name, path.abspath(xmlfile), getmtime(xmlfile)))
+                sample_id = self.db.execute("SELECT id FROM samples WHERE name = ?", (name,)).fetchone()[0]
+                labels = list(psm_counts.keys())
+                protein_ids = self.intern_proteins(labels)
+                self.db.executemany("INSERT INTO psms VALUES (?,?,?)", 
+                        ((protein_id, sample_id, psm_counts[label]) for protein_id, label in zip(protein_ids, labels)))
+        except Exception:
+            # Proteins interned in the rolled back transaction are gone.
+            self.protein_ids = dict(self.db.execute("SELECT label, id FROM proteins"))
+            raise
+
+    def get_samples(self):
+        return [name for name, in self.db.execute("SELECT name FROM samples ORDER BY id")]
+
+    def iter_rows(self):
+        """
+        Yields (protein label, {sample name: count}) for all proteins with at least one PSM.
+        """
+        query = """SELECT proteins.label, samples.name, psms.count 
+            FROM psms 
+            JOIN proteins ON proteins.id = psms.protein_id
+            JOIN samples ON samples.id = psms.sample_id
+            ORDER BY psms.protein_id"""
+        current_label = None
+        counts = {}
+        for label, name, count in self.db.execute(query):
+            if label != current_label:
+                if current_label is not None:
+                    yield current_label, counts
+                current_label = label
+                counts = {}
+            counts[name] = count
+        if current_label is not None:
+            yield current_label, counts
+
+
+def update_protein_matrix(matrix_db, xmlfiles, max_evalue, min_hyperscore, header_map=None):
+    """
+    Adds PSM counts from xmlfiles to matrix_db, skipping samples that are up to date.
+    """
+
+    from run_ledger import record_stage
+
+    for xmlfile in xmlfiles:
+        name = bioml_sample_name(xmlfile)
+        if matrix_db.is_current(name, xmlfile):
+            logging.info("Sample %s already in protein matrix, skipping", name)
+            continue
+        with record_stage(name, "protein_matrix", inputs=[xmlfile]) as record:
+            psm_counts = count_protein_psms(xmlfile, max_evalue, min_hyperscore, header_map)
+            matrix_db.add_sample(name, xmlfile, psm_counts)
+            record.records = sum(psm_counts.values())
+        logging.info("Added %s PSMs from %s unique proteins for sample %s to protein matrix", 
+                sum(psm_counts.values()), len(psm_counts), name)
+
+
+def write_protein_matrix(matrix_db, outfilename):
+    """
+    Writes protein x sample PSM count matrix as tab separated text.
+    """
+
+    samples = matrix_db.get_samples()
+    logging.info("Writing protein matrix with %s samples to '%s'", len(samples), outfilename)
+    with open(outfilename, 'w') as outfile:
+        print("protein", *samples, sep="\t", file=outfile)
+        for label, counts in matrix_db.iter_rows():
+            print(label, *(counts.get(sample, 0) for sample in samples), sep="\t", file=outfile)
+
+
+def write_unique_proteins(xmlfile, outfilename, max_evalue, min_hyperscore, header_map=None):
+    """
+    Writes sorted list of unique proteins in xmlfile to outfilename.
+    """
+
+    from run_ledger import record_stage, sample_name
+
+    if not outfilename:
+        outfilename = path.split(xmlfile)[1]+"_unique_proteins.txt"
+
+    with record_stage(sample_name(xmlfile), "unique_proteins", inputs=[xmlfile], outputs=[outfilename]) as record:
+        unique_headers = get_unique_proteins(xmlfile, max_evalue, min_hyperscore, header_map)
+        record.records = len(unique_headers)
+
+        with profile_hooks.timer("write"), open(outfilename, 'w') as outfile:
+            logging.info("Writing unique proteins to '{}'.".format(outfilename))
+            print("Found {} unique proteins for {}".format(len(unique_headers), xmlfile),
+                    file=outfile)
+            for header in sorted(list(unique_headers), reverse=True):
+                print(header, file=outfile)
 
 
 def main(options):
     """
     Main.
     """
-    
-    unique_headers = get_unique_proteins(options.FILE, options.max_evalue, options.min_hyperscore) 
 
-    if options.outfile:
-        outfilename = options.outfile
-    else:
-        outfilename = path.split(options.FILE)[1]+"_unique_proteins.txt"
-    with open(outfilename, 'w') as outfile:
-        logging.info("Writing unique proteins to '{}'.".format(outfilename))
-        print("Found {} unique proteins for {}".format(len(unique_headers), options.FILE),
-                file=outfile)
-        for header in sorted(list(unique_headers), reverse=True):
-            print(header, file=outfile)
+    header_map = None
+    if options.expand:
+        from dedup_fasta import Header_Map
+        header_map = Header_Map(options.expand)
+
+    if options.matrix:
+        matrix_db = Protein_Matrix_DB(options.matrix)
+        update_protein_matrix(matrix_db, options.FILE, options.max_evalue, options.min_hyperscore, header_map)
+        if options.write_matrix:
+            write_protein_matrix(matrix_db, options.write_matrix)
+        return
+
+    for xmlfile in options.FILE:
+        write_unique_proteins(xmlfile, options.outfile, options.max_evalue, options.min_hyperscore, header_map)
 
 
 if __name__ == "__main__":
     options = parse_commandline()
-    main(options)
+    profile_hooks.run_main(main, options)
 
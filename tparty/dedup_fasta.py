@@ -0,0 +1,308 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace, remove
+from tempfile import mkdtemp
+from xml.etree import ElementTree
+import argparse
+import logging
+import hashlib
+import sqlite3
+import struct
+import shutil
+import time
+
+from run_ledger import record_stage, sample_name
+import profile_hooks
+
+
+# Bucket file records: sequence digest (MD5), record offset and length.
+BUCKET_RECORD = struct.Struct("<16sQQ")
+
+# Separates the headers of identical proteins in a combined label.
+LABEL_SEPARATOR = " || "
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Collapse identical protein sequences in a FASTA reference database, writing a sequence-to-headers map for re-expanding search hits. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("FASTA", nargs="*",
+        help="FASTA file(s) to deduplicate (together).")
+    parser.add_argument("-t", "--taxonomy", metavar="FILE", dest="taxonomy",
+        default="",
+        help="Deduplicate the database files of TAXON in X!Tandem taxonomy.xml.")
+    parser.add_argument("-d", "--taxon", metavar="TAXON", dest="taxon",
+        default="bacteria",
+        help="Taxon to deduplicate [%(default)s].")
+    parser.add_argument("-o", "--outfile", metavar="FASTA", dest="outfile",
+        required=True,
+        help="Deduplicated FASTA output filename.")
+    parser.add_argument("-m", "--map", metavar="DBFILE", dest="map",
+        default="",
+        help="Sequence-to-headers map (SQLite3) [OUTFILE.map.sqlite3].")
+    parser.add_argument("-b", "--buckets", metavar="N", dest="buckets",
+        type=int,
+        default=256,
+        help="Number of hash partitions; memory use is about 100 bytes times sequences / N [%(default)s].")
+    parser.add_argument("--tmpdir", metavar="DIR", dest="tmpdir",
+        default=None,
+        help="Directory for temporary partition files [system default].")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+
+    if not options.FASTA and not options.taxonomy:
+        logging.error("Specify FASTA files or --taxonomy")
+        exit(1)
+    if not options.map:
+        options.map = options.outfile + ".map.sqlite3"
+    return options
+
+
+def taxon_databases(taxonomy, taxon):
+    """
+    Database files of taxon in X!Tandem taxonomy.xml.
+    """
+
+    return [file_element.attrib["URL"]
+            for taxon_element in ElementTree.parse(taxonomy).getroot().iter("taxon")
+            if taxon_element.attrib.get("label") == taxon
+            for file_element in taxon_element.iter("file")]
+
+
+def iter_fasta_records(fasta):
+    """
+    Stream records from a FASTA file opened in binary mode.
+
+    Yields tuples (offset, length, header, sequence), where offset and
+    length give the raw record in the file, header is without '>' and
+    sequence has line breaks removed.
+    """
+
+    offset = 0
+    record_offset = None
+    header = b""
+    sequence = []
+    for line in fasta:
+        if line.startswith(b">"):
+            if record_offset is not None:
+                yield record_offset, offset - record_offset, header, b"".join(sequence)
+            record_offset = offset
+            header = line[1:].rstrip()
+            sequence = []
+        elif record_offset is not None:
+            sequence.append(line.strip())
+        offset += len(line)
+    if record_offset is not None:
+        yield record_offset, offset - record_offset, header, b"".join(sequence)
+
+
+def partition_sequences(fasta_files, tmpdir, buckets):
+    """
+    Hash every sequence and spread (digest, offset, length) over bucket files.
+
+    Identical sequences always end up in the same bucket, so each bucket
+    can be deduplicated on its own. Returns the number of records.
+    """
+
+    bucket_files = [open(path.join(tmpdir, "bucket_{}".format(bucket)), "wb") for bucket in range(buckets)]
+    records = 0
+    for file_number, fasta_file in enumerate(fasta_files):
+        with open(fasta_file, "rb") as fasta:
+            for offset, length, header, sequence in iter_fasta_records(fasta):
+                digest = hashlib.md5(sequence.upper()).digest()
+                bucket = int.from_bytes(digest[:4], "little") % buckets
+                # Offsets of later files are tagged with the file number.
+                bucket_files[bucket].write(BUCKET_RECORD.pack(digest, (file_number << 48) | offset, length))
+                records += 1
+    for bucket_file in bucket_files:
+        bucket_file.close()
+    return records
+
+
+def read_record(fasta_handles, offset, length):
+    """
+    Read a raw FASTA record given its tagged offset and length.
+    """
+
+    fasta = fasta_handles[offset >> 48]
+    fasta.seek(offset & (2**48 - 1))
+    return fasta.read(length)
+
+
+def read_header(fasta_handles, offset):
+    """
+    Read the header (without '>') of the FASTA record at tagged offset.
+    """
+
+    fasta = fasta_handles[offset >> 48]
+    fasta.seek(offset & (2**48 - 1))
+    return fasta.readline()[1:].rstrip().decode("utf-8", "replace")
+
+
+def create_map_db(dbfile):
+    db = sqlite3.connect(dbfile)
+    db.executescript("""
+        DROP TABLE IF EXISTS members;
+        CREATE TABLE members(
+            representative text NOT NULL,
+            accession text NOT NULL,
+            header text NOT NULL);
+    """)
+    return db
+
+
+def deduplicate_fasta(fasta_files, outfilename, map_dbfile, buckets=256, tmpdir=None):
+    """
+    Write each distinct sequence of fasta_files once to outfilename.
+
+    Sequences are compared by MD5 digest of the upper case sequence. Records
+    are partitioned on digest into bucket files, so only one bucket's
+    digests are held in memory at a time. The first record of each
+    sequence (in input order) is kept as representative; for sequences
+    with duplicates all headers are written to the members table of
+    map_dbfile, keyed by representative header.
+
+    Returns a tuple (records read, unique sequences written).
+    """
+
+    start_time = time.time()
+    workdir = mkdtemp(prefix="dedup_fasta_", dir=tmpdir)
+    tmp_outfilename = outfilename + ".partial"
+    tmp_map_dbfile = map_dbfile + ".partial"
+    if path.exists(tmp_map_dbfile):
+        remove(tmp_map_dbfile)
+    try:
+        records = partition_sequences(fasta_files, workdir, buckets)
+        logging.info("Hashed %s records from %s in %.1f s", records, ", ".join(fasta_files), time.time() - start_time)
+
+        map_db = create_map_db(tmp_map_dbfile)
+        fasta_handles = [open(fasta_file, "rb") for fasta_file in fasta_files]
+        unique = 0
+        duplicated = 0
+        with open(tmp_outfilename, "wb") as outfile:
+            for bucket in range(buckets):
+                bucket_filename = path.join(workdir, "bucket_{}".format(bucket))
+                groups = {}
+                with open(bucket_filename, "rb") as bucket_file:
+                    for digest, offset, length in BUCKET_RECORD.iter_unpack(bucket_file.read()):
+                        groups.setdefault(digest, []).append((offset, length))
+                remove(bucket_filename)
+                members = []
+                for copies in sorted(groups.values()):
+                    record = read_record(fasta_handles, *copies[0])
+                    outfile.write(record if record.endswith(b"\n") else record + b"\n")
+                    unique += 1
+                    if len(copies) > 1:
+                        duplicated += 1
+                        representative = record.split(b"\n", 1)[0][1:].rstrip().decode("utf-8", "replace")
+                        accession = representative.split()[0] if representative.strip() else representative
+                        for offset, length in copies:
+                            members.append((representative, accession, read_header(fasta_handles, offset)))
+                with map_db:
+                    map_db.executemany("INSERT INTO members VALUES (?,?,?)", members)
+        for fasta in fasta_handles:
+            fasta.close()
+        with map_db:
+            map_db.execute("CREATE INDEX members_representative ON members(representative)")
+            map_db.execute("CREATE INDEX members_accession ON members(accession)")
+        map_db.close()
+        replace(tmp_map_dbfile, map_dbfile)
+        replace(tmp_outfilename, outfilename)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    logging.info("Wrote %s unique of %s sequences to %s in %.1f s (%.0f%% fewer); %s sequences had duplicates, headers mapped in %s",
+            unique, records, outfilename, time.time() - start_time,
+            100.0 * (1 - unique / records) if records else 0.0, duplicated, map_dbfile)
+    return records, unique
+
+
+class Header_Map():
+    """
+    Re-expand hits on a deduplicated database to all identical proteins.
+
+    Labels without duplicates are returned as they are. Labels that do
+    not match a representative header exactly (X!Tandem may shorten long
+    descriptions) are matched on their first word, the accession.
+    """
+
+    def __init__(self, map_dbfile):
+        if not path.isfile(map_dbfile):
+            raise FileNotFoundError("Header map {} not found".format(map_dbfile))
+        self.db = sqlite3.connect(map_dbfile)
+        self.cache = {}
+
+    def members(self, label):
+        """All headers with the same sequence as label (including label)."""
+        if label not in self.cache:
+            headers = [header for header, in self.db.execute(
+                "SELECT header FROM members WHERE representative = ?", (label,))]
+            if not headers and label.strip():
+                headers = [header for header, in self.db.execute(
+                    "SELECT header FROM members WHERE accession = ?", (label.split()[0],))]
+            self.cache[label] = headers or [label]
+        return self.cache[label]
+
+    def expand(self, labels):
+        """Set of all headers represented by labels."""
+        expanded = set()
+        for label in labels:
+            expanded.update(self.members(label))
+        return expanded
+
+    def combined_label(self, label):
+        """One label naming all headers with the same sequence as label."""
+        return LABEL_SEPARATOR.join(sorted(self.members(label)))
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    fasta_files = list(options.FASTA)
+    if options.taxonomy:
+        fasta_files.extend(taxon_databases(options.taxonomy, options.taxon))
+    with record_stage(sample_name(options.outfile), "dedup_fasta", inputs=fasta_files, outputs=[options.outfile, options.map]) as record:
+        records, unique = deduplicate_fasta(fasta_files, options.outfile, options.map, options.buckets, options.tmpdir)
+        record.records = records
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import replace
+import argparse
+import logging
+import bisect
+import math
+import time
+import numpy as np
+
+from dedup_fasta import iter_fasta_records
+from run_ledger import record_stage, sample_name
+import profile_hooks
+
+
+# Residues are coded in 5 bits (A-Z -> 1-26, anything else 31), so k-mers
+# of up to 6 residues fit in a 32 bit integer.
+RESIDUE_CODES = np.full(256, 31, dtype=np.uint32)
+RESIDUE_CODES[ord("A"):ord("Z") + 1] = np.arange(1, 27, dtype=np.uint32)
+RESIDUE_CODES[ord("\n")] = 0
+BITS_PER_RESIDUE = 5
+
+# Ungapped Karlin-Altschul parameters and self-match scores for BLOSUM62,
+# used to give exact matches blast8 e-values and bit scores.
+BLOSUM62_LAMBDA = 0.3176
+BLOSUM62_K = 0.134
+BLOSUM62_SELF_SCORES = {
+    "A": 4, "R": 5, "N": 6, "D": 6, "C": 9, "Q": 5, "E": 5, "G": 6, "H": 8, "I": 4,
+    "L": 4, "K": 5, "M": 5, "F": 6, "P": 7, "S": 4, "T": 5, "W": 11, "Y": 7, "V": 4}
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Find exact occurrences of peptides in a protein database (e.g. ResFinder), writing blast8. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("DATABASE",
+        help="Protein FASTA to search in.")
+    parser.add_argument("FILE", nargs="+",
+        help="Peptide FASTA file(s), e.g. from convert_tandem_xml_2_fasta.py.")
+    parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        default="",
+        help="Output blast8 filename. If not specified, FILE.blast8.")
+    parser.add_argument("-k", "--kmer", dest="kmer", metavar="K",
+        type=int,
+        default=5,
+        choices=range(1, 7),
+        help="Index k-mer length; shorter peptides are matched by scanning [%(default)s].")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+
+    if options.outfile and len(options.FILE) > 1:
+        logging.error("Cannot specify output filename with more than one file on command line")
+        exit(1)
+    return options
+
+
+def kmer_codes(residue_codes, k):
+    """
+    Integer code of every k-mer in an array of residue codes.
+    """
+
+    count = len(residue_codes) - k + 1
+    if count < 1:
+        return np.empty(0, dtype=np.uint32)
+    codes = np.zeros(count, dtype=np.uint32)
+    for i in range(k):
+        codes <<= BITS_PER_RESIDUE
+        codes |= residue_codes[i:i + count]
+    return codes
+
+
+class Protein_Index():
+    """
+    Exact substring index over all proteins in a FASTA file.
+
+    Proteins are concatenated (separated by newlines) and the positions
+    of all k-mers are sorted on k-mer code, a k-mer bucketed suffix
+    array. A peptide is looked up by binary search on its first k-mer
+    and verified at each candidate position.
+    """
+
+    def __init__(self, fasta_filename, k=5):
+        self.k = k
+        names = []
+        sequences = []
+        starts = []
+        offset = 0
+        with open(fasta_filename, "rb") as fasta:
+            for _, _, header, sequence in iter_fasta_records(fasta):
+                names.append(header.split()[0].decode("utf-8", "replace") if header.strip() else "")
+                sequence = sequence.upper()
+                sequences.append(sequence)
+                starts.append(offset)
+                offset += len(sequence) + 1
+        self.names = names
+        self.lengths = [len(sequence) for sequence in sequences]
+        self.starts = starts
+        self.text = b"\n".join(sequences) + b"\n"
+        codes = kmer_codes(RESIDUE_CODES[np.frombuffer(self.text, dtype=np.uint8)], k)
+        self.positions = np.argsort(codes, kind="mergesort").astype(np.int64)
+        self.sorted_codes = codes[self.positions]
+        self.residues = offset - len(sequences)
+
+    def find(self, peptide):
+        """
+        Yields (protein number, 0-based start) of every occurrence of peptide (bytes).
+        """
+
+        if b"\n" in peptide or not peptide:
+            return
+        if len(peptide) < self.k:
+            position = self.text.find(peptide)
+            while position != -1:
+                yield self._protein_at(position)
+                position = self.text.find(peptide, position + 1)
+            return
+        code = kmer_codes(RESIDUE_CODES[np.frombuffer(peptide[:self.k], dtype=np.uint8)], self.k)[0]
+        first = np.searchsorted(self.sorted_codes, code, side="left")
+        last = np.searchsorted(self.sorted_codes, code, side="right")
+        for position in sorted(self.positions[first:last].tolist()):
+            if self.text.startswith(peptide, position):
+                yield self._protein_at(position)
+
+    def _protein_at(self, position):
+        protein = bisect.bisect_right(self.starts, position) - 1
+        return protein, position - self.starts[protein]
+
+
+def exact_match_scores(peptide, database_residues):
+    """
+    E-value and bit score of an ungapped, exact match of peptide (str).
+    """
+
+    raw_score = sum(BLOSUM62_SELF_SCORES.get(residue, 1) for residue in peptide)
+    bit_score = (BLOSUM62_LAMBDA * raw_score - math.log(BLOSUM62_K)) / math.log(2)
+    evalue = len(peptide) * database_residues * 2.0**(-bit_score)
+    return evalue, bit_score
+
+
+def match_peptides(index, peptide_fasta, outfilename):
+    """
+    Write blast8 rows for every exact occurrence of every peptide in index.
+
+    Returns a tuple (peptides read, peptides matched, rows written).
+    """
+
+    peptides = matched = rows = 0
+    tmp_outfilename = outfilename + ".partial"
+    with open(peptide_fasta, "rb") as fasta, open(tmp_outfilename, "w") as blast8:
+        for _, _, header, sequence in iter_fasta_records(fasta):
+            peptides += 1
+            query = header.split()[0].decode("utf-8", "replace") if header.strip() else ""
+            peptide = sequence.upper()
+            hits = 0
+            for protein, start in index.find(peptide):
+                if not hits:
+                    evalue, bit_score = exact_match_scores(peptide.decode("ascii", "replace"), index.residues)
+                length = len(peptide)
+                blast8.write("{}\t{}\t100.00\t{}\t0\t0\t1\t{}\t{}\t{}\t{:.2e}\t{:.1f}\n".format(
+                    query, index.names[protein], length, length, start + 1, start + length, evalue, bit_score))
+                hits += 1
+            if hits:
+                matched += 1
+                rows += hits
+    replace(tmp_outfilename, outfilename)
+    profile_hooks.count("peptides_read", peptides)
+    profile_hooks.count("peptides_matched", matched)
+    profile_hooks.count("blast8_rows", rows)
+    return peptides, matched, rows
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    start_time = time.time()
+    with profile_hooks.timer("index"):
+        index = Protein_Index(options.DATABASE, options.kmer)
+    logging.info("Indexed %s proteins (%s residues) from %s in %.1f s",
+            len(index.names), index.residues, options.DATABASE, time.time() - start_time)
+
+    for peptide_fasta in options.FILE:
+        outfilename = options.outfile or peptide_fasta + ".blast8"
+        with record_stage(sample_name(peptide_fasta), "exact_match", inputs=[peptide_fasta], outputs=[outfilename]) as record:
+            start_time = time.time()
+            with profile_hooks.timer("match"):
+                peptides, matched, rows = match_peptides(index, peptide_fasta, outfilename)
+            record.records = peptides
+        logging.info("Matched %s of %s peptides from %s exactly (%s hits) in %.1f s, wrote %s",
+                matched, peptides, peptide_fasta, rows, time.time() - start_time, outfilename)
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
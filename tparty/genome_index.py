@@ -0,0 +1,507 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace, makedirs
+from collections import namedtuple
+import argparse
+import logging
+import shutil
+import time
+import numpy as np
+
+from dedup_fasta import iter_fasta_records
+from exact_match import RESIDUE_CODES, BITS_PER_RESIDUE, kmer_codes, exact_match_scores
+from run_ledger import record_stage, sample_name
+import profile_hooks
+
+
+# Standard genetic code, codons ordered TCAG as nucleotide codes 0-3. Codons
+# with other nucleotides (code 4) translate to X.
+CODON_TABLE = np.frombuffer(b"FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGGX", dtype=np.uint8)
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)
+for nucleotides, code in ((b"Tt", 0), (b"Uu", 0), (b"Cc", 1), (b"Aa", 2), (b"Gg", 3)):
+    NUCLEOTIDE_CODES[list(nucleotides)] = code
+
+# Files of an index directory.
+FRAMES_FILE = "frames.bin"
+CODES_FILE = "codes.npy"
+POSITIONS_FILE = "positions.npy"
+SEQUENCES_FILE = "sequences.tsv"
+
+# One translated frame of a genome sequence in frames.bin.
+Frame = namedtuple("Frame",
+        ["name",
+         "frame",
+         "offset",
+         "residues",
+         "nucleotides"])
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Build a memory-mapped six-frame translated k-mer index of genome FASTA files, and search peptides against it, writing blast8. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest="command")
+
+    build_parser = subparsers.add_parser("build",
+        help="Translate a genome FASTA in six frames and index its k-mers.")
+    build_parser.add_argument("FASTA",
+        help="Genome (nucleotide) FASTA file.")
+    build_parser.add_argument("-o", "--outdir", metavar="DIR", dest="outdir",
+        default="",
+        help="Index directory [FASTA.tindex].")
+    build_parser.add_argument("-k", "--kmer", dest="kmer", metavar="K",
+        type=int,
+        default=5,
+        choices=range(1, 7),
+        help="Indexed k-mer length, like BLAT's -tileSize [%(default)s].")
+    build_parser.add_argument("-s", "--step", dest="step", metavar="S",
+        type=int,
+        default=5,
+        help="Index every S:th k-mer, like BLAT's -stepSize [%(default)s].")
+    build_parser.add_argument("--chunk-size", dest="chunk_size", metavar="N",
+        type=int,
+        default=2**26,
+        help="Residues to index at a time; the k-mers are sorted on disk, so build memory is about 16 bytes per k-mer of a chunk [%(default)s].")
+
+    search_parser = subparsers.add_parser("search",
+        help="Seed and extend peptides against one or more indexes.")
+    search_parser.add_argument("FILE",
+        help="Peptide FASTA file.")
+    search_parser.add_argument("-i", "--index", metavar="DIR", dest="indexes",
+        nargs="+",
+        required=True,
+        help="Index directories (e.g. one per genome shard).")
+    search_parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        default="",
+        help="Output blast8 filename [FILE.blast8].")
+    search_parser.add_argument("--min-identity", dest="min_identity", metavar="P",
+        type=float,
+        default=90.0,
+        help="Minimum percent identity, like BLAT's -minIdentity [%(default)s].")
+    search_parser.add_argument("--min-score", dest="min_score", metavar="S",
+        type=int,
+        default=10,
+        help="Minimum matches minus mismatches, like BLAT's -minScore [%(default)s].")
+
+    compare_parser = subparsers.add_parser("compare",
+        help="Check that index search blast8 agrees with BLAT's for the same peptides.")
+    compare_parser.add_argument("BLAT",
+        help="blast8 output of BLAT.")
+    compare_parser.add_argument("INDEX",
+        help="blast8 output of genome_index.py search.")
+    compare_parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        default="",
+        help="Write the comparison report to FILE [stdout].")
+    compare_parser.add_argument("--min-recall", dest="min_recall", metavar="F",
+        type=float,
+        default=0.95,
+        help="Fail if fewer of BLAT's peptides (and peptide-sequence hits) are found [%(default)s].")
+
+    for subparser in (build_parser, search_parser, compare_parser):
+        profile_hooks.add_profile_arguments(subparser)
+        subparser.add_argument("--loglevel",
+            choices=["INFO", "DEBUG"],
+            default="INFO",
+            help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+    if not options.command:
+        parser.print_help()
+        exit(1)
+
+    logging.basicConfig(level=options.loglevel)
+
+    if options.command == "build" and not options.outdir:
+        options.outdir = options.FASTA + ".tindex"
+    if options.command == "search" and not options.outfile:
+        options.outfile = options.FILE + ".blast8"
+    return options
+
+
+def translate(nucleotide_codes):
+    """
+    Translate an array of nucleotide codes in reading frame 0 to amino acid bytes.
+    """
+
+    codons = nucleotide_codes[:len(nucleotide_codes) // 3 * 3].reshape(-1, 3).astype(np.uint16)
+    indexes = codons[:, 0] * 16 + codons[:, 1] * 4 + codons[:, 2]
+    indexes[(codons == 4).any(axis=1)] = 64
+    return CODON_TABLE[indexes].tobytes()
+
+
+def six_frames(sequence):
+    """
+    Yields (frame, amino acid bytes) for frames 1, 2, 3 and -1, -2, -3.
+    """
+
+    codes = NUCLEOTIDE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    for frame in range(3):
+        yield frame + 1, translate(codes[frame:])
+    # T/A and C/G are codes 0/2 and 1/3, so xor 2 complements.
+    reverse_complement = codes[::-1] ^ 2
+    reverse_complement[codes[::-1] == 4] = 4
+    for frame in range(3):
+        yield -(frame + 1), translate(reverse_complement[frame:])
+
+
+def write_frames(fasta_filename, frames_filename):
+    """
+    Write the six-frame translation of every sequence in fasta_filename.
+
+    Frames are separated by newlines. Returns a list of Frame.
+    """
+
+    frames = []
+    offset = 0
+    with open(fasta_filename, "rb") as fasta, open(frames_filename, "wb") as frames_file:
+        for _, _, header, sequence in iter_fasta_records(fasta):
+            name = header.split()[0].decode("utf-8", "replace") if header.strip() else ""
+            for frame, residues in six_frames(sequence):
+                frames_file.write(residues)
+                frames_file.write(b"\n")
+                frames.append(Frame(name, frame, offset, len(residues), len(sequence)))
+                offset += len(residues) + 1
+    return frames
+
+
+def chunk_kmers(text, chunk_start, k, step, chunk_size):
+    """
+    Codes and positions of the valid step:th k-mers starting in one chunk of text.
+
+    K-mers spanning frame separators or containing stop codons are
+    skipped, as peptides never match them.
+    """
+
+    residue_codes = RESIDUE_CODES[text[chunk_start:chunk_start + chunk_size + k - 1]]
+    positions = np.arange(0, len(residue_codes) - k + 1, step, dtype=np.int64)
+    codes = np.zeros(len(positions), dtype=np.uint32)
+    valid = np.ones(len(positions), dtype=bool)
+    for i in range(k):
+        residues = residue_codes[positions + i]
+        codes <<= BITS_PER_RESIDUE
+        codes |= residues
+        valid &= (residues != 0) & (residues != RESIDUE_CODES[ord("*")])
+    return codes[valid], positions[valid] + chunk_start
+
+
+def index_kmers(frames_filename, codes_filename, positions_filename, k, step, chunk_size):
+    """
+    Write codes and positions of every step:th k-mer of frames_filename, sorted on code.
+
+    The k-mers are sorted externally: each chunk of chunk_size residues
+    is distributed into buckets on the high bits of the code in the
+    output files, which are then sorted one bucket at a time. Peak memory
+    is about one chunk plus the largest bucket, 12-16 bytes per k-mer,
+    independent of the genome size; a skewed k-mer distribution makes
+    the largest bucket bigger than a chunk.
+    Returns the number of indexed k-mers.
+    """
+
+    text = np.memmap(frames_filename, dtype=np.uint8, mode="r")
+    chunk_size = max(chunk_size // step * step, step)
+    chunk_starts = range(0, len(text), chunk_size)
+    code_bits = k * BITS_PER_RESIDUE
+
+    kmers = 0
+    for chunk_start in chunk_starts:
+        kmers += len(chunk_kmers(text, chunk_start, k, step, chunk_size)[0])
+    bucket_bits = min(code_bits, max(0, int(np.ceil(np.log2(max(kmers * step / chunk_size, 1))))))
+    shift = code_bits - bucket_bits
+
+    counts = np.zeros(2**bucket_bits, dtype=np.int64)
+    for chunk_start in chunk_starts:
+        codes, _ = chunk_kmers(text, chunk_start, k, step, chunk_size)
+        counts += np.bincount(codes >> shift, minlength=len(counts))
+    bucket_ends = np.cumsum(counts)
+    bucket_starts = bucket_ends - counts
+
+    position_type = np.uint32 if len(text) < 2**32 else np.int64
+    all_codes = np.lib.format.open_memmap(codes_filename, mode="w+", dtype=np.uint32, shape=(kmers,))
+    all_positions = np.lib.format.open_memmap(positions_filename, mode="w+", dtype=position_type, shape=(kmers,))
+    offsets = bucket_starts.copy()
+    for chunk_start in chunk_starts:
+        codes, positions = chunk_kmers(text, chunk_start, k, step, chunk_size)
+        buckets = codes >> shift
+        order = np.argsort(buckets, kind="mergesort")
+        buckets, codes, positions = buckets[order], codes[order], positions[order]
+        chunk_counts = np.bincount(buckets, minlength=len(counts))
+        chunk_ends = np.cumsum(chunk_counts)
+        for bucket in np.flatnonzero(chunk_counts):
+            first, last = chunk_ends[bucket] - chunk_counts[bucket], chunk_ends[bucket]
+            offset = offsets[bucket]
+            all_codes[offset:offset + last - first] = codes[first:last]
+            all_positions[offset:offset + last - first] = positions[first:last]
+        offsets += chunk_counts
+    del text
+
+    for bucket in np.flatnonzero(counts):
+        first, last = bucket_starts[bucket], bucket_ends[bucket]
+        codes = np.array(all_codes[first:last])
+        order = np.argsort(codes, kind="mergesort")
+        all_codes[first:last] = codes[order]
+        all_positions[first:last] = np.array(all_positions[first:last])[order]
+    all_codes.flush()
+    all_positions.flush()
+    del all_codes, all_positions
+    return kmers
+
+
+def build_index(fasta_filename, outdir, k=5, step=5, chunk_size=2**26):
+    """
+    Build a translated k-mer index of fasta_filename in outdir.
+
+    The index is written to outdir.partial and renamed when complete.
+    Returns a tuple (sequences, indexed k-mers).
+    """
+
+    tmp_outdir = outdir.rstrip("/") + ".partial"
+    if path.exists(tmp_outdir):
+        shutil.rmtree(tmp_outdir)
+    makedirs(tmp_outdir)
+
+    start_time = time.time()
+    with profile_hooks.timer("translate"):
+        frames = write_frames(fasta_filename, path.join(tmp_outdir, FRAMES_FILE))
+    logging.info("Translated %s sequences from %s in six frames in %.1f s",
+            len(frames) // 6, fasta_filename, time.time() - start_time)
+
+    start_time = time.time()
+    with profile_hooks.timer("index"):
+        kmers = index_kmers(path.join(tmp_outdir, FRAMES_FILE), 
+                path.join(tmp_outdir, CODES_FILE), path.join(tmp_outdir, POSITIONS_FILE),
+                k, step, chunk_size)
+    with open(path.join(tmp_outdir, SEQUENCES_FILE), "w") as sequences_file:
+        sequences_file.write("# k={} step={}\n".format(k, step))
+        for frame in frames:
+            sequences_file.write("\t".join(str(field) for field in frame) + "\n")
+    logging.info("Indexed %s %s-mers in %.1f s", kmers, k, time.time() - start_time)
+
+    if path.exists(outdir):
+        shutil.rmtree(outdir)
+    replace(tmp_outdir, outdir)
+    profile_hooks.count("indexed_kmers", kmers)
+    return len(frames) // 6, kmers
+
+
+class Genome_Index():
+    """
+    Memory-mapped translated k-mer index built by build_index.
+
+    The translated frames and sorted k-mer arrays are memory-mapped
+    read-only, so concurrent searches share them through the page cache.
+    """
+
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+        with open(path.join(indexdir, SEQUENCES_FILE)) as sequences_file:
+            settings = dict(field.split("=") for field in sequences_file.readline().lstrip("#").split())
+            self.frames = []
+            for line in sequences_file:
+                name, frame, offset, residues, nucleotides = line.rstrip("\n").split("\t")
+                self.frames.append(Frame(name, int(frame), int(offset), int(residues), int(nucleotides)))
+        self.k = int(settings["k"])
+        self.step = int(settings["step"])
+        self.offsets = np.array([frame.offset for frame in self.frames], dtype=np.int64)
+        self.text = np.memmap(path.join(indexdir, FRAMES_FILE), dtype=np.uint8, mode="r")
+        self.codes = np.load(path.join(indexdir, CODES_FILE), mmap_mode="r")
+        self.positions = np.load(path.join(indexdir, POSITIONS_FILE), mmap_mode="r")
+
+    def seed_diagonals(self, peptide_codes):
+        """
+        Text positions where peptide would start, for each k-mer seed hit.
+        """
+
+        diagonals = set()
+        seeds = kmer_codes(peptide_codes, self.k)
+        for query_offset, code in enumerate(seeds):
+            first = np.searchsorted(self.codes, code, side="left")
+            last = np.searchsorted(self.codes, code, side="right")
+            if first == last:
+                continue
+            diagonals.update((self.positions[first:last].astype(np.int64) - query_offset).tolist())
+        return diagonals
+
+    def search(self, peptide, min_identity=90.0, min_score=10):
+        """
+        Yields (Frame, residue start, matches) for ungapped alignments of peptide (bytes).
+
+        Alignments cover the whole peptide and lie within one frame.
+        """
+
+        peptide_array = np.frombuffer(peptide, dtype=np.uint8)
+        length = len(peptide)
+        for diagonal in sorted(self.seed_diagonals(RESIDUE_CODES[peptide_array])):
+            frame_number = int(np.searchsorted(self.offsets, diagonal, side="right")) - 1
+            if frame_number < 0:
+                continue
+            frame = self.frames[frame_number]
+            start = diagonal - frame.offset
+            if start < 0 or start + length > frame.residues:
+                continue
+            matches = int((self.text[diagonal:diagonal + length] == peptide_array).sum())
+            if 100.0 * matches / length >= min_identity and 2 * matches - length >= min_score:
+                yield frame, start, matches
+
+
+def nucleotide_coordinates(frame, start, length):
+    """
+    1-based genome coordinates of residues start..start+length of frame.
+
+    Reverse frame alignments have subject start > subject end, as in BLAT's blast8.
+    """
+
+    first = abs(frame.frame) - 1 + 3 * start
+    last = first + 3 * length - 1
+    if frame.frame > 0:
+        return first + 1, last + 1
+    return frame.nucleotides - first, frame.nucleotides - last
+
+
+def search_indexes(indexes, peptide_fasta, outfilename, min_identity=90.0, min_score=10):
+    """
+    Write blast8 rows for all alignments of the peptides in indexes.
+
+    Returns a tuple (peptides read, peptides matched, rows written).
+    """
+
+    peptides = matched = rows = 0
+    database_residues = sum(frame.residues for index in indexes for frame in index.frames)
+    tmp_outfilename = outfilename + ".partial"
+    with open(peptide_fasta, "rb") as fasta, open(tmp_outfilename, "w") as blast8:
+        for _, _, header, sequence in iter_fasta_records(fasta):
+            peptides += 1
+            query = header.split()[0].decode("utf-8", "replace") if header.strip() else ""
+            peptide = sequence.upper()
+            length = len(peptide)
+            hits = 0
+            for index in indexes:
+                if length < index.k:
+                    continue
+                for frame, start, matches in index.search(peptide, min_identity, min_score):
+                    subject_start, subject_end = nucleotide_coordinates(frame, start, length)
+                    # Scored as an exact match of the identical residues.
+                    evalue, bit_score = exact_match_scores(
+                            "".join(chr(residue) for residue, target in
+                                    zip(peptide, index.text[frame.offset + start:frame.offset + start + length])
+                                    if residue == target),
+                            database_residues)
+                    blast8.write("{}\t{}\t{:.2f}\t{}\t{}\t0\t1\t{}\t{}\t{}\t{:.2e}\t{:.1f}\n".format(
+                        query, frame.name, 100.0 * matches / length, length, length - matches,
+                        length, subject_start, subject_end, evalue, bit_score))
+                    hits += 1
+            if hits:
+                matched += 1
+                rows += hits
+    replace(tmp_outfilename, outfilename)
+    profile_hooks.count("peptides_read", peptides)
+    profile_hooks.count("peptides_matched", matched)
+    profile_hooks.count("blast8_rows", rows)
+    return peptides, matched, rows
+
+
+def read_blast8_hits(filename):
+    """
+    Set of (query, subject) pairs and set of queries in a blast8 file.
+    """
+
+    hits = set()
+    with open(filename) as blast8:
+        for line in blast8:
+            fields = line.split("\t")
+            if len(fields) >= 2:
+                hits.add((fields[0], fields[1]))
+    return hits, {query for query, _ in hits}
+
+
+def compare_blast8(blat_filename, index_filename):
+    """
+    Agreement of index search output with BLAT's.
+
+    Returns a dict with peptide and (peptide, sequence) hit counts found
+    by both, by BLAT only and by the index only, and the recall of
+    BLAT's peptides and hits.
+    """
+
+    blat_hits, blat_peptides = read_blast8_hits(blat_filename)
+    index_hits, index_peptides = read_blast8_hits(index_filename)
+    return {
+        "peptides_both": len(blat_peptides & index_peptides),
+        "peptides_blat_only": len(blat_peptides - index_peptides),
+        "peptides_index_only": len(index_peptides - blat_peptides),
+        "hits_both": len(blat_hits & index_hits),
+        "hits_blat_only": len(blat_hits - index_hits),
+        "hits_index_only": len(index_hits - blat_hits),
+        "peptide_recall": len(blat_peptides & index_peptides) / len(blat_peptides) if blat_peptides else 1.0,
+        "hit_recall": len(blat_hits & index_hits) / len(blat_hits) if blat_hits else 1.0,
+    }
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    if options.command == "compare":
+        comparison = compare_blast8(options.BLAT, options.INDEX)
+        report = "".join("{}\t{}\n".format(key, round(value, 4) if isinstance(value, float) else value)
+                for key, value in sorted(comparison.items()))
+        if options.outfile:
+            with open(options.outfile, "w") as out:
+                out.write(report)
+        else:
+            print(report, end="")
+        agrees = min(comparison["peptide_recall"], comparison["hit_recall"]) >= options.min_recall
+        if not agrees:
+            logging.error("Index search recalls %.1f%% of BLAT's peptides and %.1f%% of its hits, below %.1f%%",
+                    100 * comparison["peptide_recall"], 100 * comparison["hit_recall"], 100 * options.min_recall)
+        exit(0 if agrees else 1)
+
+    if options.command == "build":
+        with record_stage(sample_name(options.FASTA), "genome_index", inputs=[options.FASTA]) as record:
+            sequences, kmers = build_index(options.FASTA, options.outdir, options.kmer, options.step, options.chunk_size)
+            record.records = sequences
+        return
+
+    indexes = [Genome_Index(indexdir) for indexdir in options.indexes]
+    with record_stage(sample_name(options.FILE), "genome_search", inputs=[options.FILE], outputs=[options.outfile]) as record:
+        start_time = time.time()
+        with profile_hooks.timer("search"):
+            peptides, matched, rows = search_indexes(indexes, options.FILE, options.outfile,
+                    options.min_identity, options.min_score)
+        record.records = peptides
+        record.reference_bytes = sum(path.getsize(path.join(index.indexdir, FRAMES_FILE)) for index in indexes)
+    logging.info("Aligned %s of %s peptides from %s (%s hits) in %.1f s, wrote %s",
+            matched, peptides, options.FILE, rows, time.time() - start_time, options.outfile)
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
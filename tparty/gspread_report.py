@@ -24,16 +24,16 @@ from os.path import getmtime
 from os import listdir
 from datetime import datetime
 from collections import namedtuple
-from oauth2client.client import SignedJwtAssertionCredentials
 from xml.etree import ElementTree
-import yaml
 import platform
 import logging
 import argparse
-import gspread
 import json
 import sqlite3
 
+from run_ledger import record_stage
+import profile_hooks
+
 
 def parse_commandline(argv):
     """
@@ -59,6 +59,7 @@ def parse_commandline(argv):
     parser.add_argument("-s", "--snakemake-configfile", dest="snakemake_configfile",
             required=True,
             help="Path to Snakemake configfile.")
+    profile_hooks.add_profile_arguments(parser)
     parser.add_argument("--loglevel", 
             dest="loglevel",
             default="INFO",
@@ -151,6 +152,8 @@ def get_database_versions(snakemake_configfile):
         (xtandem_db_version, genome_db_version, taxref_db_version, annotation_db_version)
     """
 
+    import yaml
+
     snakemake_config = yaml.load(open(snakemake_configfile))
 
     xtandem_db_version = get_xtandem_db_version(snakemake_config["xtandem_taxonomy"])
@@ -306,6 +309,10 @@ def read_samples_db_from_gdoc(tokenfile, spreadsheet="TTT proteotyping pipeline
 
     It expects to find it in the "Samples" sheet.
     """
+    # Imported here so that --help and the summary functions do not pay for them.
+    import gspread
+    from oauth2client.client import SignedJwtAssertionCredentials
+
     json_key = json.load(open(options.tokenfile))
     scope = ["https://spreadsheets.google.com/feeds"]
 
@@ -330,6 +337,10 @@ def report_to_gdoc_r3(results, sample_db, db_versions, tokenfile, spreadsheet="T
     Connects to Google docs using the 'gspread' Python package. 
     Authentication via OAuth2 credentials from Google Developers Console.
     """
+    # Imported here so that --help and the summary functions do not pay for them.
+    import gspread
+    from oauth2client.client import SignedJwtAssertionCredentials
+
     json_key = json.load(open(options.tokenfile))
     scope = ["https://spreadsheets.google.com/feeds"]
 
@@ -362,11 +373,23 @@ def report_to_gdoc_r3(results, sample_db, db_versions, tokenfile, spreadsheet="T
         wks.append_row(row)
 
 
-if __name__ == "__main__":
-    options = parse_commandline(argv)
+def main(options):
+    """
+    Main.
+    """
+
+    with record_stage(",".join(options.PID), "gspread_report") as record:
+        with profile_hooks.timer("summary_results"):
+            results = [get_summary_results(pid) for pid in options.PID]
 
-    results = [get_summary_results(pid) for pid in options.PID]
+        with profile_hooks.timer("gdoc_read"):
+            samples_db = read_samples_db_from_gdoc(options.tokenfile)
+        db_versions = get_database_versions(options.snakemake_configfile)
+        with profile_hooks.timer("gdoc_upload"):
+            report_to_gdoc_r3(results, samples_db, db_versions, options.tokenfile)
+        record.records = len(results)
 
-    samples_db = read_samples_db_from_gdoc(options.tokenfile)
-    db_versions = get_database_versions(options.snakemake_configfile)
-    report_to_gdoc_r3(results, samples_db, db_versions, options.tokenfile)
+
+if __name__ == "__main__":
+    options = parse_commandline(argv)
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace
+from collections import namedtuple, Counter
+import argparse
+import logging
+import base64
+import time
+import zlib
+import numpy as np
+from lxml import etree
+
+from run_ledger import record_stage, sample_name
+import profile_hooks
+from prefilter_mzxml import open_mzxml, read_xtandem_parameters, read_spectrum_filter, rejection_reason
+
+
+Scan = namedtuple("Scan",
+        ["num",
+         "ms_level",
+         "retention_time",
+         "precursor_mz",
+         "precursor_charge",
+         "mz",
+         "intensity"])
+
+Peak_Conditioning = namedtuple("Peak_Conditioning",
+        ["total_peaks",
+         "dynamic_range",
+         "min_fragment_mz"])
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Convert mzXML to compact MGF, keeping only searchable MS2 scans and their most intense peaks. The peak reduction approximates X!Tandem's spectrum conditioning but is not equivalent to it. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("FILE", type=str,
+        help="mzXML file to convert (can be gzipped).")
+    parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        required=True,
+        help="Output MGF filename.")
+    parser.add_argument("-p", "--default-parameters", metavar="FILE", dest="default_parameters",
+        required=True,
+        help="Path to X!Tandem default_parameters.xml to read spectrum thresholds from.")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+    return options
+
+
+def read_peak_conditioning(parameter_file):
+    """
+    Read X!Tandem peak reduction settings from parameter file.
+    """
+
+    parameters = read_xtandem_parameters(parameter_file)
+    return Peak_Conditioning(int(parameters.get("spectrum, total peaks", 0)),
+                             float(parameters.get("spectrum, dynamic range", 0.0)),
+                             float(parameters.get("spectrum, minimum fragment mz", 0.0)))
+
+
+def decode_peaks(text, precision=32, compression=None):
+    """
+    Decode base64 mzXML peak list into (mz, intensity) NumPy arrays.
+
+    Peaks are stored as interleaved big endian (network order) floats.
+    The returned arrays are views into a single buffer; no Python
+    objects are created per peak.
+    """
+
+    if not text:
+        empty = np.empty(0, dtype=np.float64)
+        return empty, empty
+    data = base64.b64decode(text)
+    if compression == "zlib":
+        data = zlib.decompress(data)
+    dtype = ">f8" if int(precision) == 64 else ">f4"
+    pairs = np.frombuffer(data, dtype=dtype).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def local_name(element):
+    """
+    Tag name without namespace.
+    """
+
+    tag = element.tag
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else tag
+
+
+def parse_retention_time(value):
+    """
+    Convert mzXML xs:duration retention time (e.g. 'PT123.4S') to seconds.
+    """
+
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith("PT") and value.endswith("S"):
+        return float(value[2:-1])
+    return None
+
+
+def iter_scans(filename, ms_levels=None):
+    """
+    Stream scans from (possibly gzipped) mzXML file.
+
+    Yields Scan namedtuples with peaks decoded into NumPy arrays. Nested
+    scans are yielded before their parent scan. If ms_levels is given,
+    only scans with those MS levels have their peaks decoded and yielded.
+    """
+
+    with open_mzxml(filename) as mzxml:
+        for _, element in etree.iterparse(mzxml, events=("end",), remove_comments=True):
+            if local_name(element) != "scan":
+                continue
+            ms_level = int(element.attrib.get("msLevel", 0))
+            if ms_levels and ms_level not in ms_levels:
+                element.clear()
+                continue
+            precursor_mz = None
+            precursor_charge = None
+            mz = intensity = np.empty(0, dtype=np.float64)
+            for child in element:
+                name = local_name(child)
+                if name == "precursorMz":
+                    precursor_mz = float(child.text)
+                    if "precursorCharge" in child.attrib:
+                        precursor_charge = int(child.attrib["precursorCharge"])
+                elif name == "peaks":
+                    mz, intensity = decode_peaks(child.text,
+                            child.attrib.get("precision", 32),
+                            child.attrib.get("compressionType"))
+            yield Scan(int(element.attrib["num"]),
+                       ms_level,
+                       parse_retention_time(element.attrib.get("retentionTime")),
+                       precursor_mz,
+                       precursor_charge,
+                       mz,
+                       intensity)
+            # Nested child scans have already been yielded at this point.
+            element.clear()
+
+
+def condition_peaks(mz, intensity, peak_conditioning):
+    """
+    Vectorized approximation of X!Tandem's dynamic range and total peaks reductions.
+
+    Peaks below the minimum fragment m/z are removed, intensities are
+    scaled so that the most intense peak equals the dynamic range and
+    peaks scaling to less than 1 are removed. Of the remaining, the
+    'total peaks' most intense are kept, returned sorted on m/z.
+
+    This is not equivalent to X!Tandem's conditioning: noise suppression,
+    the neutral loss window and the removal of peaks near the parent ion
+    are not applied, and ties between equally intense peaks may be broken
+    differently. X!Tandem still conditions the reduced spectra itself, so
+    searches of the MGF can differ slightly from searches of the mzXML.
+    """
+
+    keep = mz >= peak_conditioning.min_fragment_mz
+    mz = mz[keep]
+    intensity = intensity[keep]
+    if not len(intensity):
+        return mz, intensity
+
+    if peak_conditioning.dynamic_range:
+        scaled = intensity * (peak_conditioning.dynamic_range / intensity.max())
+        keep = scaled >= 1.0
+        mz = mz[keep]
+        intensity = intensity[keep]
+
+    total_peaks = peak_conditioning.total_peaks
+    if total_peaks and len(intensity) > total_peaks:
+        top = np.argpartition(intensity, len(intensity) - total_peaks)[-total_peaks:]
+        top.sort()
+        mz = mz[top]
+        intensity = intensity[top]
+    return mz, intensity
+
+
+def write_mgf_spectrum(mgf, scan, mz, intensity):
+    """
+    Write a single spectrum in MGF format.
+
+    TITLE holds the original scan number so results can be traced back.
+    """
+
+    mgf.write("BEGIN IONS\nTITLE=scan={}\nPEPMASS={:.6f}\n".format(scan.num, scan.precursor_mz))
+    if scan.precursor_charge:
+        mgf.write("CHARGE={}+\n".format(scan.precursor_charge))
+    if scan.retention_time is not None:
+        mgf.write("RTINSECONDS={:.3f}\n".format(scan.retention_time))
+    np.savetxt(mgf, np.column_stack((mz, intensity)), fmt="%.5f %.2f")
+    mgf.write("END IONS\n")
+
+
+def convert_mzxml_to_mgf(infilename, outfilename, spectrum_filter, peak_conditioning):
+    """
+    Convert mzXML to MGF, keeping only searchable MS2 scans and their
+    most intense peaks.
+
+    Dropped scans are counted per reason (no_precursor or a reason from
+    rejection_reason) and logged individually at debug level.
+    Returns a tuple (scans kept, MS2 scans read, peaks kept, peaks read).
+    """
+
+    start_time = time.time()
+    scans_read = scans_kept = peaks_read = peaks_kept = 0
+    dropped = Counter()
+    tmp_outfilename = outfilename + ".partial"
+    with open(tmp_outfilename, "w") as mgf:
+        for scan in profile_hooks.timed_iter(iter_scans(infilename, ms_levels=(2,)), "parse"):
+            scans_read += 1
+            peaks_read += len(scan.mz)
+            if scan.precursor_mz is None:
+                reason = "no_precursor"
+            else:
+                mz, intensity = condition_peaks(scan.mz, scan.intensity, peak_conditioning)
+                reason = rejection_reason(scan.ms_level, len(mz), scan.precursor_mz, scan.precursor_charge, spectrum_filter)
+            if reason:
+                logging.debug("Dropped scan %s of %s: %s", scan.num, path.basename(infilename), reason)
+                dropped[reason] += 1
+                continue
+            write_mgf_spectrum(mgf, scan, mz, intensity)
+            scans_kept += 1
+            peaks_kept += len(mz)
+    replace(tmp_outfilename, outfilename)
+    profile_hooks.count("scans_read", scans_read)
+    profile_hooks.count("scans_written", scans_kept)
+    profile_hooks.count("peaks_read", peaks_read)
+    profile_hooks.count("peaks_written", peaks_kept)
+    for reason, scans in dropped.items():
+        profile_hooks.count(reason, scans)
+
+    logging.info("Converted %s to %s in %.1f s: kept %s of %s MS2 scans and %s of %s peaks",
+            path.basename(infilename), outfilename, time.time() - start_time,
+            scans_kept, scans_read, peaks_kept, peaks_read)
+    if dropped:
+        logging.info("Dropped %s scans of %s: %s", sum(dropped.values()), path.basename(infilename),
+                ", ".join("{}: {}".format(reason, scans) for reason, scans in sorted(dropped.items())))
+    return scans_kept, scans_read, peaks_kept, peaks_read
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    spectrum_filter = read_spectrum_filter(options.default_parameters)
+    peak_conditioning = read_peak_conditioning(options.default_parameters)
+    logging.debug("Using spectrum filter %s and peak conditioning %s", spectrum_filter, peak_conditioning)
+    with record_stage(sample_name(options.FILE), "mzxml2mgf", inputs=[options.FILE], outputs=[options.outfile]) as record:
+        scans_kept, scans_read, peaks_kept, peaks_read = convert_mzxml_to_mgf(options.FILE, options.outfile, spectrum_filter, peak_conditioning)
+        record.records = scans_read
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace
+from collections import namedtuple
+from xml.etree import ElementTree
+from xml.sax.saxutils import XMLGenerator
+from io import StringIO
+import xml.sax
+import gzip
+import time
+import argparse
+import logging
+
+from run_ledger import record_stage, sample_name
+import profile_hooks
+
+
+PROTON_MASS = 1.007276
+
+Spectrum_Filter = namedtuple("Spectrum_Filter",
+        ["min_peaks",
+         "min_parent_mh",
+         "max_parent_charge"])
+
+Prefilter_Stats = namedtuple("Prefilter_Stats",
+        ["scans_in",
+         "scans_out",
+         "ms1_removed",
+         "peaks_removed",
+         "mh_removed",
+         "charge_removed",
+         "bytes_in",
+         "bytes_out",
+         "seconds"])
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Remove MS1 scans and scans X!Tandem would reject from mzXML files. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("FILE", type=str,
+        help="mzXML file to filter (can be gzipped).")
+    parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        required=True,
+        help="Output mzXML filename.")
+    parser.add_argument("-p", "--default-parameters", metavar="FILE", dest="default_parameters",
+        required=True,
+        help="Path to X!Tandem default_parameters.xml to read spectrum thresholds from.")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+    return options
+
+
+def read_xtandem_parameters(parameter_file):
+    """
+    Read all input notes in X!Tandem parameter file into a dict {label: value}.
+    """
+
+    root = ElementTree.parse(parameter_file).getroot()
+    return {note.attrib["label"]: (note.text or "").strip()
+            for note in root.iter("note")
+            if note.attrib.get("type") == "input" and "label" in note.attrib}
+
+
+def read_spectrum_filter(parameter_file):
+    """
+    Read the spectrum thresholds X!Tandem applies before scoring.
+    """
+
+    parameters = read_xtandem_parameters(parameter_file)
+    return Spectrum_Filter(int(parameters.get("spectrum, minimum peaks", 0)),
+                           float(parameters.get("spectrum, minimum parent m+h", 0.0)),
+                           int(parameters.get("spectrum, maximum parent charge", 0)))
+
+
+def rejection_reason(ms_level, peaks_count, precursor_mz, precursor_charge, spectrum_filter):
+    """
+    Reason X!Tandem would not search a scan, or None if it could be used.
+
+    Scans without precursor charge are only filtered on MS level and 
+    peak count, as X!Tandem then tries several charge states.
+    """
+
+    if ms_level == 1:
+        return "ms1_removed"
+    if peaks_count < spectrum_filter.min_peaks:
+        return "peaks_removed"
+    if precursor_charge:
+        if spectrum_filter.max_parent_charge and precursor_charge > spectrum_filter.max_parent_charge:
+            return "charge_removed"
+        if precursor_mz and precursor_mz * precursor_charge - (precursor_charge - 1) * PROTON_MASS < spectrum_filter.min_parent_mh:
+            return "mh_removed"
+    return None
+
+
+def open_mzxml(filename):
+    """
+    Open (possibly gzipped) mzXML file for binary reading.
+    """
+
+    if filename.endswith((".gz", ".GZ")):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+class Counting_Reader():
+    """
+    Minimal file wrapper that counts the (decompressed) bytes read through it.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class Scan_Prefilter(xml.sax.ContentHandler):
+    """
+    SAX handler that copies an mzXML document, leaving out unsearchable scans.
+
+    Each scan is buffered until its fate is known (i.e. when it ends or
+    when a nested child scan starts, as precursor information always
+    precedes child scans). Children of dropped scans are kept and end up
+    as siblings of their parent's siblings. The scan index is removed,
+    as its byte offsets are no longer valid.
+    """
+
+    SKIPPED_ELEMENTS = ("index", "indexOffset", "sha1")
+
+    def __init__(self, outfile, spectrum_filter):
+        super().__init__()
+        self.outfile = outfile
+        self.out = XMLGenerator(outfile, encoding="utf-8")
+        self.spectrum_filter = spectrum_filter
+        self.scans = []
+        self.skip_depth = 0
+        self.counts = dict(scans_in=0, scans_out=0, ms1_removed=0,
+                peaks_removed=0, mh_removed=0, charge_removed=0)
+
+    def current_writer(self):
+        for scan in reversed(self.scans):
+            if scan["keep"] is None:
+                return scan["writer"]
+        return self.out
+
+    def current_stream(self):
+        for scan in reversed(self.scans):
+            if scan["keep"] is None:
+                return scan["buffer"]
+        return self.outfile
+
+    def decide(self, scan):
+        """Flush or discard a buffered scan once its attributes are known."""
+        attrs = scan["attrs"]
+        reason = rejection_reason(int(attrs.get("msLevel", 2)),
+                int(attrs.get("peaksCount", self.spectrum_filter.min_peaks)),
+                scan.get("precursorMz"),
+                scan.get("precursorCharge"),
+                self.spectrum_filter)
+        scan["keep"] = reason is None
+        if reason:
+            self.counts[reason] += 1
+        else:
+            self.counts["scans_out"] += 1
+            self.current_stream().write(scan["buffer"].getvalue())
+        scan["buffer"] = None
+        scan["writer"] = None
+
+    def startElement(self, name, attrs):
+        if self.skip_depth or name in self.SKIPPED_ELEMENTS:
+            self.skip_depth += 1
+            return
+        if name == "scan":
+            self.counts["scans_in"] += 1
+            if self.scans and self.scans[-1]["keep"] is None:
+                self.decide(self.scans[-1])
+            buffer = StringIO()
+            self.scans.append(dict(attrs=dict(attrs), keep=None, buffer=buffer,
+                writer=XMLGenerator(buffer, encoding="utf-8")))
+        elif name == "precursorMz" and self.scans:
+            if "precursorCharge" in attrs:
+                self.scans[-1]["precursorCharge"] = int(attrs["precursorCharge"])
+            self.scans[-1]["reading_precursor"] = []
+        if self.scans and self.scans[-1]["keep"] is False:
+            return
+        self.current_writer().startElement(name, attrs)
+
+    def endElement(self, name):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        if self.scans and self.scans[-1]["keep"] is False and name != "scan":
+            return
+        if name == "precursorMz" and self.scans and "reading_precursor" in self.scans[-1]:
+            scan = self.scans[-1]
+            scan["precursorMz"] = float("".join(scan.pop("reading_precursor")) or 0.0)
+        if name == "scan":
+            scan = self.scans[-1]
+            if scan["keep"] is None:
+                scan["writer"].endElement(name)
+                self.scans.pop()
+                self.decide(scan)
+                return
+            self.scans.pop()
+            if scan["keep"]:
+                self.current_writer().endElement(name)
+            return
+        self.current_writer().endElement(name)
+
+    def characters(self, content):
+        if self.skip_depth or (self.scans and self.scans[-1]["keep"] is False):
+            return
+        if self.scans and "reading_precursor" in self.scans[-1]:
+            self.scans[-1]["reading_precursor"].append(content)
+        self.current_writer().characters(content)
+
+    def ignorableWhitespace(self, content):
+        self.characters(content)
+
+    def processingInstruction(self, target, data):
+        self.current_writer().processingInstruction(target, data)
+
+    def startDocument(self):
+        self.out.startDocument()
+
+    def endDocument(self):
+        self.out.endDocument()
+
+
+def prefilter_mzxml(infilename, outfilename, spectrum_filter):
+    """
+    Stream infilename (mzXML, possibly gzipped) to outfilename without
+    MS1 scans and scans failing the X!Tandem spectrum thresholds.
+
+    Output is written to a temporary name and renamed when complete.
+    Returns a Prefilter_Stats namedtuple.
+    """
+
+    start_time = time.time()
+    tmp_outfilename = outfilename + ".partial"
+    infile = Counting_Reader(open_mzxml(infilename))
+    with open(tmp_outfilename, "w", encoding="utf-8") as outfile:
+        handler = Scan_Prefilter(outfile, spectrum_filter)
+        parser = xml.sax.make_parser()
+        parser.setFeature(xml.sax.handler.feature_external_ges, False)
+        parser.setContentHandler(handler)
+        parser.parse(infile)
+    replace(tmp_outfilename, outfilename)
+
+    stats = Prefilter_Stats(bytes_in=infile.bytes_read,
+            bytes_out=path.getsize(outfilename),
+            seconds=time.time() - start_time,
+            **handler.counts)
+    log_prefilter_stats(path.basename(infilename), stats)
+    for counter in ("scans_in", "scans_out", "ms1_removed", "peaks_removed", "mh_removed", "charge_removed"):
+        profile_hooks.count(counter, getattr(stats, counter))
+    return stats
+
+
+def log_prefilter_stats(samplename, stats):
+    """
+    Log per-sample prefilter statistics.
+    """
+
+    removed = stats.scans_in - stats.scans_out
+    logging.info("Prefiltered %s in %.1f s: kept %s of %s scans, removed %s "
+            "(MS1: %s, too few peaks: %s, parent m+h too low: %s, parent charge too high: %s)",
+            samplename, stats.seconds, stats.scans_out, stats.scans_in, removed,
+            stats.ms1_removed, stats.peaks_removed, stats.mh_removed, stats.charge_removed)
+    if stats.bytes_in:
+        logging.info("Prefiltered %s: X!Tandem input reduced from %.1f MiB to %.1f MiB (%.0f%% less to read and decode)",
+                samplename, stats.bytes_in / 2**20, stats.bytes_out / 2**20,
+                100.0 * (1 - stats.bytes_out / stats.bytes_in))
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    spectrum_filter = read_spectrum_filter(options.default_parameters)
+    logging.debug("Using spectrum filter %s", spectrum_filter)
+    with record_stage(sample_name(options.FILE), "prefilter", inputs=[options.FILE], outputs=[options.outfile]) as record:
+        stats = prefilter_mzxml(options.FILE, options.outfile, spectrum_filter)
+        record.records = stats.scans_in
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,171 @@
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+"""
+Opt-in profiling for tparty programs.
+
+Programs add the --profile options with add_profile_arguments and call
+their main through run_main. Hot loops keep plain local counters and
+report them once with count(), and time sections with timer() or
+timed_iter(), so the cost when profiling is off is a few additions per
+file rather than per record.
+"""
+
+from sys import argv
+from os import path
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from io import StringIO
+import logging
+import time
+
+
+# Set by run_main when profiling. Per-record hooks do nothing otherwise.
+ENABLED = False
+COUNTERS = Counter()
+TIMERS = defaultdict(float)
+
+
+def add_profile_arguments(parser):
+    """
+    Add --profile and --profile-report options to an argparse parser.
+    """
+
+    parser.add_argument("--profile", dest="profile",
+            choices=["cpu", "memory"],
+            default="",
+            help="Profile CPU time (cProfile) or memory allocations (tracemalloc) and write a report.")
+    parser.add_argument("--profile-report", dest="profile_report", metavar="FILE",
+            default="",
+            help="Profile report filename [<program>.profile.txt].")
+
+
+def count(name, value=1):
+    """
+    Add value to counter name.
+    """
+
+    COUNTERS[name] += value
+
+
+@contextmanager
+def timer(name):
+    """
+    Accumulate wall time spent in a with block into timer name.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TIMERS[name] += time.perf_counter() - start
+
+
+def timed_iter(iterable, name):
+    """
+    Yield from iterable, accumulating time spent producing items into timer name.
+
+    Wrapping a parser generator this way separates parse time from the
+    time the consuming loop spends filtering and writing. Returns the
+    iterable unchanged when not profiling.
+    """
+
+    if not ENABLED:
+        return iterable
+    return _timed_iter(iterable, name)
+
+
+def _timed_iter(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            TIMERS[name] += time.perf_counter() - start
+            return
+        TIMERS[name] += time.perf_counter() - start
+        yield item
+
+
+def format_counters_and_timers():
+    """
+    Format collected counters and timers as text.
+    """
+
+    lines = ["Counters:"]
+    lines.extend("  {:<30} {:>14}".format(name, value) for name, value in sorted(COUNTERS.items()))
+    lines.append("Timers (s):")
+    lines.extend("  {:<30} {:>14.3f}".format(name, value) for name, value in sorted(TIMERS.items()))
+    return "\n".join(lines) + "\n"
+
+
+def run_main(main, options):
+    """
+    Run main(options), profiled if options.profile is set.
+
+    Counters and timers are logged at DEBUG level after every run, and
+    written to the profile report together with the cProfile statistics
+    or tracemalloc top allocations when profiling. Only the calling
+    process is profiled; use a single job when profiling parallel runs.
+    """
+
+    profile = getattr(options, "profile", "")
+    if not profile:
+        result = main(options)
+        if COUNTERS or TIMERS:
+            logging.debug(format_counters_and_timers())
+        return result
+
+    global ENABLED
+    ENABLED = True
+    report_filename = options.profile_report or path.basename(argv[0]) + ".profile.txt"
+    start = time.perf_counter()
+    report = StringIO()
+    try:
+        if profile == "cpu":
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(main, options)
+            finally:
+                stats = pstats.Stats(profiler, stream=report)
+                stats.sort_stats("cumulative").print_stats(40)
+        else:
+            import tracemalloc
+            tracemalloc.start(10)
+            try:
+                return main(options)
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                report.write("Traced memory: current {:.1f} MiB, peak {:.1f} MiB\n\nTop allocations:\n".format(
+                    current / 2**20, peak / 2**20))
+                for statistic in snapshot.statistics("lineno")[:30]:
+                    report.write("{}\n".format(statistic))
+    finally:
+        elapsed = time.perf_counter() - start
+        with open(report_filename, "w") as report_file:
+            report_file.write("Profile of {} ({}), wall time {:.3f} s\n\n".format(" ".join(argv), profile, elapsed))
+            report_file.write(format_counters_and_timers())
+            report_file.write("\n")
+            report_file.write(report.getvalue())
+        logging.info("Wrote %s profile report to %s", profile, report_filename)
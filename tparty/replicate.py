@@ -0,0 +1,479 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+"""
+Checksummed, parallel replication of files between hosts.
+
+Files are copied in chunks over parallel streams to a hidden temporary
+name next to the destination, verified against the source checksum,
+renamed into place and marked complete with FILE.done. Downstream
+stages wait for the marker (replicate.py wait). Files already at the
+destination with the same checksum are not copied again.
+
+The destination is a local directory or HOST:DIR. Remote destinations
+run this script on the remote host over ssh (receive, commit and
+present subcommands), so tparty must be installed there too.
+"""
+
+from sys import argv, exit, stdin
+from os import path, makedirs, replace, remove
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import argparse
+import hashlib
+import logging
+import shlex
+import time
+import os
+
+from run_ledger import record_stage, sample_name
+import profile_hooks
+
+
+# Completion marker written next to each replicated file.
+MARKER_SUFFIX = ".done"
+
+DEFAULT_CHUNK_SIZE = 16 * 2**20
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Replicate files to a local directory or HOST:DIR in parallel chunked streams, with checksum verification, atomic rename and completion markers. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest="command")
+
+    send_parser = subparsers.add_parser("send",
+        help="Replicate files to a directory, local or HOST:DIR.")
+    send_parser.add_argument("FILES", nargs="+",
+        help="Files to replicate.")
+    send_parser.add_argument("DEST",
+        help="Destination directory, local or HOST:DIR.")
+    send_parser.add_argument("-j", "--streams", dest="streams", metavar="N",
+        type=int,
+        default=4,
+        help="Parallel chunk streams [%(default)s].")
+    send_parser.add_argument("-c", "--chunk-size", dest="chunk_size", metavar="B",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Chunk size in bytes; part of the checksum [%(default)s].")
+    send_parser.add_argument("-r", "--retries", dest="retries", metavar="N",
+        type=int,
+        default=3,
+        help="Retries per chunk, and per file on checksum mismatch [%(default)s].")
+    send_parser.add_argument("--remote-command", dest="remote_command", metavar="CMD",
+        default="replicate.py",
+        help="Command running this script on remote hosts [%(default)s].")
+    send_parser.add_argument("--ssh", dest="ssh", metavar="CMD",
+        default="ssh",
+        help="ssh command, e.g. with -o ControlMaster options [%(default)s].")
+
+    wait_parser = subparsers.add_parser("wait",
+        help="Wait for the completion markers of replicated files.")
+    wait_parser.add_argument("FILES", nargs="+",
+        help="Replicated files.")
+    wait_parser.add_argument("-t", "--timeout", dest="timeout", metavar="S",
+        type=float,
+        default=3600,
+        help="Seconds to wait before giving up (0 waits forever) [%(default)s].")
+    wait_parser.add_argument("-i", "--interval", dest="interval", metavar="S",
+        type=float,
+        default=5,
+        help="Seconds between checks [%(default)s].")
+    wait_parser.add_argument("--verify", dest="verify", action="store_true",
+        default=False,
+        help="Also verify file checksums against their markers [%(default)s].")
+
+    checksum_parser = subparsers.add_parser("checksum",
+        help="Print the replication checksum of files.")
+    checksum_parser.add_argument("FILES", nargs="+",
+        help="Files to checksum.")
+    checksum_parser.add_argument("-c", "--chunk-size", dest="chunk_size", metavar="B",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Chunk size in bytes [%(default)s].")
+
+    # Run on the destination host by 'send' to remote destinations.
+    receive_parser = subparsers.add_parser("receive",
+        help="(remote) Write a chunk read from stdin to TARGET's temporary file.")
+    receive_parser.add_argument("TARGET")
+    receive_parser.add_argument("--offset", dest="offset", type=int, required=True)
+    receive_parser.add_argument("--size", dest="size", type=int, required=True)
+    commit_parser = subparsers.add_parser("commit",
+        help="(remote) Verify, rename and mark TARGET's temporary file.")
+    commit_parser.add_argument("TARGET")
+    commit_parser.add_argument("CHECKSUM")
+    present_parser = subparsers.add_parser("present",
+        help="(remote) Exit 0 if TARGET is present with CHECKSUM.")
+    present_parser.add_argument("TARGET")
+    present_parser.add_argument("CHECKSUM")
+
+    for subparser in (send_parser, wait_parser, checksum_parser, receive_parser, commit_parser, present_parser):
+        profile_hooks.add_profile_arguments(subparser)
+        subparser.add_argument("--loglevel",
+            choices=["INFO", "DEBUG"],
+            default="INFO",
+            help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+    if not options.command:
+        parser.print_help()
+        exit(1)
+
+    logging.basicConfig(level=options.loglevel, format="%(asctime)s %(levelname)s: %(message)s")
+    return options
+
+
+def temporary_filename(target):
+    """
+    Hidden temporary name of target while it is being replicated.
+
+    It does not match the pipeline's *.mzXML.gz globs.
+    """
+
+    dirname, basename = path.split(target)
+    return path.join(dirname, "." + basename + ".partial")
+
+
+def marker_filename(target):
+    """
+    Completion marker of target.
+    """
+
+    return target + MARKER_SUFFIX
+
+
+def file_checksum(filename, chunk_size=DEFAULT_CHUNK_SIZE, jobs=4):
+    """
+    Replication checksum of filename: 'sha256/CHUNK_SIZE:HEX'.
+
+    HEX is the SHA-256 of the concatenated SHA-256 digests of the
+    file's chunks, so chunks can be hashed in parallel on both ends.
+    """
+
+    size = path.getsize(filename)
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        chunk_digest = lambda offset: hashlib.sha256(os.pread(fd, chunk_size, offset)).digest()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            digests = list(executor.map(chunk_digest, range(0, size, chunk_size)))
+    finally:
+        os.close(fd)
+    return combine_digests(digests, chunk_size)
+
+
+def combine_digests(digests, chunk_size):
+    """
+    Replication checksum from chunk digests, in file order.
+    """
+
+    return "sha256/{}:{}".format(chunk_size, hashlib.sha256(b"".join(digests)).hexdigest())
+
+
+def checksum_chunk_size(checksum):
+    """
+    Chunk size of a replication checksum.
+    """
+
+    try:
+        algorithm, _ = checksum.split(":", 1)
+        return int(algorithm.split("/")[1])
+    except (ValueError, IndexError):
+        raise ValueError("Invalid replication checksum '{}'".format(checksum))
+
+
+def read_marker(target):
+    """
+    Checksum recorded in target's completion marker, '' if there is none.
+    """
+
+    try:
+        with open(marker_filename(target)) as marker:
+            return marker.read().split()[0]
+    except (OSError, IndexError):
+        return ""
+
+
+def write_marker(target, checksum):
+    """
+    Atomically write target's completion marker, in sha256sum-like format.
+    """
+
+    marker = marker_filename(target)
+    with open(marker + ".partial", "w") as out:
+        out.write("{}  {}\n".format(checksum, path.basename(target)))
+    replace(marker + ".partial", marker)
+
+
+def is_present(target, checksum):
+    """
+    True if target exists with checksum.
+
+    Trusts a matching marker; an unmarked file is checksummed, and
+    marked if it matches.
+    """
+
+    if not path.isfile(target):
+        return False
+    if read_marker(target) == checksum:
+        return True
+    if file_checksum(target, checksum_chunk_size(checksum)) == checksum:
+        write_marker(target, checksum)
+        return True
+    return False
+
+
+def receive_chunk(target, offset, data, size):
+    """
+    Write data at offset in target's temporary file, sized to size bytes.
+
+    Safe to call concurrently for different chunks of the same file.
+    """
+
+    fd = os.open(temporary_filename(target), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size > size:
+            os.ftruncate(fd, size)
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+
+
+def commit(target, checksum):
+    """
+    Verify target's temporary file against checksum, rename it into place and mark it.
+
+    Returns False (and removes the temporary file) on mismatch.
+    """
+
+    partial = temporary_filename(target)
+    actual = file_checksum(partial, checksum_chunk_size(checksum))
+    if actual != checksum:
+        logging.error("Checksum mismatch for %s: expected %s, got %s", target, checksum, actual)
+        remove(partial)
+        return False
+    if path.exists(marker_filename(target)):
+        remove(marker_filename(target))
+    replace(partial, target)
+    write_marker(target, checksum)
+    return True
+
+
+class Local_Target():
+    """
+    Destination directory on this host.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return self.directory
+
+    def target(self, filename):
+        return path.join(self.directory, path.basename(filename))
+
+    def present(self, filename, checksum):
+        return is_present(self.target(filename), checksum)
+
+    def write_chunk(self, filename, offset, data, size):
+        receive_chunk(self.target(filename), offset, data, size)
+
+    def commit(self, filename, checksum):
+        return commit(self.target(filename), checksum)
+
+
+class SSH_Target():
+    """
+    Destination directory on a remote host, written through ssh.
+
+    Each call runs this script's receive, commit or present subcommand
+    on the remote host; use ssh connection sharing (ControlMaster) to
+    avoid a new connection per chunk.
+    """
+
+    def __init__(self, host, directory, remote_command="replicate.py", ssh="ssh"):
+        self.host = host
+        self.directory = directory
+        self.remote_command = remote_command
+        self.ssh = shlex.split(ssh)
+
+    def __str__(self):
+        return self.host + ":" + self.directory
+
+    def target(self, filename):
+        return path.join(self.directory, path.basename(filename))
+
+    def run(self, arguments, data=None):
+        command = self.remote_command + " " + " ".join(shlex.quote(str(argument)) for argument in arguments)
+        return subprocess.run(self.ssh + [self.host, command], input=data,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def present(self, filename, checksum):
+        return self.run(["present", self.target(filename), checksum]).returncode == 0
+
+    def write_chunk(self, filename, offset, data, size):
+        result = self.run(["receive", self.target(filename), "--offset", offset, "--size", size], data)
+        if result.returncode:
+            raise OSError("Remote write to {} failed: {}".format(self, result.stderr.decode(errors="replace").strip()))
+
+    def commit(self, filename, checksum):
+        return self.run(["commit", self.target(filename), checksum]).returncode == 0
+
+
+def parse_destination(dest, remote_command="replicate.py", ssh="ssh"):
+    """
+    Local_Target or SSH_Target from DIR or HOST:DIR (as scp does).
+    """
+
+    host, colon, directory = dest.partition(":")
+    if colon and "/" not in host:
+        return SSH_Target(host, directory, remote_command, ssh)
+    return Local_Target(dest)
+
+
+def send_file(filename, destination, streams=4, chunk_size=DEFAULT_CHUNK_SIZE, retries=3):
+    """
+    Replicate filename to destination (Local_Target or SSH_Target).
+
+    Chunks are sent over parallel streams, each retried up to retries
+    times. The whole file is resent if the destination checksum does
+    not match. Returns the number of chunks sent (0 if already present).
+    """
+
+    checksum = file_checksum(filename, chunk_size, streams)
+    if destination.present(filename, checksum):
+        logging.info("%s already present in %s", filename, destination)
+        profile_hooks.count("files_skipped")
+        return 0
+
+    size = path.getsize(filename)
+    fd = os.open(filename, os.O_RDONLY)
+
+    def send_chunk(offset):
+        data = os.pread(fd, chunk_size, offset)
+        for attempt in range(retries + 1):
+            try:
+                destination.write_chunk(filename, offset, data, size)
+                break
+            except OSError as e:
+                if attempt == retries:
+                    raise
+                logging.warning("Retrying chunk at %s of %s: %s", offset, filename, e)
+                profile_hooks.count("chunk_retries")
+                time.sleep(2 ** attempt)
+        profile_hooks.count("bytes_sent", len(data))
+        return hashlib.sha256(data).digest()
+
+    try:
+        for attempt in range(retries + 1):
+            with ThreadPoolExecutor(max_workers=streams) as executor:
+                # An empty file still needs its (empty) temporary file.
+                digests = list(executor.map(send_chunk, range(0, size, chunk_size) or [0]))
+            if size == 0:
+                digests = []
+            if combine_digests(digests, chunk_size) != checksum:
+                raise OSError("{} changed while it was replicated".format(filename))
+            if destination.commit(filename, checksum):
+                return len(digests)
+            logging.warning("Checksum mismatch at %s for %s, resending (attempt %s)", destination, filename, attempt + 1)
+            profile_hooks.count("file_retries")
+    finally:
+        os.close(fd)
+    raise OSError("Could not replicate {} to {}: checksum mismatch after {} attempts".format(filename, destination, retries + 1))
+
+
+def wait_for_markers(filenames, timeout=3600, interval=5, verify=False):
+    """
+    Wait until all filenames have completion markers.
+
+    With verify, each file's checksum must also match its marker.
+    Returns the filenames still missing when timeout (0: never) passed.
+    """
+
+    start = time.time()
+    waiting = list(filenames)
+    while True:
+        still_waiting = []
+        for filename in waiting:
+            checksum = read_marker(filename)
+            if not checksum or not path.isfile(filename):
+                still_waiting.append(filename)
+            elif verify and file_checksum(filename, checksum_chunk_size(checksum)) != checksum:
+                logging.error("%s does not match its marker", filename)
+                still_waiting.append(filename)
+        waiting = still_waiting
+        if not waiting or (timeout and time.time() - start >= timeout):
+            return waiting
+        time.sleep(interval)
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    if options.command == "send":
+        destination = parse_destination(options.DEST, options.remote_command, options.ssh)
+        failed = 0
+        for filename in options.FILES:
+            start_time = time.time()
+            try:
+                with record_stage(sample_name(filename), "replicate", inputs=[filename]) as record:
+                    record.records = send_file(filename, destination, options.streams, options.chunk_size, options.retries)
+            except OSError as e:
+                logging.error("%s", e)
+                failed += 1
+                continue
+            if record.records:
+                seconds = time.time() - start_time
+                logging.info("Replicated %s to %s in %.1f s (%.1f MiB/s)", filename, destination,
+                        seconds, path.getsize(filename) / 2**20 / max(seconds, 1e-6))
+        exit(1 if failed else 0)
+
+    if options.command == "wait":
+        missing = wait_for_markers(options.FILES, options.timeout, options.interval, options.verify)
+        for filename in missing:
+            logging.error("No completion marker for %s", filename)
+        exit(1 if missing else 0)
+
+    if options.command == "checksum":
+        for filename in options.FILES:
+            print("{}  {}".format(file_checksum(filename, options.chunk_size), filename))
+    elif options.command == "receive":
+        makedirs(path.dirname(options.TARGET) or ".", exist_ok=True)
+        receive_chunk(options.TARGET, options.offset, stdin.buffer.read(), options.size)
+    elif options.command == "commit":
+        exit(0 if commit(options.TARGET, options.CHECKSUM) else 1)
+    elif options.command == "present":
+        exit(0 if is_present(options.TARGET, options.CHECKSUM) else 1)
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, environ, getpid, wait4, WIFSIGNALED, WTERMSIG, WEXITSTATUS
+from contextlib import contextmanager
+from datetime import datetime
+from statistics import median
+import platform
+import resource
+import argparse
+import logging
+import sqlite3
+import time
+
+import profile_hooks
+
+
+# Ledger location for all tparty programs. Recording is disabled if unset.
+LEDGER_ENVIRONMENT_VARIABLE = "TPARTY_LEDGER"
+
+CREATE_TABLE_RUNS = """CREATE TABLE IF NOT EXISTS runs(
+    started text,
+    host text,
+    pid int,
+    sample text,
+    stage text,
+    status text,
+    wall_seconds real,
+    cpu_seconds real,
+    peak_rss_bytes int,
+    input_bytes int,
+    output_bytes int,
+    records int,
+    threads int,
+    reference_bytes int,
+    cpu_set text)
+"""
+
+# Columns added after the first ledgers were created, added on first write.
+ADDED_COLUMNS = [("threads", "int"), ("reference_bytes", "int"), ("cpu_set", "text")]
+
+# Stages recorded by this process so far.
+STAGES_RECORDED = 0
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Summarize tparty run ledger: throughput per stage and outlier runs. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("LEDGER", nargs="?",
+        default=environ.get(LEDGER_ENVIRONMENT_VARIABLE, ""),
+        help="Path to run ledger (SQLite3) [${} or %(default)s].".format(LEDGER_ENVIRONMENT_VARIABLE))
+    parser.add_argument("-s", "--stage", dest="stage",
+        default="",
+        help="Only summarize STAGE.")
+    parser.add_argument("--since", dest="since", metavar="YYYY-MM-DD",
+        default="",
+        help="Only include runs started on or after this date.")
+    parser.add_argument("--outlier-factor", dest="outlier_factor", metavar="F",
+        type=float,
+        default=3.0,
+        help="Flag runs with seconds per MiB input more than F times the stage median [%(default)s].")
+    parser.add_argument("--by-placement", dest="by_placement", action="store_true",
+        default=False,
+        help="Summarize CPU-pinned and unpinned runs of each stage separately [%(default)s].")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+
+    if not options.LEDGER:
+        parser.print_help()
+        exit()
+    return options
+
+
+def sample_name(filename):
+    """
+    Sample name from any pipeline file name, e.g. 2.xml/SAMPLE.bacterial.xml -> SAMPLE.
+    """
+
+    return path.basename(filename).split(".")[0]
+
+
+def file_bytes(filenames):
+    """
+    Total size of the files that exist among filenames.
+    """
+
+    return sum(path.getsize(filename) for filename in filenames if filename and path.isfile(filename))
+
+
+def cpu_seconds():
+    """
+    User and system CPU time of this process and its waited-for children.
+    """
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process or its largest waited-for child.
+
+    This is the peak over the life of the process, not of one stage.
+    """
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    return max(own, children) * 1024
+
+
+def wait_peak_rss(process):
+    """
+    Wait for Popen process and return its peak resident set size in bytes.
+
+    The peak is that of process or its largest waited-for descendant
+    (e.g. an MPI rank) only, unlike peak_rss_bytes. Sets
+    process.returncode as Popen.wait does; use files, not pipes, for
+    its output.
+    """
+
+    _, status, usage = wait4(process.pid, 0)
+    process.returncode = -WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+    # ru_maxrss is in KiB on Linux
+    return usage.ru_maxrss * 1024
+
+
+class Stage_Record():
+    """
+    Measurements for one stage of one sample, filled in by record_stage.
+
+    The instrumented code adds to records and sets inputs/outputs.
+    Searches also set threads and reference_bytes (database size), which
+    search_sizing uses to fit its performance model, and cpu_set if
+    the search was pinned to CPUs. Stages that run in a child process set
+    peak_rss_bytes to its peak (see wait_peak_rss); otherwise the peak of
+    the process is recorded if it has not run other stages, else 0.
+    """
+
+    def __init__(self, sample, stage, inputs=(), outputs=()):
+        self.sample = sample
+        self.stage = stage
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.records = 0
+        self.threads = 0
+        self.reference_bytes = 0
+        self.cpu_set = ""
+        self.peak_rss_bytes = 0
+        self.status = "ok"
+
+
+def upgrade_runs_table(db):
+    """
+    Create the runs table, or add columns missing from an older ledger.
+    """
+
+    db.execute(CREATE_TABLE_RUNS)
+    existing = set(row[1] for row in db.execute("PRAGMA table_info(runs)"))
+    for column, column_type in ADDED_COLUMNS:
+        if column not in existing:
+            default = "''" if column_type == "text" else "0"
+            db.execute("ALTER TABLE runs ADD COLUMN {} {} DEFAULT {}".format(column, column_type, default))
+
+
+def write_record(ledger, record, started, wall, cpu, input_bytes, peak_rss):
+    """
+    Append one record to the ledger.
+
+    Every record is its own short transaction, so concurrent writers
+    from several processes only wait on each other briefly.
+    """
+
+    db = sqlite3.connect(ledger, timeout=60)
+    try:
+        with db:
+            upgrade_runs_table(db)
+            db.execute("""INSERT INTO runs
+                (started, host, pid, sample, stage, status, wall_seconds, cpu_seconds,
+                 peak_rss_bytes, input_bytes, output_bytes, records, threads, reference_bytes, cpu_set)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                (started,
+                 platform.node().split(".")[0],
+                 getpid(),
+                 record.sample,
+                 record.stage,
+                 record.status,
+                 wall,
+                 cpu,
+                 peak_rss,
+                 input_bytes,
+                 file_bytes(record.outputs),
+                 record.records,
+                 record.threads,
+                 record.reference_bytes,
+                 record.cpu_set))
+    finally:
+        db.close()
+
+
+@contextmanager
+def record_stage(sample, stage, inputs=(), outputs=(), ledger=None):
+    """
+    Context manager that records timing and resource use of a stage.
+
+    Does nothing but yield a Stage_Record unless a ledger is given or
+    configured in $TPARTY_LEDGER. Input sizes are taken before the stage
+    runs, as it may replace its inputs. Failures to write to the ledger
+    are logged but never stop the pipeline.
+    """
+
+    global STAGES_RECORDED
+    record = Stage_Record(sample, stage, inputs, outputs)
+    ledger = ledger or environ.get(LEDGER_ENVIRONMENT_VARIABLE, "")
+    if not ledger:
+        yield record
+        return
+
+    STAGES_RECORDED += 1
+    input_bytes = file_bytes(record.inputs)
+    started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    start_wall = time.time()
+    start_cpu = cpu_seconds()
+    try:
+        yield record
+    except BaseException:
+        record.status = "failed"
+        raise
+    finally:
+        wall = time.time() - start_wall
+        cpu = cpu_seconds() - start_cpu
+        peak_rss = record.peak_rss_bytes or (peak_rss_bytes() if STAGES_RECORDED == 1 else 0)
+        try:
+            write_record(ledger, record, started, wall, cpu, input_bytes, peak_rss)
+        except (sqlite3.Error, OSError) as e:
+            logging.warning("Could not write to run ledger %s: %s", ledger, e)
+
+
+def fetch_runs(ledger, stage="", since=""):
+    """
+    Fetch successful runs from ledger as a list of dicts.
+
+    The ledger is only read; columns missing from an older ledger get
+    their default values, and a ledger without runs gives an empty list.
+    """
+
+    db = sqlite3.connect(ledger, timeout=60)
+    db.row_factory = sqlite3.Row
+    if not db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='runs'").fetchone():
+        db.close()
+        return []
+    query = "SELECT * FROM runs WHERE status = 'ok'"
+    parameters = []
+    if stage:
+        query += " AND stage = ?"
+        parameters.append(stage)
+    if since:
+        query += " AND started >= ?"
+        parameters.append(since)
+    runs = [dict(row) for row in db.execute(query + " ORDER BY started", parameters)]
+    db.close()
+    for run in runs:
+        for column, column_type in ADDED_COLUMNS:
+            run.setdefault(column, "" if column_type == "text" else 0)
+    return runs
+
+
+def summarize_stages(runs):
+    """
+    Per-stage throughput summary.
+
+    Returns a list of tuples:
+      (stage, runs, median wall s, total wall s, median CPU s, max peak RSS MiB, MiB/s, records/s)
+    """
+
+    summary = []
+    for stage in sorted(set(run["stage"] for run in runs)):
+        stage_runs = [run for run in runs if run["stage"] == stage]
+        total_wall = sum(run["wall_seconds"] for run in stage_runs)
+        total_mib = sum(run["input_bytes"] for run in stage_runs) / 2**20
+        total_records = sum(run["records"] for run in stage_runs)
+        summary.append((stage,
+            len(stage_runs),
+            median(run["wall_seconds"] for run in stage_runs),
+            total_wall,
+            median(run["cpu_seconds"] for run in stage_runs),
+            max(run["peak_rss_bytes"] for run in stage_runs) / 2**20,
+            total_mib / total_wall if total_wall else 0.0,
+            total_records / total_wall if total_wall else 0.0))
+    return summary
+
+
+def find_outliers(runs, factor):
+    """
+    Find runs that are slow relative to their input size.
+
+    A run is an outlier if its seconds per MiB of input exceeds factor
+    times the median of the runs of its stage with input size. Runs
+    without input size are compared on wall time with the other runs of
+    their stage without input size. Groups of fewer than three runs are
+    not compared.
+    """
+
+    def cost(run):
+        if run["input_bytes"]:
+            return run["wall_seconds"] / (run["input_bytes"] / 2**20)
+        return run["wall_seconds"]
+
+    outliers = []
+    for stage in sorted(set(run["stage"] for run in runs)):
+        for sized in (True, False):
+            group = [run for run in runs if run["stage"] == stage and bool(run["input_bytes"]) == sized]
+            if len(group) < 3:
+                continue
+            typical = median(cost(run) for run in group)
+            for run in group:
+                if typical and cost(run) > factor * typical:
+                    outliers.append((run, cost(run) / typical))
+    return outliers
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    runs = fetch_runs(options.LEDGER, options.stage, options.since)
+    logging.info("Read %s runs from %s", len(runs), options.LEDGER)
+    if options.by_placement:
+        for run in runs:
+            run["stage"] += " (pinned)" if run.get("cpu_set") else " (unpinned)"
+
+    print("stage", "runs", "median_wall_s", "total_wall_s", "median_cpu_s", "max_rss_MiB", "MiB_per_s", "records_per_s", sep="\t")
+    for row in summarize_stages(runs):
+        print(row[0], row[1], *("{:.2f}".format(value) for value in row[2:]), sep="\t")
+
+    outliers = find_outliers(runs, options.outlier_factor)
+    if outliers:
+        print()
+        print("OUTLIERS", "stage", "sample", "host", "started", "wall_s", "times_median", sep="\t")
+        for run, ratio in outliers:
+            print("", run["stage"], run["sample"], run["host"], run["started"],
+                    "{:.2f}".format(run["wall_seconds"]), "{:.1f}".format(ratio), sep="\t")
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
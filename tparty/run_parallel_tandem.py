@@ -20,16 +20,27 @@
 #  PERFORMANCE OF THIS SOFTWARE.
 
 from sys import argv, exit
-from subprocess import Popen, PIPE
+from subprocess import Popen
 from glob import glob
-from os import path, getcwd, chdir, mkdir, SEEK_END, listdir
-from tempfile import mkdtemp
+from os import path, getcwd, chdir, mkdir, makedirs, SEEK_END, listdir, environ
+from functools import partial
+from tempfile import mkdtemp, TemporaryFile
 import shutil
 import shlex
 import subprocess
 import argparse
 import logging
 
+from run_ledger import record_stage, sample_name, wait_peak_rss
+import profile_hooks
+from staging import Staging_Pipeline, Background_Mover, Staged_Sample
+from cpu_placement import pinned_cpus, pinned_command, format_cpulist, LEASE_ENVIRONMENT_VARIABLE, DEFAULT_LEASE_FILE
+from search_sizing import size_search
+
+
+# MPI process count when not specified, or when --threads auto has too little history.
+DEFAULT_THREADS = 10
+
 
 def parse_commandline():
     """
@@ -48,11 +59,36 @@ def parse_commandline():
             default="/storage/boulund/TTT/ms_refdb/ms_refdb.fasta",
             help="Database to search against [%(default)s].")
     parser.add_argument("-n", "--threads", dest="threads",
-            default=10,
-            help="Number of MPI processes to use [%(default)s].")
+            default=DEFAULT_THREADS,
+            help="Number of MPI processes to use, or 'auto' to size each search from its spectrum count, the database size and earlier runs in the run ledger [%(default)s].")
+    parser.add_argument("--max-threads", metavar="N", dest="max_threads",
+            type=int,
+            default=0,
+            help="Maximum number of MPI processes with --threads auto [number of CPUs].")
+    parser.add_argument("--shared-node", dest="shared_node", action="store_true",
+            default=False,
+            help="With --threads auto, size for node throughput, as searches of similar samples run side by side on the node, instead of for the latency of each search within --max-threads [%(default)s].")
     parser.add_argument("-x", "--xtandem", dest="xtandem_path",
             default="/home/boulund/research/TTT/src/parallel_tandem/src/parallel_tandem_10-12-01-1/bin/tandem.exe",
             help="Path to parallel X!!Tandem executable [%(default)s].")
+    parser.add_argument("--scratch", metavar="DIR", dest="scratch",
+            default="",
+            help="Stage spectra and write X!!Tandem output in DIR (e.g. on a local scratch disk); outputs are moved to their final location in the background [current dir].")
+    parser.add_argument("--prefetch", metavar="N", dest="prefetch",
+            type=int,
+            default=0,
+            help="Number of samples to stage ahead while searching [%(default)s].")
+    parser.add_argument("--scratch-budget", metavar="GB", dest="scratch_budget",
+            type=float,
+            default=0,
+            help="Maximum disk space for prefetched spectra in GB, 0 means unlimited [%(default)s].")
+    parser.add_argument("--pin", dest="pin", action="store_true",
+            default=False,
+            help="Pin each search to its own set of CPUs, on one NUMA node if possible, leased in a lock file shared by concurrent searches [%(default)s].")
+    parser.add_argument("--lease-file", metavar="FILE", dest="lease_file",
+            default=environ.get(LEASE_ENVIRONMENT_VARIABLE, DEFAULT_LEASE_FILE),
+            help="CPU lease file for --pin [${} or %(default)s].".format(LEASE_ENVIRONMENT_VARIABLE))
+    profile_hooks.add_profile_arguments(parser)
     parser.add_argument("--loglevel", 
             choices=["INFO","DEBUG"],
             default="DEBUG",
@@ -63,19 +99,31 @@ def parse_commandline():
         exit()
 
     options = parser.parse_args()
+    if options.threads != "auto":
+        try:
+            options.threads = int(options.threads)
+        except ValueError:
+            parser.error("--threads must be a number or 'auto'")
     logging.basicConfig(level=options.loglevel, format='%(asctime)s %(levelname)s: %(message)s')
     return options
 
 
-def run_xtandem(input_xml_filename, output_xml_filename, options):
+def run_xtandem(input_xml_filename, output_xml_filename, options, threads=None, cpus=None):
     """
     Runs X!!tandem on a single mzXML file defined in an input_{samplename}.xml.
+
+    With cpus, mpirun and its ranks are restricted to those CPUs. Returns
+    the peak resident set size of the largest rank in bytes.
     """
-    xtandem_call = shlex.split("mpirun -n {xtandem_threads} {xtandem_path} {inputxml}".format(xtandem_threads=options.threads, xtandem_path=options.xtandem_path, inputxml=input_xml_filename))
+    xtandem_call = shlex.split("mpirun -n {xtandem_threads} {binding}{xtandem_path} {inputxml}".format(xtandem_threads=threads or options.threads, binding="--bind-to none " if cpus else "", xtandem_path=options.xtandem_path, inputxml=input_xml_filename))
     logging.debug("X!!Tandem call: %s", " ".join(xtandem_call))
     logging.info("Running X!!Tandem on %s", input_xml_filename)
-    xtandem = Popen(xtandem_call, stdout=PIPE, stderr=PIPE)
-    xtandem_output = xtandem.communicate()
+    with TemporaryFile() as stdout, TemporaryFile() as stderr:
+        xtandem = Popen(pinned_command(xtandem_call, cpus), stdout=stdout, stderr=stderr)
+        peak_rss = wait_peak_rss(xtandem)
+        stdout.seek(0)
+        stderr.seek(0)
+        xtandem_output = (stdout.read(), stderr.read())
     try: 
         logging.debug("Expecting X!!Tandem output somewhere here: %s", output_xml_filename)
         xtandem_output_filename = glob(path.splitext(output_xml_filename)[0]+".*.xml")[-1]
@@ -107,6 +155,7 @@ def run_xtandem(input_xml_filename, output_xml_filename, options):
     # Move annoyingly named X!!Tandem output file to requested output location.
     logging.debug("Moving X!!Tandem outputfile '%s' to '%s", xtandem_output_filename, output_xml_filename)
     shutil.move(xtandem_output_filename, output_xml_filename)
+    return peak_rss
 
 
 def create_misc_xtandem_files(options):
@@ -125,34 +174,62 @@ def create_misc_xtandem_files(options):
     logging.debug("Wrote taxonomy.xml with refdb='%s'", options.db)
 
 
+def stage_xtandem_input_file(filename, output_filename, scratch_dir="", threads=DEFAULT_THREADS, max_threads=0, database_bytes=0, shared_node=False):
+    """
+    Stages the spectra of one input file and creates its input_FILENAME.xml.
+
+    With scratch_dir, the spectra are unpacked and X!!Tandem writes its
+    output there instead of in the working directory.
+    With threads 'auto', the MPI process count is sized from the staged
+    spectra and database_bytes (see search_sizing); only then are the
+    spectra counted for the run ledger.
+
+    Returns (Staged_Sample, [staged spectrum file]).
+    """
+
+    filename_abspath = path.abspath(filename)
+    samplename = path.splitext(path.basename(filename))[0]
+    spectrum_path = path.join(scratch_dir, samplename)
+
+    if filename.endswith((".gz", ".GZ")):
+        logging.debug("Filename %s ends with .gz or .GZ", filename)
+        gunzip_call = ["gunzip", "-c", filename_abspath]
+        logging.debug("Gunzipping %s into %s", filename, spectrum_path)
+        with open(spectrum_path, "w") as gunzipped:
+            logging.debug("gunzip call: %s", gunzip_call)
+            subprocess.call(gunzip_call, stdout=gunzipped)
+        logging.debug("Unpacked the file to %s", spectrum_path)
+    else:
+        spectrum_path = filename_abspath
+
+    spectra = 0
+    if threads == "auto":
+        threads, spectra = size_search(spectrum_path, database_bytes, "parallel_xtandem", DEFAULT_THREADS, max_threads, processes=True,
+                shared_node=shared_node)
+
+    if not output_filename:
+        output_filename = "output_"+samplename+".xml"
+    xtandem_output_filename = path.join(scratch_dir, path.basename(output_filename)) if scratch_dir else output_filename
+
+    logging.debug("Creating input XML for '%s'", filename)
+    input_xml_filename = "input_"+samplename+".xml"
+    with open(input_xml_filename, "w") as input_xml:
+        input_xml.write(INPUT_XML.format(input=spectrum_path, output=xtandem_output_filename))
+    logging.debug("Wrote file %s for sample %s", input_xml_filename, samplename)
+
+    staged_files = [spectrum_path] if spectrum_path != filename_abspath else []
+    staged_sample = Staged_Sample(input_xml_filename, xtandem_output_filename, output_filename, spectrum_path, spectra, int(threads), None)
+    return staged_sample, staged_files
+
+
 def generate_xtandem_input_files(inputfiles):
     """
     Creates input_FILENAME.xml for each input file.
     """
 
     for filename in inputfiles:
-        filename_abspath = path.abspath(filename)
-        samplename = path.splitext(path.basename(filename))[0]
-
-        if filename.endswith((".gz", ".GZ")):
-            logging.debug("Filename %s ends with .gz or .GZ", filename)
-            gunzip_call = ["gunzip", "-c", filename_abspath]
-            logging.debug("Gunzipping %s into %s", filename, samplename)
-            with open(samplename, "w") as gunzipped:
-                logging.debug("gunzip call: %s", gunzip_call)
-                subprocess.call(gunzip_call, stdout=gunzipped)
-            logging.debug("Unpacked the file to %s", samplename)
-
-        logging.debug("Creating input XML for '%s'", filename)
-        input_xml_filename = "input_"+samplename+".xml"
-        with open(input_xml_filename, "w") as input_xml:
-            if options.output:
-                output = options.output
-            else:
-                output = "output_"+samplename+".xml"
-            input_xml.write(INPUT_XML.format(input=samplename, output=output))
-        logging.debug("Wrote file %s for sample %s", input_xml_filename, samplename)
-        yield input_xml_filename, output
+        staged_sample, _ = stage_xtandem_input_file(filename, options.output, threads=options.threads)
+        yield staged_sample.input_xml, staged_sample.xtandem_output
 
 
 # COMPLETE INPUT FILES FOR X!!TANDEM AS STRINGS
@@ -252,9 +329,43 @@ INPUT_XML = """<?xml version="1.0"?>
 </bioml>"""
 
 
+def main(options):
+    """
+    Main function.
+    """
+
+    if options.scratch:
+        makedirs(options.scratch, exist_ok=True)
+    create_misc_xtandem_files(options)
+    database_bytes = path.getsize(options.db) if path.isfile(options.db) else 0
+    stage_function = partial(stage_xtandem_input_file,
+            output_filename=options.output,
+            scratch_dir=options.scratch,
+            threads=options.threads,
+            max_threads=options.max_threads,
+            shared_node=options.shared_node,
+            database_bytes=database_bytes)
+    samples = Staging_Pipeline(options.FILES, stage_function,
+            depth=options.prefetch,
+            disk_budget=options.scratch_budget * 1e9,
+            cleanup=bool(options.scratch))
+    mover = Background_Mover()
+
+    for filename, sample in profile_hooks.timed_iter(samples, "staging"):
+        with record_stage(sample_name(filename), "parallel_xtandem", inputs=[filename], outputs=[sample.xtandem_output]) as record:
+            record.records = sample.spectra
+            record.threads = sample.threads
+            record.reference_bytes = database_bytes
+            with pinned_cpus(sample.threads if options.pin else 0, options.lease_file) as cpus, \
+                    profile_hooks.timer("search"):
+                record.cpu_set = format_cpulist(cpus) if cpus else ""
+                record.peak_rss_bytes = run_xtandem(sample.input_xml, sample.xtandem_output, options, sample.threads, cpus)
+            profile_hooks.count("samples")
+        samples.release(filename)
+        mover.move(sample.xtandem_output, sample.final_output)
+    with profile_hooks.timer("move_outputs"):
+        mover.wait()
+
 if __name__ == "__main__":
     options = parse_commandline()
-
-    for inputxml, outputxml in generate_xtandem_input_files(options.FILES):
-        create_misc_xtandem_files(options)
-        xtandem_output_filename = run_xtandem(inputxml, outputxml, options)
+    profile_hooks.run_main(main, options)
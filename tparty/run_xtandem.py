@@ -20,15 +20,30 @@
 #  PERFORMANCE OF THIS SOFTWARE.
 
 from sys import argv, exit
-from subprocess import Popen, PIPE
+from subprocess import Popen
 from glob import glob
-from os import path, getcwd, chdir, mkdir, SEEK_END, listdir
-from tempfile import mkdtemp
+from os import path, getcwd, chdir, mkdir, SEEK_END, listdir, makedirs, environ, remove, replace
+from functools import partial
+from tempfile import mkdtemp, TemporaryFile
 import shutil
 import shlex
 import subprocess
 import argparse
 import logging
+import math
+import re
+import time
+
+from run_ledger import record_stage, sample_name, fetch_runs, wait_peak_rss, LEDGER_ENVIRONMENT_VARIABLE
+import profile_hooks
+from staging import Staging_Pipeline, Background_Mover, Staged_Sample
+from cpu_placement import pinned_cpus, pinned_command, format_cpulist, LEASE_ENVIRONMENT_VARIABLE, DEFAULT_LEASE_FILE
+from search_sizing import size_search, reference_bytes, fit_performance_model, wall_seconds
+from dedup_fasta import iter_fasta_records, taxon_databases
+
+
+# Thread count when not specified, or when --threads auto has too little history.
+DEFAULT_THREADS = 10
 
 
 INPUT_XML = """<?xml version="1.0"?>
@@ -41,6 +56,22 @@ INPUT_XML = """<?xml version="1.0"?>
     <note type="input" label="refine, maximum valid expectation value">{evalue_refine}</note>
 	<note type="input" label="output, path">{output}</note>
     <note type="input" label="output, maximum valid expectation value">{evalue_output}</note>
+{extra}</bioml>"""
+
+# Fast first pass of --two-pass searches: no refinement (and therefore no
+# unanticipated cleavage or potential modifications in refinement).
+FIRST_PASS_NOTES = """	<note type="input" label="refine">no</note>
+"""
+
+# Start tags whose expect attribute rescale_expect adjusts.
+EXPECT_TAG = re.compile(r"<(group|protein|domain)\b[^>]*>")
+EXPECT_ATTRIBUTE = re.compile(r' expect="([^"]*)"')
+
+TAXONOMY_XML = """<?xml version="1.0"?>
+<bioml label="x! taxon-to-file matching list">
+	<taxon label="{taxon}">
+		<file format="peptide" URL="{database}"/>
+	</taxon>
 </bioml>"""
 
 
@@ -67,18 +98,69 @@ def parse_commandline():
             required=True,
             help="Path to X!Tandem default_parameters.xml [%(default)s].")
     parser.add_argument("-n", "--threads", dest="threads",
-            default=10,
-            help="Number of threads to use [%(default)s].")
+            default=DEFAULT_THREADS,
+            help="Number of threads to use, or 'auto' to size each search from its spectrum count, the database size and earlier runs in the run ledger [%(default)s].")
+    parser.add_argument("--max-threads", metavar="N", dest="max_threads",
+            type=int,
+            default=0,
+            help="Maximum number of threads with --threads auto [number of CPUs].")
+    parser.add_argument("--shared-node", dest="shared_node", action="store_true",
+            default=False,
+            help="With --threads auto, size for node throughput, as searches of similar samples run side by side on the node, instead of for the latency of each search within --max-threads [%(default)s].")
     parser.add_argument("-e", "--evalue", metavar="e", dest="evalue",
             type=float,
             default=1.0,
             help="Maximum e-value (both refine and output filters) [%(default)s].")
+    parser.add_argument("--prefilter", dest="prefilter", action="store_true",
+            default=False,
+            help="Remove MS1 scans and scans failing the spectrum thresholds in the default parameters before searching [%(default)s].")
+    parser.add_argument("--mgf", dest="mgf", action="store_true",
+            default=False,
+            help="Search a compact MGF with only searchable MS2 scans, reduced to the 'total peaks' most intense peaks within the 'dynamic range' (implies --prefilter). The reduction approximates, but is not equivalent to, X!Tandem's own spectrum conditioning [%(default)s].")
+    parser.add_argument("--cluster", dest="cluster", action="store_true",
+            default=False,
+            help="Search one consensus spectrum per cluster of redundant MS2 scans (see cluster_spectra.py) and expand the results back to the original scans (implies --mgf) [%(default)s].")
+    parser.add_argument("--library", metavar="FILE", dest="library",
+            default="",
+            help="Spectral library (see spectral_library.py); spectra matching it take the library PSM and only the others are searched (implies --mgf).")
+    parser.add_argument("--min-cosine", metavar="C", dest="min_cosine",
+            type=float,
+            default=0.9,
+            help="Minimum cosine similarity for a --library match [%(default)s].")
+    parser.add_argument("--slim", dest="slim", action="store_true",
+            default=False,
+            help="Slim the X!Tandem output down to PSM groups, domains and parameters [%(default)s].")
+    parser.add_argument("--two-pass", dest="two_pass", action="store_true",
+            default=False,
+            help="First search the full database without refinement, then run the full search against only the proteins found [%(default)s].")
+    parser.add_argument("--first-pass-evalue", metavar="e", dest="first_pass_evalue",
+            type=float,
+            default=0.01,
+            help="Maximum e-value for candidate proteins in the first pass of --two-pass [%(default)s].")
+    parser.add_argument("--scratch", metavar="DIR", dest="scratch",
+            default="",
+            help="Stage spectra and write X!Tandem output in DIR (e.g. on a local scratch disk); outputs are moved to their final location in the background [current dir].")
+    parser.add_argument("--prefetch", metavar="N", dest="prefetch",
+            type=int,
+            default=0,
+            help="Number of samples to stage ahead while searching [%(default)s].")
+    parser.add_argument("--scratch-budget", metavar="GB", dest="scratch_budget",
+            type=float,
+            default=0,
+            help="Maximum disk space for prefetched spectra in GB, 0 means unlimited [%(default)s].")
     parser.add_argument("-x", "--xtandem", dest="xtandem_path",
             default="/storage/TTT/bin/tandem.exe",
             help="Path to X!Tandem executable [%(default)s].")
     parser.add_argument("--logfile", metavar="LOGFILE",
             default="",
             help="Log to LOGFILE instead of STDOUT.")
+    parser.add_argument("--pin", dest="pin", action="store_true",
+            default=False,
+            help="Pin each search to its own set of CPUs, on one NUMA node if possible, leased in a lock file shared by concurrent searches [%(default)s].")
+    parser.add_argument("--lease-file", metavar="FILE", dest="lease_file",
+            default=environ.get(LEASE_ENVIRONMENT_VARIABLE, DEFAULT_LEASE_FILE),
+            help="CPU lease file for --pin [${} or %(default)s].".format(LEASE_ENVIRONMENT_VARIABLE))
+    profile_hooks.add_profile_arguments(parser)
     parser.add_argument("--loglevel", 
             choices=["INFO","DEBUG"],
             default="DEBUG",
@@ -89,6 +171,13 @@ def parse_commandline():
         exit()
 
     options = parser.parse_args()
+    if options.cluster and options.library:
+        parser.error("--cluster and --library cannot be combined")
+    if options.threads != "auto":
+        try:
+            options.threads = int(options.threads)
+        except ValueError:
+            parser.error("--threads must be a number or 'auto'")
     logging_format = "%(asctime)s %(levelname)s: %(message)s"
     if options.logfile:
         logging.basicConfig(level=options.loglevel, filename=options.logfile, format=logging_format)
@@ -102,30 +191,46 @@ def parse_commandline():
     return options
 
 
-def run_xtandem(input_xml_filename, output_xml_filename, xtandem_executable):
+def bioml_complete(xmlfile):
+    """
+    True if BIOML file xmlfile exists and ends with its closing tag.
+    """
+
+    try:
+        with open(xmlfile, "rb") as xml:
+            xml.seek(max(xml.seek(0, SEEK_END) - 64, 0))
+            return xml.read().rstrip().endswith(b"</bioml>")
+    except FileNotFoundError:
+        return False
+
+
+def run_xtandem(input_xml_filename, output_xml_filename, xtandem_executable, cpus=None):
     """
     Runs X!tandem on a single mzXML file defined in an input_{samplename}.xml.
+
+    With cpus, X!Tandem is restricted to those CPUs. Returns the peak
+    resident set size of X!Tandem in bytes.
     """
     xtandem_call = shlex.split("{xtandem_path} {inputxml}".format(xtandem_path=xtandem_executable, inputxml=input_xml_filename))
     logging.debug("X!tandem call: %s", " ".join(xtandem_call))
     logging.info("Running X!tandem on %s", input_xml_filename)
-    xtandem = Popen(xtandem_call, stdout=PIPE, stderr=PIPE)
-    xtandem_output = xtandem.communicate()
+    with TemporaryFile() as stdout, TemporaryFile() as stderr:
+        xtandem = Popen(pinned_command(xtandem_call, cpus), stdout=stdout, stderr=stderr)
+        peak_rss = wait_peak_rss(xtandem)
+        stdout.seek(0)
+        stderr.seek(0)
+        xtandem_output = (stdout.read(), stderr.read())
 
     if xtandem.returncode != 0:
         logging.error("X!Tandem error: %s\n%s", xtandem_output[0].decode("utf-8"), 
                 xtandem_output[1].decode("utf-8"))
-        try:
-            with open(output_xml_filename, "rb") as outputxml:
-                outputxml.seek(-9, SEEK_END)
-                last_line = outputxml.readline()
-            if last_line == "</bioml>\n":
-                logging.warning("X!tandem returned non-zero exit code, but outputfile looks OK!")
-            else:
-                logging.error("X!tandem returned non-zero exit code, and outputfile appears incomplete!")
-        except FileNotFoundError as e:
-            logging.error("Unrecoverable X!Tandem error: %s", e)
+        if not path.isfile(output_xml_filename):
+            logging.error("Unrecoverable X!Tandem error: no output file %s", output_xml_filename)
             exit(1)
+        if bioml_complete(output_xml_filename):
+            logging.warning("X!tandem returned non-zero exit code, but outputfile looks OK!")
+        else:
+            logging.error("X!tandem returned non-zero exit code, and outputfile appears incomplete!")
     else:
         logging.info("Finished running X!Tandem on %s.", input_xml_filename)
 
@@ -134,41 +239,307 @@ def run_xtandem(input_xml_filename, output_xml_filename, xtandem_executable):
         log.write(xtandem_output[0].decode("utf8"))
         log.write("\nSTDERR:\n")
         log.write(xtandem_output[1].decode("utf8"))
+    return peak_rss
+
+
+def write_input_xml(input_xml_filename, default_parameters, taxonomy, taxon, threads, spectrum_path, output_filename, max_evalue, extra=""):
+    """
+    Writes an X!Tandem input XML file.
+    """
+
+    with open(input_xml_filename, "w") as input_xml:
+        input_xml.write(INPUT_XML.format(defaults=default_parameters, 
+            taxonomy=taxonomy,
+            taxon=taxon,  
+            threads=threads,
+            input=spectrum_path, 
+            output=output_filename,
+            evalue_refine=max_evalue,
+            evalue_output=max_evalue,
+            extra=extra))
+
+
+def write_reduced_database(database_files, proteins, outfilename):
+    """
+    Writes the records of proteins (X!Tandem labels) in database_files to outfilename.
+
+    Labels are matched on the full FASTA header, or on the first word
+    (accession) in case X!Tandem shortened the description.
+    Returns the number of written proteins.
+    """
+
+    headers = set(protein.encode("utf-8") for protein in proteins)
+    accessions = set(header.split()[0] for header in headers if header.strip())
+    written = 0
+    with open(outfilename, "wb") as reduced:
+        for database_file in database_files:
+            with open(database_file, "rb") as fasta:
+                for offset, length, header, sequence in iter_fasta_records(fasta):
+                    if header in headers or (header.strip() and header.split()[0] in accessions):
+                        reduced.write(b">" + header + b"\n" + sequence + b"\n")
+                        written += 1
+    return written
+
+
+def estimate_one_pass_seconds(taxon, spectra, database_bytes, threads):
+    """
+    Estimated wall time of an ordinary search from earlier runs in the run ledger.
+
+    Returns None without a ledger or enough earlier runs.
+    """
+
+    ledger = environ.get(LEDGER_ENVIRONMENT_VARIABLE, "")
+    if not ledger or not path.isfile(ledger) or not spectra:
+        return None
+    model = fit_performance_model(fetch_runs(ledger, "xtandem_"+taxon))
+    if model is None:
+        return None
+    return wall_seconds(model, spectra, database_bytes, threads)
+
+
+def log_prefilter_effect(samplename, stats, search_seconds, taxon, database_bytes, threads):
+    """
+    Log the prefilter wall time next to the change in search time.
+
+    The search time without prefiltering is estimated from earlier runs
+    in the run ledger for the MS/MS scans of the input (see
+    estimate_one_pass_seconds); without an estimate, only the prefilter
+    and search times are logged.
+    """
+
+    msms_scans = stats.scans_in - stats.ms1_removed
+    estimate = estimate_one_pass_seconds(taxon, msms_scans, database_bytes, threads)
+    if estimate:
+        logging.info("Prefilter of %s took %.1f s; search of %s of %s MS/MS scans took %.1f s, estimated %.1f s "
+                "without prefilter: %.1f s saved in the search, %.1f s net",
+                samplename, stats.seconds, stats.scans_out, msms_scans, search_seconds, estimate,
+                estimate - search_seconds, estimate - search_seconds - stats.seconds)
+    else:
+        logging.info("Prefilter of %s took %.1f s; search of %s of %s MS/MS scans took %.1f s "
+                "(no run ledger estimate of the search without prefilter)",
+                samplename, stats.seconds, stats.scans_out, msms_scans, search_seconds)
+
+
+def rescale_expect(xmlfile, factor):
+    """
+    Multiply the e-values in X!Tandem BIOML xmlfile by factor, in place.
+
+    X!Tandem e-values grow about in proportion to the database size, so
+    this maps e-values from a search of a reduced database to the scale
+    of the full database (factor = full size / reduced size). Group and
+    domain expect attributes are e-values; protein expect attributes
+    are log10 e-values and get log10(factor) added. The protein values
+    are an approximation, as X!Tandem combines the peptide e-values.
+    """
+
+    log_factor = math.log10(factor)
+
+    def rescale_attribute(match, protein):
+        value = float(match.group(1))
+        if protein:
+            return ' expect="{:.1f}"'.format(value + log_factor)
+        return ' expect="{:.1e}"'.format(value * factor)
+
+    def rescale_tag(match):
+        protein = match.group(1) == "protein"
+        return EXPECT_ATTRIBUTE.sub(lambda attribute: rescale_attribute(attribute, protein), match.group(0), count=1)
+
+    tmp_xmlfile = xmlfile + ".partial"
+    with open(xmlfile) as xml, open(tmp_xmlfile, "w") as rescaled:
+        for line in xml:
+            rescaled.write(EXPECT_TAG.sub(rescale_tag, line) if "expect=" in line else line)
+    replace(tmp_xmlfile, xmlfile)
 
 
-def generate_xtandem_input_files(inputfiles, taxon, default_parameters, taxonomy, threads, output_filename, max_evalue):
+def run_two_pass_search(sample, options, database_files, database_bytes, cpus=None):
+    """
+    Searches a staged sample in two passes.
+
+    The first pass searches the full database without refinement and
+    collects proteins with e-value below options.first_pass_evalue, using
+    the same filtering as create_unique_protein_list. The ordinary search
+    then runs against a per-sample FASTA of only those proteins, through
+    a temporary taxonomy.xml. X!Tandem e-values depend on the database
+    size, so the second pass uses options.evalue scaled down by the
+    size ratio of the reduced to the full database, and its e-values are
+    scaled back up afterwards (see rescale_expect); the output then uses
+    the same e-value scale and cutoff as an ordinary search.
+    Temporary files are removed afterwards; the time saved compared with
+    an estimated ordinary search is logged. If the first pass output is
+    missing or incomplete, the ordinary search runs against the full
+    database instead. Returns the larger peak resident set size of the
+    two X!Tandem runs in bytes.
+    """
+
+    from create_unique_protein_list import get_unique_proteins
+
+    workdir = path.dirname(sample.xtandem_output)
+    samplename = path.basename(sample.input_xml)[len("input_"):-len(".xml")]
+    first_pass_input = "first_pass_" + path.basename(sample.input_xml)
+    first_pass_output = path.join(workdir, "first_pass_" + path.basename(sample.xtandem_output))
+    reduced_database = path.abspath(path.join(workdir, "reduced_" + samplename + ".fasta"))
+    reduced_taxonomy = path.join(workdir, "taxonomy_" + samplename + ".xml")
+
+    start_time = time.time()
+    write_input_xml(first_pass_input, options.default_parameters, options.taxonomy, options.taxon, 
+            sample.threads, sample.spectra_file, first_pass_output, options.first_pass_evalue, FIRST_PASS_NOTES)
+    with profile_hooks.timer("first_pass"):
+        first_pass_rss = run_xtandem(first_pass_input, first_pass_output, options.xtandem_path, cpus)
+    first_pass_seconds = time.time() - start_time
+
+    if not bioml_complete(first_pass_output):
+        logging.warning("First pass output %s is missing or incomplete; searching %s against the full database",
+                first_pass_output, samplename)
+        for temporary_file in (first_pass_input, first_pass_output):
+            if path.exists(temporary_file):
+                remove(temporary_file)
+        return max(first_pass_rss, run_xtandem(sample.input_xml, sample.xtandem_output, options.xtandem_path, cpus))
+
+    candidates = get_unique_proteins(first_pass_output, options.first_pass_evalue, 0.0)
+    if not candidates:
+        logging.warning("First pass found no proteins with e-value below %s for %s; keeping first pass result", 
+                options.first_pass_evalue, samplename)
+        shutil.move(first_pass_output, sample.xtandem_output)
+        return first_pass_rss
+    with profile_hooks.timer("reduce_database"):
+        proteins = write_reduced_database(database_files, candidates, reduced_database)
+    with open(reduced_taxonomy, "w") as taxonomy:
+        taxonomy.write(TAXONOMY_XML.format(taxon=options.taxon, database=reduced_database))
+    reduced_bytes = path.getsize(reduced_database)
+    expect_factor = max(database_bytes / reduced_bytes, 1.0) if reduced_bytes else 1.0
+
+    second_pass_start = time.time()
+    write_input_xml(sample.input_xml, options.default_parameters, reduced_taxonomy, options.taxon, 
+            sample.threads, sample.spectra_file, sample.xtandem_output, options.evalue / expect_factor)
+    second_pass_rss = run_xtandem(sample.input_xml, sample.xtandem_output, options.xtandem_path, cpus)
+    if bioml_complete(sample.xtandem_output):
+        with profile_hooks.timer("rescale_expect"):
+            rescale_expect(sample.xtandem_output, expect_factor)
+    second_pass_seconds = time.time() - second_pass_start
+    total_seconds = time.time() - start_time
+
+    for temporary_file in (first_pass_input, first_pass_output, reduced_database, reduced_taxonomy):
+        if path.exists(temporary_file):
+            remove(temporary_file)
+
+    logging.info("Two-pass search of %s: first pass %.1f s, reduced database %s proteins (%.1f MiB, %.2f%% of full), "
+            "second pass %.1f s (e-values scaled by %.1f), total %.1f s", 
+            samplename, first_pass_seconds, proteins, reduced_bytes / 2**20, 
+            100.0 * reduced_bytes / database_bytes if database_bytes else 0.0, second_pass_seconds, expect_factor, total_seconds)
+    estimate = estimate_one_pass_seconds(options.taxon, sample.spectra, database_bytes, sample.threads)
+    if estimate:
+        logging.info("Two-pass search of %s saved %.1f s (%.0f%%) compared with an estimated %.1f s one-pass search",
+                samplename, estimate - total_seconds, 100.0 * (1 - total_seconds / estimate), estimate)
+    return max(first_pass_rss, second_pass_rss)
+
+
+def stage_xtandem_input_file(filename, taxon, default_parameters, taxonomy, threads, output_filename, max_evalue, prefilter=False, mgf=False, scratch_dir="", max_threads=0, database_bytes=0, cluster=False, library=None, min_cosine=0.9, shared_node=False):
+    """
+    Stages the spectra of one input file and creates its input_FILENAME.xml.
+
+    With prefilter, the (possibly gzipped) mzXML is streamed through 
+    prefilter_mzxml into the working directory instead of just gunzipped.
+    With mgf, it is instead converted to a peak picked MGF file.
+    With cluster, redundant scans are merged into consensus spectra in
+    the MGF file, with the cluster map next to it (see cluster_map).
+    With library (a Spectral_Library), only spectra without a library
+    match are written to the MGF file; the library PSMs of the others
+    are written next to it (see library_hits_file).
+    With scratch_dir, the spectra are staged and X!Tandem writes its
+    output there instead of in the working directory.
+    With threads 'auto', the thread count is sized from the staged
+    spectra and database_bytes (see search_sizing). The spectra are
+    counted for the run ledger only when staging or sizing does so.
+    The prefilter is recorded as its own stage in the run ledger.
+
+    Returns (Staged_Sample, [staged spectrum file]).
+    """
+
+    # The spectrum modules import NumPy and lxml, so they are only
+    # imported for the options that use them.
+    if prefilter or mgf:
+        from prefilter_mzxml import read_spectrum_filter
+        spectrum_filter = read_spectrum_filter(default_parameters)
+        logging.debug("Prefiltering spectra with %s", spectrum_filter)
+    if mgf:
+        from mzxml_spectra import convert_mzxml_to_mgf, read_peak_conditioning
+        peak_conditioning = read_peak_conditioning(default_parameters)
+        logging.debug("Reducing peaks with %s", peak_conditioning)
+
+    filename_abspath = path.abspath(filename)
+    samplename = path.splitext(path.basename(filename))[0]
+    spectrum_path = path.join(scratch_dir, samplename)
+
+    spectra = None
+    prefilter_stats = None
+    if cluster:
+        from cluster_spectra import write_clusters, cluster_map
+        spectrum_path = path.splitext(spectrum_path)[0] + ".mgf"
+        logging.debug("Clustering %s into %s", filename, spectrum_path)
+        _, spectra = write_clusters([filename_abspath], spectrum_path, cluster_map(spectrum_path), default_parameters)
+    elif library is not None:
+        from spectral_library import library_prefilter, library_hits_file
+        spectrum_path = path.splitext(spectrum_path)[0] + ".mgf"
+        logging.debug("Matching %s against the spectral library into %s", filename, spectrum_path)
+        scans, matched = library_prefilter(filename_abspath, library, spectrum_path, library_hits_file(spectrum_path), default_parameters, min_cosine)
+        spectra = scans - matched
+    elif mgf:
+        spectrum_path = path.splitext(spectrum_path)[0] + ".mgf"
+        logging.debug("Converting %s into %s", filename, spectrum_path)
+        spectra = convert_mzxml_to_mgf(filename_abspath, spectrum_path, spectrum_filter, peak_conditioning)[0]
+    elif prefilter:
+        if filename_abspath == path.abspath(spectrum_path):
+            spectrum_path = spectrum_path + ".prefiltered"
+        from prefilter_mzxml import prefilter_mzxml
+        logging.debug("Prefiltering %s into %s", filename, spectrum_path)
+        with record_stage(sample_name(filename), "prefilter", inputs=[filename_abspath], outputs=[spectrum_path]) as record:
+            prefilter_stats = prefilter_mzxml(filename_abspath, spectrum_path, spectrum_filter)
+            record.records = prefilter_stats.scans_in
+        spectra = prefilter_stats.scans_out
+    elif filename.endswith((".gz", ".GZ")):
+        logging.debug("Filename %s ends with .gz or .GZ", filename)
+        gunzip_call = ["gunzip", "-c", filename_abspath]
+        logging.debug("Gunzipping %s into %s", filename, spectrum_path)
+        with open(spectrum_path, "w") as gunzipped:
+            logging.debug("gunzip call: %s", gunzip_call)
+            subprocess.call(gunzip_call, stdout=gunzipped)
+        logging.debug("Unpacked the file to %s", spectrum_path)
+    else:
+        spectrum_path = filename_abspath
+
+    if threads == "auto":
+        threads, spectra = size_search(spectrum_path, database_bytes, "xtandem_"+taxon, DEFAULT_THREADS, max_threads,
+                spectra=spectra, shared_node=shared_node)
+    spectra = spectra or 0
+
+    if not output_filename:
+        output_filename = "output_"+samplename+".xml"
+    xtandem_output_filename = path.join(scratch_dir, path.basename(output_filename)) if scratch_dir else output_filename
+
+    logging.debug("Creating input XML for '%s'", filename)
+    input_xml_filename = "input_"+samplename+".xml"
+    write_input_xml(input_xml_filename, default_parameters, taxonomy, taxon, threads, 
+            spectrum_path, xtandem_output_filename, max_evalue)
+    logging.debug("Wrote file %s for sample %s", input_xml_filename, samplename)
+
+    staged_files = [spectrum_path] if path.abspath(spectrum_path) != filename_abspath else []
+    if cluster:
+        staged_files.append(cluster_map(spectrum_path))
+    if library is not None:
+        staged_files.append(library_hits_file(spectrum_path))
+    staged_sample = Staged_Sample(input_xml_filename, xtandem_output_filename, output_filename, spectrum_path, spectra, int(threads), prefilter_stats)
+    return staged_sample, staged_files
+
+
+def generate_xtandem_input_files(inputfiles, taxon, default_parameters, taxonomy, threads, output_filename, max_evalue, prefilter=False, mgf=False):
     """
     Creates input_FILENAME.xml for each input file.
     """
 
     for filename in inputfiles:
-        filename_abspath = path.abspath(filename)
-        samplename = path.splitext(path.basename(filename))[0]
-
-        if filename.endswith((".gz", ".GZ")):
-            logging.debug("Filename %s ends with .gz or .GZ", filename)
-            gunzip_call = ["gunzip", "-c", filename_abspath]
-            logging.debug("Gunzipping %s into %s", filename, samplename)
-            with open(samplename, "w") as gunzipped:
-                logging.debug("gunzip call: %s", gunzip_call)
-                subprocess.call(gunzip_call, stdout=gunzipped)
-            logging.debug("Unpacked the file to %s", samplename)
-
-        logging.debug("Creating input XML for '%s'", filename)
-        input_xml_filename = "input_"+samplename+".xml"
-        with open(input_xml_filename, "w") as input_xml:
-            if not output_filename:
-                output_filename = "output_"+samplename+".xml"
-            input_xml.write(INPUT_XML.format(defaults=default_parameters, 
-                taxonomy=taxonomy,
-                taxon=taxon,  
-                threads=threads,
-                input=samplename, 
-                output=output_filename,
-                evalue_refine=max_evalue,
-                evalue_output=max_evalue))
-        logging.debug("Wrote file %s for sample %s", input_xml_filename, samplename)
-        yield input_xml_filename, output_filename
+        staged_sample, _ = stage_xtandem_input_file(filename, 
+                taxon, default_parameters, taxonomy, threads, output_filename, max_evalue, prefilter, mgf)
+        yield staged_sample.input_xml, staged_sample.xtandem_output
 
 
 def main(options):
@@ -176,15 +547,85 @@ def main(options):
     Main function.
     """
 
-    for inputxml, outputxml in generate_xtandem_input_files(options.FILES, 
-            options.taxon, 
-            options.default_parameters, 
-            options.taxonomy, 
-            options.threads, 
-            options.output,
-            options.evalue):
-        run_xtandem(inputxml, outputxml, options.xtandem_path)
+    if options.cluster:
+        from cluster_spectra import expand_bioml, map_sources, cluster_map
+    if options.library:
+        from spectral_library import Spectral_Library, library_hits_file, merge_library_hits
+    if options.slim:
+        from slim_bioml import slim_bioml
+
+    if options.scratch:
+        makedirs(options.scratch, exist_ok=True)
+    database_bytes = reference_bytes(options.taxonomy, options.taxon)
+    database_files = taxon_databases(options.taxonomy, options.taxon)
+    stage = "xtandem_" + options.taxon + ("_two_pass" if options.two_pass else "")
+    stage_function = partial(stage_xtandem_input_file, 
+            taxon=options.taxon, 
+            default_parameters=options.default_parameters, 
+            taxonomy=options.taxonomy, 
+            threads=options.threads, 
+            output_filename=options.output,
+            max_evalue=options.evalue,
+            prefilter=options.prefilter,
+            mgf=options.mgf,
+            scratch_dir=options.scratch,
+            max_threads=options.max_threads,
+            shared_node=options.shared_node,
+            database_bytes=database_bytes,
+            cluster=options.cluster,
+            library=Spectral_Library(options.library) if options.library else None,
+            min_cosine=options.min_cosine)
+    samples = Staging_Pipeline(options.FILES, stage_function, 
+            depth=options.prefetch,
+            disk_budget=options.scratch_budget * 1e9,
+            cleanup=bool(options.scratch))
+    mover = Background_Mover()
+
+    for filename, sample in profile_hooks.timed_iter(samples, "staging"):
+        with record_stage(sample_name(filename), stage, inputs=[filename], outputs=[sample.xtandem_output]) as record:
+            record.records = sample.spectra
+            record.threads = sample.threads
+            record.reference_bytes = database_bytes
+            with pinned_cpus(sample.threads if options.pin else 0, options.lease_file) as cpus, \
+                    profile_hooks.timer("search"):
+                record.cpu_set = format_cpulist(cpus) if cpus else ""
+                search_start = time.time()
+                if options.two_pass:
+                    record.peak_rss_bytes = run_two_pass_search(sample, options, database_files, database_bytes, cpus)
+                else:
+                    record.peak_rss_bytes = run_xtandem(sample.input_xml, sample.xtandem_output, options.xtandem_path, cpus)
+                if sample.prefilter_stats:
+                    log_prefilter_effect(sample_name(filename), sample.prefilter_stats, time.time() - search_start,
+                            options.taxon, database_bytes, sample.threads)
+            if options.cluster:
+                if bioml_complete(sample.xtandem_output):
+                    with profile_hooks.timer("expand_clusters"):
+                        map_dbfile = cluster_map(sample.spectra_file)
+                        expand_bioml(sample.xtandem_output, map_dbfile,
+                                {source: sample.xtandem_output for source in map_sources(map_dbfile)})
+                else:
+                    logging.warning("Not expanding clusters in %s, X!Tandem output is missing or incomplete",
+                            sample.xtandem_output)
+            if options.library:
+                if bioml_complete(sample.xtandem_output):
+                    merge_library_hits(sample.xtandem_output, library_hits_file(sample.spectra_file))
+                else:
+                    logging.warning("Not merging library hits into %s, X!Tandem output is missing or incomplete",
+                            sample.xtandem_output)
+            if options.slim:
+                if bioml_complete(sample.xtandem_output):
+                    with profile_hooks.timer("slim"):
+                        slim_bioml(sample.xtandem_output, sample.xtandem_output)
+                else:
+                    logging.warning("Not slimming %s, X!Tandem output is missing or incomplete",
+                            sample.xtandem_output)
+            profile_hooks.count("samples")
+        samples.release(filename)
+        mover.move(sample.xtandem_output, sample.final_output)
+    with profile_hooks.timer("move_outputs"):
+        mover.wait()
+
 
 if __name__ == "__main__":
     options = parse_commandline()
-    main(options)
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, environ, sysconf, cpu_count
+from collections import namedtuple
+from statistics import median
+from xml.etree import ElementTree
+import argparse
+import logging
+import re
+
+from run_ledger import fetch_runs, LEDGER_ENVIRONMENT_VARIABLE
+from prefilter_mzxml import open_mzxml
+import profile_hooks
+
+
+# Search wall time is modelled as overhead + seconds_per_work * work *
+# (serial_fraction + (1 - serial_fraction) / threads) (Amdahl's law), where
+# work is MS2 spectra times reference database MiB, and peak memory as
+# base_memory_bytes + memory_per_spectrum * spectra.
+Performance_Model = namedtuple("Performance_Model",
+        ["overhead",
+         "seconds_per_work",
+         "serial_fraction",
+         "base_memory_bytes",
+         "memory_per_spectrum",
+         "runs"])
+
+MS2_SCAN = re.compile(rb"""msLevel=["']2["']""")
+MGF_SPECTRUM = re.compile(rb"BEGIN IONS")
+
+# Fewer earlier runs than this and the configured thread count is used.
+MIN_RUNS = 3
+
+# Serial fractions tried when fitting the performance model.
+SERIAL_FRACTIONS = [step / 100 for step in range(101)]
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Recommend X!Tandem thread (or MPI process) counts per sample from spectrum count, database size and earlier runs in the run ledger. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("FILES", metavar="SPECTRA", nargs="+",
+        help="mzXML (can be gzipped) or MGF files to size searches for.")
+    parser.add_argument("-t", "--taxonomy", metavar="FILE", dest="taxonomy",
+        default="",
+        help="X!Tandem taxonomy.xml to look up the database of TAXON in.")
+    parser.add_argument("-d", "--taxon", metavar="TAXON", dest="taxon",
+        default="bacteria",
+        help="Taxon to search [%(default)s].")
+    parser.add_argument("--db", metavar="FASTA", dest="db",
+        default="",
+        help="Reference database, instead of --taxonomy/--taxon.")
+    parser.add_argument("-s", "--stage", dest="stage",
+        default="xtandem_bacteria",
+        help="Ledger stage with earlier runs of this search [%(default)s].")
+    parser.add_argument("-n", "--threads", dest="threads",
+        type=int,
+        default=10,
+        help="Thread count to use without enough earlier runs [%(default)s].")
+    parser.add_argument("--mpi", dest="processes", action="store_true",
+        default=False,
+        help="Size MPI process counts (each process needs its own memory) [%(default)s].")
+    parser.add_argument("--max-threads", dest="max_threads",
+        type=int,
+        default=0,
+        help="Maximum thread count [number of CPUs].")
+    parser.add_argument("--shared-node", dest="shared_node", action="store_true",
+        default=False,
+        help="Searches of similar samples run side by side on the node; size for node throughput instead of the latency of one search [%(default)s].")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+
+    if not options.db and not options.taxonomy:
+        logging.error("Specify either --db or --taxonomy")
+        exit(1)
+    return options
+
+
+def count_spectra(filename, chunk_size=2**22):
+    """
+    Count MS2 scans in mzXML (can be gzipped) or spectra in MGF file.
+
+    Only the raw bytes are scanned, so this is much cheaper than parsing.
+    """
+
+    pattern = MGF_SPECTRUM if filename.lower().endswith(".mgf") else MS2_SCAN
+    overlap = 16
+    spectra = 0
+    tail = b""
+    with open_mzxml(filename) as spectrum_file:
+        for chunk in iter(lambda: spectrum_file.read(chunk_size), b""):
+            data = tail + chunk
+            # Matches starting in the last bytes are counted with the next chunk.
+            cutoff = max(len(data) - overlap, 0)
+            spectra += sum(1 for match in pattern.finditer(data) if match.start() < cutoff)
+            tail = data[cutoff:]
+        spectra += len(pattern.findall(tail))
+    return spectra
+
+
+def reference_bytes(taxonomy, taxon):
+    """
+    Total size of the database files of taxon in X!Tandem taxonomy.xml.
+    """
+
+    total = 0
+    for taxon_element in ElementTree.parse(taxonomy).getroot().iter("taxon"):
+        if taxon_element.attrib.get("label") != taxon:
+            continue
+        for file_element in taxon_element.iter("file"):
+            url = file_element.attrib.get("URL", "")
+            if path.isfile(url):
+                total += path.getsize(url)
+            else:
+                logging.warning("Database file %s for taxon %s not found", url, taxon)
+    return total
+
+
+def available_cores():
+    """
+    Number of CPUs this process may run on.
+    """
+
+    try:
+        from os import sched_getaffinity
+        return len(sched_getaffinity(0))
+    except ImportError:
+        return cpu_count() or 1
+
+
+def total_memory_bytes():
+    """
+    Physical memory of the node.
+    """
+
+    return sysconf("SC_PAGE_SIZE") * sysconf("SC_PHYS_PAGES")
+
+
+def work_units(spectra, database_bytes):
+    """
+    Search work of a sample: spectra times database MiB.
+    """
+
+    return spectra * database_bytes / 2**20
+
+
+def linear_fit(x, y):
+    """
+    Least squares fit of y = intercept + slope * x, both kept non-negative.
+
+    Returns a tuple (intercept, slope).
+    """
+
+    mean_x = sum(x) / len(x)
+    mean_y = sum(y) / len(y)
+    sxx = sum((xi - mean_x)**2 for xi in x)
+    if sxx:
+        slope = sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y)) / sxx
+    else:
+        slope = 0.0
+    slope = max(slope, 0.0)
+    return max(mean_y - slope * mean_x, 0.0), slope
+
+
+def parallel_work(work, threads, serial_fraction):
+    """
+    Work of a search on threads, scaled by Amdahl's law.
+    """
+
+    return work * (serial_fraction + (1 - serial_fraction) / threads)
+
+
+def wall_seconds(model, spectra, database_bytes, threads):
+    """
+    Modelled wall time of a search.
+    """
+
+    work = work_units(spectra, database_bytes)
+    return model.overhead + model.seconds_per_work * parallel_work(work, threads, model.serial_fraction)
+
+
+def fit_performance_model(runs):
+    """
+    Fit a Performance_Model to earlier ledger runs of a search stage.
+
+    Wall time is fitted on the Amdahl-scaled work for each serial
+    fraction in SERIAL_FRACTIONS, keeping the fit with the least squared
+    error; the serial fraction is only learned from runs with different
+    thread counts, and is 0 (linear scaling) otherwise. Peak RSS is
+    fitted on spectrum count (for MPI searches peak RSS is that of the
+    largest rank). Returns None if there are too few usable runs.
+    """
+
+    usable = [run for run in runs
+              if run.get("threads") and run.get("records") and run.get("reference_bytes")]
+    if len(usable) < MIN_RUNS:
+        return None
+    walls = [run["wall_seconds"] for run in usable]
+    best = None
+    for serial_fraction in SERIAL_FRACTIONS if len(set(run["threads"] for run in usable)) > 1 else [0.0]:
+        x = [parallel_work(work_units(run["records"], run["reference_bytes"]), run["threads"], serial_fraction)
+             for run in usable]
+        overhead, seconds_per_work = linear_fit(x, walls)
+        error = sum((overhead + seconds_per_work * xi - wall)**2 for xi, wall in zip(x, walls))
+        if best is None or error < best[0]:
+            best = (error, overhead, seconds_per_work, serial_fraction)
+    _, overhead, seconds_per_work, serial_fraction = best
+    base_memory_bytes, memory_per_spectrum = linear_fit(
+            [run["records"] for run in usable],
+            [run["peak_rss_bytes"] for run in usable])
+    return Performance_Model(overhead, seconds_per_work, serial_fraction,
+            base_memory_bytes, memory_per_spectrum, len(usable))
+
+
+def choose_threads(spectra, database_bytes, model, max_threads, cores, memory_bytes, processes=False, shared_node=False):
+    """
+    Pick the thread count for this sample.
+
+    By default only this search runs on the max_threads CPUs reserved for
+    it (e.g. a Snakemake job's threads), so the count with the shortest
+    modelled wall time is picked; with a serial fraction, extra threads
+    help less, but never hurt. With shared_node, the node is assumed to
+    be kept busy with searches of similar samples, and the count with
+    the best node throughput is picked: with n threads, as many searches
+    run side by side as fit in both the cores and the memory. With
+    processes (MPI ranks), every rank needs its own memory, and counts
+    that do not fit in memory are skipped. Ties go to more threads.
+    """
+
+    sample_memory = model.base_memory_bytes + model.memory_per_spectrum * spectra
+    best_threads = 1
+    best_score = None
+    for threads in range(1, max(max_threads, 1) + 1):
+        search_memory = sample_memory * (threads if processes else 1)
+        memory_limit = int(memory_bytes // search_memory) if search_memory else cores
+        if memory_limit < 1 and threads > 1:
+            break
+        wall = wall_seconds(model, spectra, database_bytes, threads)
+        if shared_node:
+            concurrent = max(min(cores // threads, memory_limit), 1)
+            score = concurrent / wall if wall else float(concurrent)
+        else:
+            score = 1 / wall if wall else float(threads)
+        if best_score is None or score >= best_score * 0.999:
+            best_threads = threads
+            best_score = max(best_score or 0.0, score)
+    return best_threads
+
+
+def size_search(spectrum_file, database_bytes, stage, default_threads, max_threads=0, processes=False, ledger=None, spectra=None, shared_node=False):
+    """
+    Choose the thread count for searching spectrum_file.
+
+    Uses the performance model fitted to earlier runs of stage in the run
+    ledger. Falls back to default_threads without a ledger or with too few
+    earlier runs. Set processes when sizing MPI ranks rather than threads,
+    and shared_node when searches run side by side (see choose_threads).
+    The spectra in spectrum_file are counted unless spectra is given,
+    e.g. by staging. Returns a tuple (threads, spectra).
+    """
+
+    if spectra is None:
+        spectra = count_spectra(spectrum_file)
+    cores = available_cores()
+    max_threads = min(max_threads or cores, cores)
+    ledger = ledger or environ.get(LEDGER_ENVIRONMENT_VARIABLE, "")
+    model = fit_performance_model(fetch_runs(ledger, stage)) if ledger and path.isfile(ledger) else None
+    if model is None:
+        threads = min(default_threads, max_threads)
+        logging.info("Too few earlier %s runs to size search of %s (%s spectra), using %s threads",
+                stage, spectrum_file, spectra, threads)
+        return threads, spectra
+
+    threads = choose_threads(spectra, database_bytes, model, max_threads, cores, total_memory_bytes(), processes, shared_node)
+    logging.info("Sized search of %s (%s spectra, %.0f MiB database) to %s threads, %.1f s "
+            "(model from %s runs: %.1f s + %.3g s/work unit, serial fraction %.2f, %.0f MiB per search)",
+            spectrum_file, spectra, database_bytes / 2**20, threads,
+            wall_seconds(model, spectra, database_bytes, threads),
+            model.runs, model.overhead, model.seconds_per_work, model.serial_fraction,
+            (model.base_memory_bytes + model.memory_per_spectrum * spectra) / 2**20)
+    return threads, spectra
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    if options.db:
+        database_bytes = path.getsize(options.db)
+    else:
+        database_bytes = reference_bytes(options.taxonomy, options.taxon)
+
+    print("file", "spectra", "threads", sep="\t")
+    for filename in options.FILES:
+        threads, spectra = size_search(filename, database_bytes, options.stage, options.threads, options.max_threads, options.processes,
+                shared_node=options.shared_node)
+        print(filename, spectra, threads, sep="\t")
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace
+from xml.sax.saxutils import quoteattr
+import argparse
+import logging
+import time
+from lxml import etree
+
+from run_ledger import record_stage, sample_name
+import profile_hooks
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Slim X!Tandem BIOML XML output files down to PSM groups and domains. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("FILE", type=str, nargs="+",
+        help="X!Tandem BIOML XML file(s) to slim.")
+    parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        default="",
+        help="Output filename. If not specified, FILE is replaced by its slim version.")
+    parser.add_argument("--no-parameters", dest="keep_parameters", action="store_false",
+        default=True,
+        help="Also drop the input and performance parameter groups.")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+
+    if options.outfile and len(options.FILE) > 1:
+        logging.error("Cannot specify output filename with more than one file on command line")
+        exit(1)
+    return options
+
+
+def format_attributes(element):
+    """
+    Format element attributes for a start tag.
+    """
+
+    return "".join(" {}={}".format(name, quoteattr(value))
+                   for name, value in element.attrib.items())
+
+
+def spectrum_scan(group):
+    """
+    Original scan number of a BIOML model group, or None.
+
+    X!Tandem numbers MGF spectra in file order; the original scan number
+    is kept in the 'scan=N' spectrum description (see write_mgf_spectrum)
+    and, in slim, expanded and library results, in a scan attribute.
+    """
+
+    if "scan" in group.attrib:
+        return int(group.attrib["scan"])
+    for note in group.iterdescendants("note"):
+        if note.attrib.get("label") == "Description" and note.text and note.text.strip().startswith("scan="):
+            return int(note.text.strip()[5:].split()[0])
+    return None
+
+
+def slim_bioml(xmlfile, outfilename, keep_parameters=True):
+    """
+    Write a slim copy of X!Tandem BIOML XML file.
+
+    Only model groups (with their attributes) and their domain elements
+    (with their attributes) are kept, plus the input and performance
+    parameter groups if keep_parameters is set. The original scan number
+    of MGF spectra is kept as a scan attribute (see spectrum_scan). Spectra, histograms,
+    protein sequences and all other support data are dropped. The slim
+    file is written to a temporary name and renamed when complete, so
+    outfilename can be the same as xmlfile.
+
+    Returns a tuple (bytes in, bytes out).
+    """
+
+    start_time = time.time()
+    bytes_in = path.getsize(xmlfile)
+    tmp_outfilename = outfilename + ".partial"
+    groups = 0
+    domains = 0
+    with open(tmp_outfilename, "w") as slim:
+        slim.write('<?xml version="1.0"?>\n')
+        for event, element in etree.iterparse(xmlfile, events=("start", "end")):
+            if event == "start":
+                if element.tag == "bioml":
+                    slim.write("<bioml{}>\n".format(format_attributes(element)))
+                continue
+            if element.tag != "group":
+                continue
+            group_type = element.attrib.get("type")
+            if group_type == "model":
+                scan = spectrum_scan(element)
+                if scan is not None and "scan" not in element.attrib:
+                    element.attrib["scan"] = str(scan)
+                slim.write("<group{}>\n".format(format_attributes(element)))
+                for domain in element.iterdescendants("domain"):
+                    slim.write("<domain{}/>\n".format(format_attributes(domain)))
+                    domains += 1
+                slim.write("</group>\n")
+                groups += 1
+            elif group_type == "parameters" and keep_parameters:
+                slim.write(etree.tostring(element, encoding="unicode", with_tail=False))
+                slim.write("\n")
+            else:
+                # Nested support groups (spectra, histograms) end before
+                # their model group and are simply discarded.
+                continue
+            element.clear()
+        slim.write("</bioml>\n")
+    replace(tmp_outfilename, outfilename)
+    profile_hooks.count("groups_seen", groups)
+    profile_hooks.count("domains_written", domains)
+
+    bytes_out = path.getsize(outfilename)
+    logging.info("Slimmed %s in %.1f s: kept %s groups with %s domains, %.1f MiB -> %.1f MiB (%.0f%% smaller)",
+            xmlfile, time.time() - start_time, groups, domains,
+            bytes_in / 2**20, bytes_out / 2**20,
+            100.0 * (1 - bytes_out / bytes_in) if bytes_in else 0.0)
+    return bytes_in, bytes_out
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    for xmlfile in options.FILE:
+        outfilename = options.outfile or xmlfile
+        with record_stage(sample_name(xmlfile), "slim_bioml", inputs=[xmlfile]) as record:
+            slim_bioml(xmlfile, outfilename, options.keep_parameters)
+            record.outputs.append(outfilename)
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
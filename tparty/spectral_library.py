@@ -0,0 +1,414 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, replace, SEEK_END
+from glob import glob
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+import numpy as np
+from lxml import etree
+
+from mzxml_spectra import Scan, iter_scans, condition_peaks, read_peak_conditioning, write_mgf_spectrum
+from prefilter_mzxml import read_spectrum_filter
+from cluster_spectra import read_searchable_scans, read_parent_tolerance, mz_tolerance, binned_vectors, expand_group
+from run_ledger import record_stage, sample_name
+from slim_bioml import spectrum_scan
+import profile_hooks
+
+
+# Spectra scored against the library at a time, and the most library
+# spectra a batch is scored against; bounds the similarity matrix.
+BATCH_SIZE = 256
+MAX_CANDIDATES = 8192
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Build a spectral library from confident PSMs in earlier X!Tandem results, and resolve new spectra against it so only unmatched spectra need a database search. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest="command")
+
+    build_parser = subparsers.add_parser("build",
+        help="Add confident PSMs of BIOML files to the library.")
+    build_parser.add_argument("LIBRARY",
+        help="Spectral library (SQLite3), created if missing.")
+    build_parser.add_argument("FILES", metavar="BIOML", nargs="+",
+        help="X!Tandem BIOML output files (can be slimmed).")
+    build_parser.add_argument("-s", "--spectra-dir", metavar="DIR", dest="spectra_dir",
+        required=True,
+        help="Directory with the searched SAMPLE.mzXML(.gz) files.")
+    build_parser.add_argument("-H", "--min-hyperscore", dest="min_hyperscore", metavar="H",
+        type=float,
+        default=0.0,
+        help="Minimum hyperscore value, as in convert_tandem_xml_2_fasta.py [%(default)s].")
+    build_parser.add_argument("-e", "--max-evalue", dest="max_evalue", metavar="e",
+        type=float,
+        default=1e15,
+        help="Maximum e-value, as in convert_tandem_xml_2_fasta.py [%(default)s].")
+
+    search_parser = subparsers.add_parser("search",
+        help="Match the spectra of an mzXML file against the library.")
+    search_parser.add_argument("LIBRARY",
+        help="Spectral library (SQLite3).")
+    search_parser.add_argument("FILE", metavar="MZXML",
+        help="mzXML file (can be gzipped).")
+    search_parser.add_argument("-o", "--outfile", dest="outfile", metavar="FILE",
+        required=True,
+        help="MGF of the spectra without a library match, for X!Tandem.")
+    search_parser.add_argument("--hits", dest="hits", metavar="FILE",
+        default="",
+        help="BIOML with the library PSMs of matched spectra [OUTFILE.library.xml].")
+    search_parser.add_argument("-c", "--min-cosine", dest="min_cosine", metavar="C",
+        type=float,
+        default=0.9,
+        help="Minimum cosine similarity of binned, square root scaled peaks for a library match [%(default)s].")
+    search_parser.add_argument("-b", "--bin-width", dest="bin_width", metavar="DA",
+        type=float,
+        default=1.0005,
+        help="Fragment m/z bin width in Dalton [%(default)s].")
+
+    for subparser in (build_parser, search_parser):
+        subparser.add_argument("-p", "--default-parameters", metavar="FILE", dest="default_parameters",
+            required=True,
+            help="X!Tandem default_parameters.xml with parent mass tolerance, spectrum thresholds and peak reduction settings.")
+        profile_hooks.add_profile_arguments(subparser)
+        subparser.add_argument("--loglevel",
+            choices=["INFO", "DEBUG"],
+            default="INFO",
+            help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+    if not options.command:
+        parser.print_help()
+        exit(1)
+
+    logging.basicConfig(level=options.loglevel)
+
+    if options.command == "search" and not options.hits:
+        options.hits = library_hits_file(options.outfile)
+    return options
+
+
+def library_hits_file(mgf_filename):
+    """
+    Default library hits filename for an unmatched spectra MGF.
+    """
+
+    return mgf_filename + ".library.xml"
+
+
+def create_library_db(dbfile):
+    db = sqlite3.connect(dbfile)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS spectra(
+            peptide text NOT NULL,
+            charge integer NOT NULL,
+            precursor_mz real NOT NULL,
+            hyperscore real NOT NULL,
+            expect real NOT NULL,
+            sample text NOT NULL,
+            scan integer NOT NULL,
+            mz blob NOT NULL,
+            intensity blob NOT NULL,
+            psm text NOT NULL,
+            PRIMARY KEY(peptide, charge));
+    """)
+    return db
+
+
+def iter_confident_psms(xmlfile, min_hyperscore, max_evalue):
+    """
+    Yields (scan, peptide, charge, hyperscore, expect, PSM group) from BIOML file.
+
+    As in convert_tandem_xml_2_fasta.py, only the first domain of each
+    group is considered. The PSM group is a slim copy of the model
+    group with its domains. The scan is the original scan number (see
+    spectrum_scan), or the group id for mzXML searches. The ids of an
+    MGF search are not scan numbers, so a ValueError is raised at the
+    end if its BIOML (per its input parameters) lacks some.
+    """
+
+    mgf_search = False
+    unmapped = 0
+    for _, element in etree.iterparse(xmlfile):
+        if element.tag == "note" and element.attrib.get("label") == "spectrum, path":
+            mgf_search = (element.text or "").strip().lower().endswith(".mgf")
+            continue
+        if element.tag != "group" or element.attrib.get("type") != "model":
+            continue
+        scan = spectrum_scan(element)
+        if scan is None:
+            scan = int(element.attrib["id"])
+            unmapped += 1
+        for domain in element.iterdescendants("domain"):
+            if float(domain.attrib["expect"]) <= max_evalue and float(domain.attrib["hyperscore"]) >= min_hyperscore:
+                psm = etree.Element("group", element.attrib)
+                for psm_domain in element.iterdescendants("domain"):
+                    etree.SubElement(psm, "domain", psm_domain.attrib)
+                yield (scan, domain.attrib["seq"], int(element.attrib["z"]),
+                       float(domain.attrib["hyperscore"]), float(domain.attrib["expect"]), psm)
+            break
+        element.clear()
+    if mgf_search and unmapped:
+        raise ValueError("{} is an MGF search without the original scan numbers of {} groups; "
+                "use the unslimmed X!Tandem output or one slimmed by slim_bioml.py".format(xmlfile, unmapped))
+
+
+def find_spectrum_file(spectra_dir, sample):
+    """
+    The mzXML file of sample in spectra_dir.
+    """
+
+    candidates = sorted(glob(path.join(spectra_dir, sample + ".mzXML*")))
+    if not candidates:
+        raise FileNotFoundError("No mzXML file for sample {} in {}".format(sample, spectra_dir))
+    return candidates[0]
+
+
+def add_to_library(library_file, xmlfile, spectra_dir, default_parameters, min_hyperscore, max_evalue):
+    """
+    Add confident PSMs of xmlfile to the library.
+
+    For each peptide and charge state the spectrum with the highest
+    hyperscore is kept, with peaks reduced as X!Tandem would. The whole
+    file is read before the library is changed. Returns a tuple
+    (confident PSMs, library entries added or improved).
+    """
+
+    best = {}
+    for scan, peptide, charge, hyperscore, expect, psm in iter_confident_psms(xmlfile, min_hyperscore, max_evalue):
+        if (peptide, charge) not in best or hyperscore > best[(peptide, charge)][1]:
+            best[(peptide, charge)] = (scan, hyperscore, expect, etree.tostring(psm, encoding="unicode"))
+    psms = len(best)
+    if not best:
+        return 0, 0
+
+    library = create_library_db(library_file)
+    known = {}
+    for peptide, charge, hyperscore in library.execute("SELECT peptide, charge, hyperscore FROM spectra"):
+        known[(peptide, charge)] = hyperscore
+    wanted = {}
+    for key, (scan, hyperscore, expect, psm) in best.items():
+        if hyperscore > known.get(key, float("-inf")):
+            wanted.setdefault(scan, []).append((key, hyperscore, expect, psm))
+    if not wanted:
+        library.close()
+        return psms, 0
+
+    sample = sample_name(xmlfile)
+    peak_conditioning = read_peak_conditioning(default_parameters)
+    entries = []
+    for scan in iter_scans(find_spectrum_file(spectra_dir, sample), ms_levels=(2,)):
+        if scan.num not in wanted or scan.precursor_mz is None:
+            continue
+        mz, intensity = condition_peaks(scan.mz, scan.intensity, peak_conditioning)
+        for (peptide, charge), hyperscore, expect, psm in wanted[scan.num]:
+            entries.append((peptide, charge, scan.precursor_mz, hyperscore, expect, sample, scan.num,
+                            mz.astype(np.float64).tobytes(), intensity.astype(np.float32).tobytes(), psm))
+    with library:
+        library.executemany("INSERT OR REPLACE INTO spectra VALUES (?,?,?,?,?,?,?,?,?,?)", entries)
+    library.close()
+    return psms, len(entries)
+
+
+class Spectral_Library():
+    """
+    Library spectra per charge state, sorted on precursor m/z.
+    """
+
+    def __init__(self, library_file):
+        if not path.isfile(library_file):
+            raise FileNotFoundError("Spectral library {} not found".format(library_file))
+        # Staging threads look up PSMs of matched spectra.
+        self.db = sqlite3.connect(library_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.spectra = {}
+        self.precursors = {}
+        for rowid, charge, precursor_mz, mz, intensity in self.db.execute(
+                "SELECT rowid, charge, precursor_mz, mz, intensity FROM spectra ORDER BY charge, precursor_mz"):
+            self.spectra.setdefault(charge, []).append(Scan(rowid, 2, None, precursor_mz, charge,
+                    np.frombuffer(mz, dtype=np.float64), np.frombuffer(intensity, dtype=np.float32)))
+        for charge, spectra in self.spectra.items():
+            self.precursors[charge] = np.array([spectrum.precursor_mz for spectrum in spectra])
+
+    def __len__(self):
+        return sum(len(spectra) for spectra in self.spectra.values())
+
+    def psm(self, rowid):
+        with self.lock:
+            psm, = self.db.execute("SELECT psm FROM spectra WHERE rowid = ?", (rowid,)).fetchone()
+        return etree.fromstring(psm)
+
+    def match(self, scans, parent_tolerance, min_cosine=0.9, bin_width=1.0005):
+        """
+        Best library match of each scan.
+
+        Scans are scored in batches of consecutive precursor m/z per
+        charge state against the library spectra within the precursor
+        tolerance of the batch, as one matrix product of binned peak
+        vectors. Returns a list with (library rowid, cosine) or None
+        per scan.
+        """
+
+        matches = [None] * len(scans)
+        for charge in sorted(set(scan.precursor_charge or 0 for scan in scans)):
+            if charge not in self.spectra:
+                continue
+            library_spectra = self.spectra[charge]
+            library_precursors = self.precursors[charge]
+            indexes = sorted((i for i, scan in enumerate(scans) if (scan.precursor_charge or 0) == charge),
+                             key=lambda i: scans[i].precursor_mz)
+            batch_start = 0
+            batch_size = BATCH_SIZE
+            while batch_start < len(indexes):
+                batch = indexes[batch_start:batch_start + batch_size]
+                precursors = np.array([scans[i].precursor_mz for i in batch])
+                tolerances = mz_tolerance(precursors, charge, parent_tolerance)
+                first = int(np.searchsorted(library_precursors, precursors[0] - tolerances[0], side="left"))
+                last = int(np.searchsorted(library_precursors, precursors[-1] + tolerances[-1], side="right"))
+                if last - first > MAX_CANDIDATES and len(batch) > 1:
+                    batch_size = max(len(batch) // 2, 1)
+                    continue
+                if last > first:
+                    vectors = binned_vectors([scans[i] for i in batch] + library_spectra[first:last], bin_width)
+                    cosines = vectors[:len(batch)].dot(vectors[len(batch):].T)
+                    outside = np.abs(precursors[:, np.newaxis] - library_precursors[np.newaxis, first:last]) > tolerances[:, np.newaxis]
+                    cosines[outside] = -1.0
+                    best = cosines.argmax(axis=1)
+                    for row, i in enumerate(batch):
+                        cosine = float(cosines[row, best[row]])
+                        if cosine >= min_cosine:
+                            matches[i] = (library_spectra[first + best[row]].num, cosine)
+                batch_start += len(batch)
+                batch_size = BATCH_SIZE
+        return matches
+
+
+def library_prefilter(filename, library, outfilename, hits_filename, default_parameters, min_cosine=0.9, bin_width=1.0005):
+    """
+    Resolve the searchable scans of filename against library.
+
+    Scans with a library match get a copy of the library PSM, set to the
+    scan's number and precursor, in hits_filename (BIOML). The remaining
+    scans are written to outfilename (MGF) for the database search.
+    X!Tandem numbers the MGF spectra in file order, so the library PSMs
+    are numbered after them to keep group ids unique in the merged
+    result. Returns a tuple (scans, matched).
+    """
+
+    start_time = time.time()
+    spectrum_filter = read_spectrum_filter(default_parameters)
+    peak_conditioning = read_peak_conditioning(default_parameters)
+    parent_tolerance = read_parent_tolerance(default_parameters)
+    scans, _ = read_searchable_scans([filename], spectrum_filter, peak_conditioning)
+    with profile_hooks.timer("library_match"):
+        matches = library.match(scans, parent_tolerance, min_cosine, bin_width)
+
+    unmatched = sum(1 for match in matches if match is None)
+    matched = 0
+    tmp_outfilename = outfilename + ".partial"
+    tmp_hits_filename = hits_filename + ".partial"
+    with open(tmp_outfilename, "w") as mgf, open(tmp_hits_filename, "w") as hits:
+        hits.write('<?xml version="1.0"?>\n<bioml label="spectral library matches">\n')
+        for scan, match in zip(scans, matches):
+            if match is None:
+                write_mgf_spectrum(mgf, scan, scan.mz, scan.intensity)
+                continue
+            rowid, cosine = match
+            matched += 1
+            psm = expand_group(library.psm(rowid), scan.num, scan.precursor_mz, scan.precursor_charge,
+                    group_id=unmatched + matched)
+            psm.attrib["library_cosine"] = "{:.3f}".format(cosine)
+            hits.write(etree.tostring(psm, encoding="unicode", with_tail=False))
+            hits.write("\n")
+        hits.write("</bioml>\n")
+    replace(tmp_hits_filename, hits_filename)
+    replace(tmp_outfilename, outfilename)
+    profile_hooks.count("scans_read", len(scans))
+    profile_hooks.count("library_matches", matched)
+
+    logging.info("Resolved %s of %s scans of %s with the spectral library (%s spectra) in %.1f s; %s left to search in %s",
+            matched, len(scans), filename, len(library), time.time() - start_time, len(scans) - matched, outfilename)
+    return len(scans), matched
+
+
+def merge_library_hits(xmlfile, hits_filename):
+    """
+    Append the library PSMs in hits_filename to X!Tandem BIOML xmlfile.
+
+    The groups are inserted before the closing bioml tag, so the output
+    of the database search and the library matches read as one result.
+    """
+
+    with open(hits_filename, "rb") as hits:
+        groups = [line for line in hits if line.startswith(b"<group")]
+    with open(xmlfile, "r+b") as xml:
+        xml.seek(max(xml.seek(0, SEEK_END) - 64, 0))
+        tail_offset = xml.tell()
+        tail = xml.read()
+        end = tail.rfind(b"</bioml>")
+        if end == -1:
+            raise ValueError("{} does not end with </bioml>".format(xmlfile))
+        xml.seek(tail_offset + end)
+        xml.truncate()
+        xml.writelines(groups)
+        xml.write(b"</bioml>\n")
+    return len(groups)
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    if options.command == "build":
+        for xmlfile in options.FILES:
+            start_time = time.time()
+            with record_stage(sample_name(xmlfile), "spectral_library_build", inputs=[xmlfile], outputs=[options.LIBRARY]) as record:
+                psms, added = add_to_library(options.LIBRARY, xmlfile, options.spectra_dir,
+                        options.default_parameters, options.min_hyperscore, options.max_evalue)
+                record.records = psms
+            logging.info("Added or improved %s library spectra from %s confident PSMs in %s in %.1f s",
+                    added, psms, xmlfile, time.time() - start_time)
+        return
+
+    library = Spectral_Library(options.LIBRARY)
+    with record_stage(sample_name(options.FILE), "spectral_library_search", inputs=[options.FILE], outputs=[options.outfile, options.hits]) as record:
+        scans, matched = library_prefilter(options.FILE, library, options.outfile, options.hits,
+                options.default_parameters, options.min_cosine, options.bin_width)
+        record.records = scans
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
@@ -0,0 +1,191 @@
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+"""
+Overlap sample staging and output handling with searches.
+
+Staging_Pipeline prepares upcoming samples in a background thread while
+the current sample is searched, keeping the staged data on the scratch
+device within a disk budget. Background_Mover moves finished outputs to
+their final location without holding up the next search.
+"""
+
+from os import path, remove
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
+import threading
+import logging
+import shutil
+import struct
+
+
+# What the X!Tandem wrappers stage for one sample: the input XML to run,
+# where the search writes its output and where that output should end up,
+# the staged spectra and their search size, and the Prefilter_Stats of the
+# spectra if they were prefiltered (else None).
+Staged_Sample = namedtuple("Staged_Sample",
+        ["input_xml",
+         "xtandem_output",
+         "final_output",
+         "spectra_file",
+         "spectra",
+         "threads",
+         "prefilter_stats"])
+
+
+def estimate_staged_bytes(filename):
+    """
+    Estimate disk space needed to stage (decompress) filename.
+
+    Uses the uncompressed size stored in the gzip trailer (modulo 4 GiB,
+    so it is corrected to at least the compressed size).
+    """
+
+    size = path.getsize(filename)
+    if filename.endswith((".gz", ".GZ")) and size >= 4:
+        with open(filename, "rb") as gzipped:
+            gzipped.seek(-4, 2)
+            uncompressed = struct.unpack("<I", gzipped.read(4))[0]
+        while uncompressed < size:
+            uncompressed += 2**32
+        return uncompressed
+    return size
+
+
+class Staging_Pipeline():
+    """
+    Iterate over staged samples while the next ones are staged in the background.
+
+    stage_function(item) prepares one sample and returns (result,
+    staged_files). Iterating yields (item, result) in input order. Call
+    release(item) when a sample is done with; its staged files are then
+    removed (if cleanup is set) and its space is returned to the budget.
+
+    At most depth samples are staged ahead of the one being consumed,
+    and a new sample is only staged when its estimated size fits in
+    disk_budget bytes (0 means unlimited), unless nothing else is staged.
+    With depth 0 all staging happens in the consuming thread, exactly
+    like a plain loop.
+    """
+
+    def __init__(self, items, stage_function, depth=1, disk_budget=0, cleanup=True):
+        self.items = list(items)
+        self.stage_function = stage_function
+        self.depth = depth
+        self.disk_budget = disk_budget
+        self.cleanup = cleanup
+        self.condition = threading.Condition()
+        self.ready = deque()
+        self.staged = {}
+        self.staged_bytes = 0
+        self.error = None
+        self.finished = False
+
+    def _space_available(self, estimate):
+        if not self.staged:
+            return True
+        if len(self.staged) > self.depth:
+            return False
+        return not self.disk_budget or self.staged_bytes + estimate <= self.disk_budget
+
+    def _worker(self):
+        try:
+            for item in self.items:
+                estimate = estimate_staged_bytes(item) if isinstance(item, str) and path.isfile(item) else 0
+                with self.condition:
+                    while not self._space_available(estimate):
+                        self.condition.wait()
+                    self.staged[item] = ([], estimate)
+                    self.staged_bytes += estimate
+                logging.debug("Staging %s in background (%.1f MiB staged)", item, self.staged_bytes / 2**20)
+                result, staged_files = self.stage_function(item)
+                with self.condition:
+                    self.staged[item] = (list(staged_files), estimate)
+                    self.ready.append((item, result))
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def __iter__(self):
+        if self.depth < 1:
+            for item in self.items:
+                result, staged_files = self.stage_function(item)
+                self.staged[item] = (list(staged_files), 0)
+                yield item, result
+            return
+
+        worker = threading.Thread(target=self._worker, name="staging", daemon=True)
+        worker.start()
+        while True:
+            with self.condition:
+                while not self.ready and not self.finished and self.error is None:
+                    self.condition.wait()
+                if self.ready:
+                    item, result = self.ready.popleft()
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    break
+            yield item, result
+        worker.join()
+
+    def release(self, item):
+        """
+        Remove the staged files of item and return its space to the budget.
+        """
+
+        with self.condition:
+            staged_files, estimate = self.staged.pop(item, ([], 0))
+            self.staged_bytes -= estimate
+            self.condition.notify_all()
+        if self.cleanup:
+            for staged_file in staged_files:
+                if path.exists(staged_file):
+                    logging.debug("Removing staged file %s", staged_file)
+                    remove(staged_file)
+
+
+class Background_Mover():
+    """
+    Move finished output files to their final location in a background thread.
+
+    Call wait() before exiting; it raises the first error encountered.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.moves = []
+
+    def move(self, source, destination):
+        if path.abspath(source) == path.abspath(destination):
+            return
+        logging.debug("Moving %s to %s in background", source, destination)
+        self.moves.append(self.executor.submit(shutil.move, source, destination))
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+        for move in self.moves:
+            move.result()
+        self.moves = []
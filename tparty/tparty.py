@@ -0,0 +1,234 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+"""
+Single entry point for the tparty programs: tparty.py SUBCOMMAND [ARGS].
+
+Only the standard library is imported up front; a subcommand's module
+(and with it lxml, numpy, gspread, ...) is imported when it is run.
+'tparty.py worker' runs many subcommands in one process, so interpreter
+startup and imports are paid once.
+"""
+
+from sys import argv, exit, executable, stdin, stdout
+from os import path
+from statistics import median
+import argparse
+import logging
+import runpy
+import shlex
+import subprocess
+import sys
+import time
+
+
+# Subcommands and the modules implementing them, in help order.
+SUBCOMMANDS = [
+    ("xtandem", "run_xtandem", "Run X!Tandem on mzXML files."),
+    ("parallel-xtandem", "run_parallel_tandem", "Run MPI X!Tandem on mzXML files."),
+    ("prefilter", "prefilter_mzxml", "Remove unsearchable scans from mzXML."),
+    ("mgf", "mzxml_spectra", "Convert mzXML to compact MGF."),
+    ("cluster", "cluster_spectra", "Cluster redundant scans / expand results."),
+    ("library", "spectral_library", "Build or search the spectral library."),
+    ("slim", "slim_bioml", "Slim X!Tandem BIOML output."),
+    ("xml2fasta", "convert_tandem_xml_2_fasta", "Convert X!Tandem BIOML to peptide FASTA."),
+    ("unique-proteins", "create_unique_protein_list", "List unique proteins of BIOML files."),
+    ("exact-match", "exact_match", "Exact peptide matching against a protein database."),
+    ("genome-index", "genome_index", "Build or search the translated genome index."),
+    ("dedup", "dedup_fasta", "Deduplicate a protein FASTA database."),
+    ("warm-cache", "warm_cache", "Pre-fault reference databases into the page cache."),
+    ("sizing", "search_sizing", "Recommend X!Tandem thread counts."),
+    ("cpus", "cpu_placement", "Show NUMA nodes and CPU leases."),
+    ("replicate", "replicate", "Replicate files between hosts with checksums."),
+    ("queue", "work_queue", "Shared multi-host work queue for jobs."),
+    ("ledger", "run_ledger", "Summarize the run ledger."),
+    ("report", "gspread_report", "Report results to Google Docs."),
+    ("benchmark", "benchmark_pipeline", "Benchmark the pipeline with stand-in executables."),
+]
+MODULES = {subcommand: module for subcommand, module, _ in SUBCOMMANDS}
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+
+    Subcommand arguments are left for the subcommand's own parser.
+    """
+
+    desc = """Run tparty programs as subcommands, many in one process (worker), or benchmark their startup time. Fredrik Boulund 2016"""
+    epilog = "subcommands:\n" + "\n".join("  {:<18} {}".format(subcommand, text) for subcommand, _, text in SUBCOMMANDS)
+    epilog += "\n  {:<18} {}\n  {:<18} {}".format(
+            "worker", "Run subcommands read one per line from FILE (or stdin) in this process.",
+            "benchmark-startup", "Time 'SUBCOMMAND --help' as script, via tparty.py and in a worker.")
+
+    parser = argparse.ArgumentParser(description=desc, epilog=epilog,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("SUBCOMMAND",
+        choices=sorted(MODULES) + ["worker", "benchmark-startup"],
+        metavar="SUBCOMMAND",
+        help="Subcommand to run, see below.")
+    parser.add_argument("ARGS", nargs=argparse.REMAINDER,
+        help="Arguments to the subcommand.")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    return parser.parse_args()
+
+
+def run_subcommand(subcommand, args):
+    """
+    Run subcommand with args (list) as if its script was run.
+
+    The module is executed as __main__ (so worker processes of
+    multiprocessing pools find its functions), with argv set for its
+    parser. Returns the exit status.
+    """
+
+    module = MODULES[subcommand]
+    saved_argv = sys.argv
+    sys.argv = [module + ".py"] + list(args)
+    try:
+        runpy.run_module(module, run_name="__main__", alter_sys=True)
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    finally:
+        sys.argv = saved_argv
+
+
+def reset_profile_state():
+    """
+    Clear counters and timers left by the previous subcommand in a worker.
+    """
+
+    if "profile_hooks" in sys.modules:
+        profile_hooks = sys.modules["profile_hooks"]
+        profile_hooks.COUNTERS.clear()
+        profile_hooks.TIMERS.clear()
+
+
+def run_worker(commands, status):
+    """
+    Run commands (lines 'SUBCOMMAND ARGS', '#' comments) one after another.
+
+    Imports are shared between commands; logging is configured by the
+    first command. A line 'exit status seconds command' is written to
+    status per command. Returns the number of failed commands.
+    """
+
+    failed = 0
+    for line in commands:
+        words = shlex.split(line, comments=True)
+        if not words:
+            continue
+        start = time.perf_counter()
+        if words[0] not in MODULES:
+            logging.error("Unknown subcommand %s", words[0])
+            code = 2
+        else:
+            reset_profile_state()
+            try:
+                code = run_subcommand(words[0], words[1:])
+            except Exception:
+                logging.exception("%s failed", line.strip())
+                code = 1
+        failed += bool(code)
+        status.write("exit {} {:.3f} {}\n".format(code, time.perf_counter() - start, line.strip()))
+        status.flush()
+    return failed
+
+
+def time_command(command, repeat):
+    """
+    Median wall time of running command (list) repeat times.
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return median(times)
+
+
+def benchmark_startup(subcommands, repeat=5):
+    """
+    Time 'SUBCOMMAND --help' started as its own script, through tparty.py and in a worker.
+
+    Returns a list of tuples (subcommand, script s, tparty.py s, worker s).
+    The worker time is that of the command after the first, i.e. with
+    imports already done.
+    """
+
+    here = path.dirname(path.abspath(__file__))
+    results = []
+    for subcommand in subcommands:
+        script = path.join(here, MODULES[subcommand] + ".py")
+        script_time = time_command([executable, script, "--help"], repeat)
+        tparty_time = time_command([executable, path.abspath(__file__), subcommand, "--help"], repeat)
+        worker_input = "\n".join([subcommand + " --help"] * (repeat + 1)) + "\n"
+        worker = subprocess.run([executable, path.abspath(__file__), "worker"],
+                input=worker_input, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        worker_times = [float(line.split()[2]) for line in worker.stdout.splitlines() if line.startswith("exit ")]
+        worker_time = median(worker_times[1:]) if len(worker_times) > 1 else float("nan")
+        results.append((subcommand, script_time, tparty_time, worker_time))
+    return results
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    if options.SUBCOMMAND in MODULES:
+        return run_subcommand(options.SUBCOMMAND, options.ARGS)
+
+    if options.SUBCOMMAND == "worker":
+        logging.basicConfig(level=logging.INFO)
+        if options.ARGS and options.ARGS[0] not in ("-", "--help", "-h"):
+            with open(options.ARGS[0]) as commands:
+                return 1 if run_worker(commands, stdout) else 0
+        if options.ARGS:
+            print("usage: tparty.py worker [FILE]\n\nRun 'SUBCOMMAND ARGS' lines from FILE (or stdin) in one process.")
+            return 0
+        return 1 if run_worker(stdin, stdout) else 0
+
+    parser = argparse.ArgumentParser(prog="tparty.py benchmark-startup")
+    parser.add_argument("SUBCOMMANDS", nargs="*",
+        default=[subcommand for subcommand, _, _ in SUBCOMMANDS],
+        help="Subcommands to benchmark [all].")
+    parser.add_argument("-r", "--repeat", dest="repeat", metavar="N",
+        type=int,
+        default=5,
+        help="Runs per measurement [%(default)s].")
+    benchmark_options = parser.parse_args(options.ARGS)
+    print("subcommand", "script_s", "tparty_s", "worker_s", sep="\t")
+    for subcommand, script_time, tparty_time, worker_time in benchmark_startup(benchmark_options.SUBCOMMANDS, benchmark_options.repeat):
+        print(subcommand, "{:.3f}".format(script_time), "{:.3f}".format(tparty_time), "{:.3f}".format(worker_time), sep="\t")
+    return 0
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    exit(main(options))
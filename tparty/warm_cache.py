@@ -0,0 +1,315 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+
+from sys import argv, exit
+from os import path, listdir, posix_fadvise, POSIX_FADV_WILLNEED, POSIX_FADV_DONTNEED, POSIX_FADV_SEQUENTIAL
+from xml.etree import ElementTree
+import argparse
+import logging
+import ctypes
+import ctypes.util
+import signal
+import mmap
+import time
+import yaml
+import numpy as np
+
+from cpu_placement import process_alive
+import profile_hooks
+
+
+# Snakemake config entries naming reference databases (a path or list of paths).
+DATABASE_KEYS = ["blat_genome_db", "human_proteome", "blat_resistance_db"]
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Pre-fault reference databases into the page cache, optionally keeping them resident while a batch runs. Reports first and repeated load times, which are cold load times only with --drop. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("FILES", nargs="*",
+        help="Additional files to warm.")
+    parser.add_argument("-t", "--taxonomy", metavar="FILE", dest="taxonomy",
+        default="",
+        help="Warm all databases in X!Tandem taxonomy.xml.")
+    parser.add_argument("-c", "--config", metavar="FILE", dest="config",
+        default="",
+        help="Warm the databases in the Snakemake config ({}), and those in its xtandem_taxonomy.".format(", ".join(DATABASE_KEYS)))
+    parser.add_argument("--drop", dest="drop", action="store_true",
+        default=False,
+        help="Evict the files from the page cache first, so the first load time is a cold load time. Pages that are mapped or dirty (e.g. held by another warm_cache.py --hold) are not evicted [%(default)s].")
+    parser.add_argument("--hold", dest="hold", action="store_true",
+        default=False,
+        help="Keep the files mapped and resident (locked if allowed, else re-touched every --interval) until terminated [%(default)s].")
+    parser.add_argument("--while-pid", metavar="PID", dest="while_pid",
+        type=int,
+        default=0,
+        help="With --hold, stop holding when process PID exits.")
+    parser.add_argument("--interval", metavar="S", dest="interval",
+        type=float,
+        default=300,
+        help="Seconds between re-touching held files that could not be locked [%(default)s].")
+    profile_hooks.add_profile_arguments(parser)
+    parser.add_argument("--loglevel",
+        choices=["INFO", "DEBUG"],
+        default="INFO",
+        help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.loglevel, format="%(asctime)s %(levelname)s: %(message)s")
+    return options
+
+
+def taxonomy_databases(taxonomy):
+    """
+    Database files of all taxa in X!Tandem taxonomy.xml.
+    """
+
+    return [file_element.attrib["URL"]
+            for file_element in ElementTree.parse(taxonomy).getroot().iter("file")
+            if file_element.attrib.get("URL")]
+
+
+def config_databases(configfile):
+    """
+    Database files named in the Snakemake config, including those in its taxonomy.xml.
+    """
+
+    with open(configfile) as f:
+        config = yaml.safe_load(f)
+    databases = []
+    for key in DATABASE_KEYS:
+        value = config.get(key)
+        if isinstance(value, str):
+            databases.append(value)
+        elif value:
+            databases.extend(value)
+    if config.get("xtandem_taxonomy") and path.isfile(config["xtandem_taxonomy"]):
+        databases.extend(taxonomy_databases(config["xtandem_taxonomy"]))
+    # Translated genome indexes built by genome_index.py in the workdir.
+    if config.get("genome_index"):
+        indexdir_base = path.join(config.get("workdir", ""), config.get("genome_indexdir", "genome_index"))
+        for genome in config.get("blat_genome_db") or []:
+            indexdir = path.join(indexdir_base, path.basename(genome) + ".tindex")
+            if path.isdir(indexdir):
+                databases.extend(path.join(indexdir, filename) for filename in sorted(listdir(indexdir)))
+    return databases
+
+
+def drop_from_cache(filename):
+    """
+    Ask the kernel to evict (clean) pages of filename from the page cache.
+    """
+
+    with open(filename, "rb") as f:
+        posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+
+
+def touch_pages(mapped):
+    """
+    Read one byte of every page of mapped, faulting all pages in.
+    """
+
+    pages = np.frombuffer(mapped, dtype=np.uint8)[::mmap.PAGESIZE]
+    return int(pages.sum())
+
+
+def load_file(filename):
+    """
+    Map filename and fault all its pages in, with sequential readahead hints.
+
+    Returns a tuple (mmap, file object, seconds).
+    """
+
+    f = open(filename, "rb")
+    start = time.perf_counter()
+    posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+    posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    touch_pages(mapped)
+    return mapped, f, time.perf_counter() - start
+
+
+class Locked_Mapping():
+    """
+    Read-only shared mapping of a file, locked in memory with mlock(2).
+
+    Mapped through libc rather than the mmap module: a PROT_READ,
+    MAP_SHARED mapping locks the page cache pages themselves, which
+    concurrent searches share. (mlock of a writable private mapping
+    would copy every page into anonymous memory.)
+    """
+
+    def __init__(self, libc, address, length):
+        self.libc = libc
+        self.address = address
+        self.length = length
+
+    def close(self):
+        if self.address is not None:
+            self.libc.munlock(self.address, self.length)
+            self.libc.munmap(self.address, self.length)
+            self.address = None
+
+
+def lock_in_memory(filename):
+    """
+    Map filename read-only and shared, and lock its pages in memory with mlock(2).
+
+    Returns a Locked_Mapping, or None if locking is not permitted (see
+    'ulimit -l').
+    """
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    length = path.getsize(filename)
+    with open(filename, "rb") as f:
+        address = libc.mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0)
+    if address is None or address == ctypes.c_void_p(-1).value:
+        logging.debug("mmap of %s failed: %s", filename, ctypes.get_errno())
+        return None
+    if libc.mlock(address, length) != 0:
+        logging.debug("mlock of %s failed: %s", filename, ctypes.get_errno())
+        libc.munmap(address, length)
+        return None
+    return Locked_Mapping(libc, address, length)
+
+
+def warm_files(filenames, drop=False):
+    """
+    Load each file into the page cache and measure first and repeated load times.
+
+    The first load is only cold with drop, and then only for the pages
+    the kernel could evict; without drop it includes whatever was
+    already cached.
+    Returns a list of tuples (filename, bytes, first seconds, warm seconds).
+    """
+
+    if not drop:
+        logging.warning("Without --drop, the first load times include pages already in the page cache and are not cold load times")
+    results = []
+    for filename in filenames:
+        if not path.isfile(filename):
+            logging.warning("Database %s not found", filename)
+            continue
+        size = path.getsize(filename)
+        if not size:
+            continue
+        if drop:
+            drop_from_cache(filename)
+        mapped, f, first = load_file(filename)
+        mapped.close()
+        f.close()
+        mapped, f, warm = load_file(filename)
+        mapped.close()
+        f.close()
+        logging.info("Warmed %s (%.0f MiB): first load %.2f s (%.0f MiB/s), warm %.2f s",
+                filename, size / 2**20, first, size / 2**20 / first if first else 0.0, warm)
+        results.append((filename, size, first, warm))
+    return results
+
+
+def hold_files(filenames, while_pid=0, interval=300):
+    """
+    Keep files resident until SIGTERM/SIGINT, or until while_pid exits.
+
+    Files are locked in memory if permitted, otherwise kept mapped and
+    re-touched every interval seconds so they stay recently used.
+    """
+
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.append(signum))
+
+    locked = []
+    touched = []
+    for filename in filenames:
+        if not path.isfile(filename) or not path.getsize(filename):
+            continue
+        mapped = lock_in_memory(filename)
+        if mapped is not None:
+            locked.append(mapped)
+            logging.info("Locked %s in memory", filename)
+        else:
+            mapped, f, _ = load_file(filename)
+            touched.append((filename, mapped, f))
+            logging.info("Holding %s (re-touched every %s s, could not lock)", filename, interval)
+
+    last_touch = time.time()
+    while not stop and (not while_pid or process_alive(while_pid)):
+        time.sleep(min(interval, 5))
+        if touched and time.time() - last_touch >= interval:
+            for filename, mapped, f in touched:
+                touch_pages(mapped)
+            last_touch = time.time()
+
+    for mapped in locked:
+        mapped.close()
+    for filename, mapped, f in touched:
+        mapped.close()
+        f.close()
+    logging.info("Released %s held files", len(locked) + len(touched))
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    filenames = list(options.FILES)
+    if options.taxonomy:
+        filenames.extend(taxonomy_databases(options.taxonomy))
+    if options.config:
+        filenames.extend(config_databases(options.config))
+    seen = set()
+    unique_filenames = []
+    for filename in filenames:
+        if path.realpath(filename) not in seen:
+            seen.add(path.realpath(filename))
+            unique_filenames.append(filename)
+
+    results = warm_files(unique_filenames, options.drop)
+    print("database", "MiB", "first_s", "warm_s", "first_MiB_per_s", sep="\t")
+    for filename, size, first, warm in results:
+        print(filename, "{:.0f}".format(size / 2**20), "{:.2f}".format(first), "{:.2f}".format(warm),
+                "{:.0f}".format(size / 2**20 / first if first else 0.0), sep="\t")
+
+    if options.hold:
+        hold_files([filename for filename, _, _, _ in results], options.while_pid, options.interval)
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)
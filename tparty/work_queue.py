@@ -0,0 +1,491 @@
+#!/usr/bin/env python3.5
+# encoding: utf-8
+#
+#  ----------------------------------------------------------
+#  This file is part of TPARTY: http://tparty.readthedocs.org
+#  ----------------------------------------------------------
+#
+#  Copyright (c) 2016, Fredrik Boulund <fredrik.boulund@chalmers.se>
+#
+#  Permission to use, copy, modify, and/or distribute this software for any
+#  purpose with or without fee is hereby granted, provided that the above
+#  copyright notice and this permission notice appear in all copies.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+#  REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+#  INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+#  LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+#  OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+#  PERFORMANCE OF THIS SOFTWARE.
+"""
+Durable multi-host work queue for sample-level jobs (e.g. run_xtandem.py).
+
+Jobs are commands stored in an SQLite3 queue file shared by all hosts.
+Workers on any host claim jobs atomically, renew a lease with periodic
+heartbeats while the command runs, and mark it done or failed. Jobs
+whose lease expires (worker host died or hung) are claimed again by
+the next worker, up to --max-attempts times. Jobs are therefore run at
+least once; commands must tolerate being rerun.
+
+The queue file must be on a filesystem with working POSIX locks
+(local disk, or NFSv4 with locking); SQLite does not work reliably
+on filesystems without them.
+"""
+
+from sys import argv, exit
+from os import path, getpid, makedirs, killpg
+from collections import namedtuple, Counter
+from contextlib import contextmanager
+import subprocess
+import threading
+import argparse
+import logging
+import sqlite3
+import socket
+import signal
+import shlex
+import json
+import time
+
+from run_ledger import sample_name
+import profile_hooks
+
+
+CREATE_TABLE_JOBS = """CREATE TABLE IF NOT EXISTS jobs(
+    id integer PRIMARY KEY,
+    sample text,
+    command text UNIQUE,
+    priority int DEFAULT 0,
+    state text DEFAULT 'pending',
+    attempts int DEFAULT 0,
+    max_attempts int DEFAULT 3,
+    worker text,
+    lease_expires real,
+    submitted real,
+    started real,
+    finished real,
+    exit_code int,
+    message text)
+"""
+
+CREATE_INDEX_STATE = "CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, priority, id)"
+
+Job = namedtuple("Job", ["id", "sample", "command", "attempts"])
+
+# Queue file errors (e.g. "database is locked" after the busy timeout, or
+# a briefly unavailable network filesystem) are retried with exponential
+# backoff up to MAX_BACKOFF seconds; a finished job's result is recorded
+# in at most DATABASE_RETRIES attempts.
+MAX_BACKOFF = 60
+DATABASE_RETRIES = 6
+
+# Processes of the jobs this worker is running, and whether it is
+# stopping; on SIGTERM or SIGINT their process groups are terminated and
+# the jobs returned to the queue (see stop_worker).
+RUNNING_PROCESSES = set()
+STOPPING = threading.Event()
+
+
+def parse_commandline():
+    """
+    Parse commandline.
+    """
+
+    desc = """Durable work queue (SQLite3) shared by workers on several hosts. Workers claim jobs atomically, heartbeat while they run, and jobs with expired leases are taken over by other workers. Fredrik Boulund 2016"""
+
+    parser = argparse.ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest="command")
+
+    submit_parser = subparsers.add_parser("submit",
+        help="Add a job (command) to the queue; already queued commands are ignored.")
+    submit_parser.add_argument("QUEUE",
+        help="Queue file (SQLite3), created if missing.")
+    submit_parser.add_argument("COMMAND", nargs=argparse.REMAINDER,
+        help="Command and arguments to run, e.g. run_xtandem.py --output ... SAMPLE.mzXML.gz.")
+    submit_parser.add_argument("-s", "--sample", dest="sample", metavar="NAME",
+        default="",
+        help="Sample name of the job [from the last argument].")
+    submit_parser.add_argument("-p", "--priority", dest="priority", metavar="P",
+        type=int,
+        default=0,
+        help="Jobs with lower priority values are claimed first [%(default)s].")
+    submit_parser.add_argument("-a", "--max-attempts", dest="max_attempts", metavar="N",
+        type=int,
+        default=3,
+        help="Attempts before the job is marked failed [%(default)s].")
+
+    worker_parser = subparsers.add_parser("worker",
+        help="Claim and run jobs from the queue.")
+    worker_parser.add_argument("QUEUE",
+        help="Queue file (SQLite3).")
+    worker_parser.add_argument("-j", "--jobs", dest="jobs", metavar="N",
+        type=int,
+        default=1,
+        help="Jobs run concurrently by this worker [%(default)s].")
+    worker_parser.add_argument("-l", "--lease", dest="lease", metavar="S",
+        type=float,
+        default=300,
+        help="Lease length; a job is taken over if not renewed within it [%(default)s].")
+    worker_parser.add_argument("--heartbeat", dest="heartbeat", metavar="S",
+        type=float,
+        default=60,
+        help="Seconds between lease renewals [%(default)s].")
+    worker_parser.add_argument("--poll", dest="poll", metavar="S",
+        type=float,
+        default=30,
+        help="Seconds between claims when the queue is empty [%(default)s].")
+    worker_parser.add_argument("--exit-when-empty", dest="exit_when_empty", action="store_true",
+        default=False,
+        help="Exit when no job can be claimed, instead of polling [%(default)s].")
+    worker_parser.add_argument("--logdir", dest="logdir", metavar="DIR",
+        default="",
+        help="Write each job's output to DIR/SAMPLE.JOBID.log [discard].")
+
+    status_parser = subparsers.add_parser("status",
+        help="Show job counts per state, and running jobs.")
+    status_parser.add_argument("QUEUE",
+        help="Queue file (SQLite3).")
+
+    requeue_parser = subparsers.add_parser("requeue",
+        help="Return failed jobs to the queue.")
+    requeue_parser.add_argument("QUEUE",
+        help="Queue file (SQLite3).")
+    requeue_parser.add_argument("SAMPLES", nargs="*",
+        help="Only requeue failed jobs of these samples [all].")
+
+    for subparser in (submit_parser, worker_parser, status_parser, requeue_parser):
+        profile_hooks.add_profile_arguments(subparser)
+        subparser.add_argument("--loglevel",
+            choices=["INFO", "DEBUG"],
+            default="INFO",
+            help="Set logging level [%(default)s].")
+
+    if len(argv)<2:
+        parser.print_help()
+        exit()
+
+    options = parser.parse_args()
+    if not options.command:
+        parser.print_help()
+        exit(1)
+    if options.command == "submit" and not options.COMMAND:
+        submit_parser.error("no COMMAND to submit")
+    if options.command == "worker" and options.heartbeat >= options.lease:
+        worker_parser.error("--heartbeat must be shorter than --lease")
+
+    logging.basicConfig(level=options.loglevel, format="%(asctime)s %(levelname)s: %(message)s")
+    return options
+
+
+class Work_Queue():
+    """
+    Jobs in an SQLite3 queue file.
+
+    Every state change is a single IMMEDIATE transaction, so claims by
+    concurrent workers, on this or other hosts, never return the same
+    job twice. Methods are safe to call from several threads.
+    """
+
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(queue_file, timeout=120, isolation_level=None, check_same_thread=False)
+        with self.transaction():
+            self.db.execute(CREATE_TABLE_JOBS)
+            self.db.execute(CREATE_INDEX_STATE)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def submit(self, command, sample="", priority=0, max_attempts=3):
+        """
+        Queue command (list). Returns False if it is already queued.
+        """
+
+        with self.transaction() as db:
+            cursor = db.execute("INSERT OR IGNORE INTO jobs(sample, command, priority, max_attempts, submitted) VALUES (?, ?, ?, ?, ?)",
+                    (sample or sample_name(command[-1]), json.dumps(command), priority, max_attempts, time.time()))
+        return cursor.rowcount == 1
+
+    def claim(self, worker, lease):
+        """
+        Claim the next pending job, or one whose lease has expired, for worker.
+
+        Jobs whose lease expired max_attempts times are marked failed.
+        Returns a Job, or None if there is nothing to claim.
+        """
+
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("""UPDATE jobs SET state='failed', finished=?, message='lease expired after ' || attempts || ' attempts'
+                    WHERE state='running' AND lease_expires<? AND attempts>=max_attempts""", (now, now))
+            row = db.execute("""SELECT id, sample, command, attempts, worker, state FROM jobs
+                    WHERE state='pending' OR (state='running' AND lease_expires<?)
+                    ORDER BY priority, id LIMIT 1""", (now,)).fetchone()
+            if not row:
+                return None
+            job_id, sample, command, attempts, previous_worker, state = row
+            db.execute("""UPDATE jobs SET state='running', worker=?, attempts=attempts+1, lease_expires=?, started=?
+                    WHERE id=?""", (worker, now + lease, now, job_id))
+        if state == "running":
+            logging.warning("Took over job %s (%s) from %s", job_id, sample, previous_worker)
+            profile_hooks.count("jobs_taken_over")
+        return Job(job_id, sample, json.loads(command), attempts + 1)
+
+    def heartbeat(self, job, worker, lease):
+        """
+        Renew worker's lease on job. Returns False if the lease was lost.
+        """
+
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires=? WHERE id=? AND worker=? AND state='running'",
+                    (time.time() + lease, job.id, worker))
+        return cursor.rowcount == 1
+
+    def finish(self, job, worker, exit_code, message=""):
+        """
+        Mark worker's job done (exit_code 0), or failed or pending for a retry.
+
+        Returns False if worker no longer held the job.
+        """
+
+        with self.transaction() as db:
+            row = db.execute("SELECT max_attempts FROM jobs WHERE id=? AND worker=? AND state='running'",
+                    (job.id, worker)).fetchone()
+            if not row:
+                return False
+            if exit_code == 0:
+                state = "done"
+            else:
+                state = "failed" if job.attempts >= row[0] else "pending"
+            db.execute("UPDATE jobs SET state=?, finished=?, exit_code=?, message=?, lease_expires=NULL WHERE id=?",
+                    (state, time.time(), exit_code, message, job.id))
+        return True
+
+    def release(self, job, worker):
+        """
+        Return worker's job to pending without counting the attempt.
+
+        Returns False if worker no longer held the job.
+        """
+
+        with self.transaction() as db:
+            cursor = db.execute("""UPDATE jobs SET state='pending', worker=NULL, attempts=attempts-1, lease_expires=NULL
+                    WHERE id=? AND worker=? AND state='running'""", (job.id, worker))
+        return cursor.rowcount == 1
+
+    def requeue(self, samples=()):
+        """
+        Return failed jobs (of samples) to pending with fresh attempts. Returns their number.
+        """
+
+        with self.transaction() as db:
+            query = "UPDATE jobs SET state='pending', attempts=0, worker=NULL WHERE state='failed'"
+            if samples:
+                query += " AND sample IN ({})".format(",".join("?" * len(samples)))
+            cursor = db.execute(query, list(samples))
+        return cursor.rowcount
+
+    def status(self):
+        """
+        Returns (Counter of jobs per state, [(id, sample, worker, attempts, running seconds)]).
+        """
+
+        with self.lock:
+            counts = Counter(dict(self.db.execute("SELECT state, count(*) FROM jobs GROUP BY state")))
+            running = self.db.execute("""SELECT id, sample, worker, attempts, ? - started FROM jobs
+                    WHERE state='running' ORDER BY started""", (time.time(),)).fetchall()
+        return counts, running
+
+
+def terminate_group(process, grace=30):
+    """
+    Terminate process and its process group, killing it after grace seconds.
+    """
+
+    try:
+        killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        process.wait()
+
+
+def run_job(queue, job, worker, lease, heartbeat, logdir=""):
+    """
+    Run job's command, renewing the lease every heartbeat seconds.
+
+    The command runs in its own process group. If the lease is lost
+    (the job was taken over after missed heartbeats) the whole group is
+    terminated, including e.g. the tandem started by run_xtandem.py, so
+    it does not keep writing next to the worker that took over.
+    The process is in RUNNING_PROCESSES while it runs, so that
+    stop_worker can terminate its group.
+    Returns the exit code, or None if the lease was lost.
+    """
+
+    log = open(path.join(logdir, "{}.{}.log".format(job.sample, job.id)), "a") if logdir else subprocess.DEVNULL
+    process = None
+    try:
+        process = subprocess.Popen(job.command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        RUNNING_PROCESSES.add(process)
+        if STOPPING.is_set():
+            terminate_group(process)
+        while True:
+            try:
+                return process.wait(timeout=heartbeat)
+            except subprocess.TimeoutExpired:
+                pass
+            try:
+                renewed = queue.heartbeat(job, worker, lease)
+            except sqlite3.Error as e:
+                logging.warning("Heartbeat for job %s failed: %s", job.id, e)
+                continue
+            if not renewed:
+                logging.error("Lost lease on job %s (%s), terminating it", job.id, job.sample)
+                terminate_group(process)
+                return None
+    finally:
+        RUNNING_PROCESSES.discard(process)
+        if logdir:
+            log.close()
+
+
+def finish_job(queue, job, worker, exit_code, message=""):
+    """
+    Work_Queue.finish, retried with backoff on queue file errors.
+
+    Returns the result of finish, or None if it could not be recorded;
+    the job is then run again once its lease expires.
+    """
+
+    delay = 1
+    for attempt in range(DATABASE_RETRIES):
+        try:
+            return queue.finish(job, worker, exit_code, message)
+        except sqlite3.Error as e:
+            logging.warning("Could not record the result of job %s: %s; retrying in %s s", job.id, e, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+    logging.error("Gave up recording the result of job %s (%s); it will be rerun when its lease expires",
+            job.id, job.sample)
+    return None
+
+
+def work(queue, worker, options):
+    """
+    Claim and run jobs until the queue is empty (with exit_when_empty) or forever.
+
+    Queue file errors when claiming are logged and retried with backoff,
+    so they do not end the worker thread. When the worker is stopping, no
+    more jobs are claimed and the interrupted job is returned to pending.
+    """
+
+    delay = 1
+    while not STOPPING.is_set():
+        try:
+            job = queue.claim(worker, options.lease)
+        except sqlite3.Error as e:
+            logging.warning("%s could not claim a job: %s; retrying in %s s", worker, e, delay)
+            STOPPING.wait(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+            continue
+        delay = 1
+        if not job:
+            if options.exit_when_empty:
+                return
+            STOPPING.wait(options.poll)
+            continue
+        logging.info("%s running job %s (%s, attempt %s): %s", worker, job.id, job.sample, job.attempts,
+                " ".join(shlex.quote(argument) for argument in job.command))
+        start_time = time.time()
+        try:
+            exit_code = run_job(queue, job, worker, options.lease, options.heartbeat, options.logdir)
+        except OSError as e:
+            logging.error("Could not run job %s: %s", job.id, e)
+            exit_code, message = 127, str(e)
+        else:
+            message = ""
+        if STOPPING.is_set():
+            try:
+                if queue.release(job, worker):
+                    logging.info("%s returned job %s (%s) to the queue", worker, job.id, job.sample)
+            except sqlite3.Error as e:
+                logging.warning("Could not return job %s to the queue, it is rerun when its lease expires: %s", job.id, e)
+            return
+        if exit_code is None:
+            profile_hooks.count("jobs_lost")
+            continue
+        finished = finish_job(queue, job, worker, exit_code, message)
+        if finished is None:
+            profile_hooks.count("jobs_unrecorded")
+            continue
+        if not finished:
+            logging.warning("Job %s was taken over before it finished", job.id)
+            profile_hooks.count("jobs_lost")
+            continue
+        profile_hooks.count("jobs_done" if exit_code == 0 else "jobs_failed")
+        logging.info("%s finished job %s (%s) with exit code %s in %.1f s",
+                worker, job.id, job.sample, exit_code, time.time() - start_time)
+
+
+def stop_worker(signum, frame):
+    """
+    Signal handler: stop claiming jobs and terminate the running jobs.
+
+    The process groups are terminated in background threads, as each
+    may take terminate_group's grace period to exit.
+    """
+
+    logging.warning("Received %s, terminating %s running jobs", signal.Signals(signum).name, len(RUNNING_PROCESSES))
+    STOPPING.set()
+    for process in list(RUNNING_PROCESSES):
+        threading.Thread(target=terminate_group, args=(process,)).start()
+
+
+def main(options):
+    """
+    Main.
+    """
+
+    queue = Work_Queue(options.QUEUE)
+
+    if options.command == "submit":
+        if queue.submit(options.COMMAND, options.sample, options.priority, options.max_attempts):
+            logging.info("Queued %s", " ".join(options.COMMAND))
+        else:
+            logging.info("Already queued: %s", " ".join(options.COMMAND))
+    elif options.command == "worker":
+        if options.logdir:
+            makedirs(options.logdir, exist_ok=True)
+        workers = ["{}:{}:{}".format(socket.gethostname(), getpid(), slot) for slot in range(options.jobs)]
+        signal.signal(signal.SIGTERM, stop_worker)
+        signal.signal(signal.SIGINT, stop_worker)
+        threads = [threading.Thread(target=work, args=(queue, worker, options)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elif options.command == "requeue":
+        logging.info("Requeued %s failed jobs", queue.requeue(options.SAMPLES))
+    else:
+        counts, running = queue.status()
+        print("\t".join("{} {}".format(state, counts[state]) for state in ["pending", "running", "done", "failed"]))
+        for job_id, sample, worker, attempts, seconds in running:
+            print(job_id, sample, worker, "attempt {}".format(attempts), "{:.0f} s".format(seconds), sep="\t")
+
+
+if __name__ == "__main__":
+    options = parse_commandline()
+    profile_hooks.run_main(main, options)